@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+'''
+Measure the start up time of StreaMD command line tools.
+Each module is imported in a fresh python process several times and the best wall time is reported together with
+heavy libraries which were loaded by the import (they should be loaded only by the code which uses them).
+
+python benchmarks/import_time.py
+python benchmarks/import_time.py --help_time
+'''
+import argparse
+import subprocess
+import sys
+import time
+
+MODULES = ['streamd.run_md',
+           'streamd.run_gbsa',
+           'streamd.prolif.run_prolif',
+           'streamd.prolif.prolif2png',
+           'streamd.prolif.prolif_frame_map',
+           'streamd.analysis.run_analysis']
+
+HEAVY_LIBRARIES = ['MDAnalysis', 'rdkit', 'parmed', 'dask', 'distributed', 'matplotlib', 'seaborn', 'plotly',
+                   'prolif', 'plotnine', 'pandas', 'numpy']
+
+CHECK_CODE = '''
+import sys, time
+start = time.perf_counter()
+import {module}
+duration = time.perf_counter() - start
+heavy = [name for name in {heavy} if name in sys.modules]
+print(f'{{duration}}|{{",".join(heavy)}}')
+'''
+
+
+def measure_import(module, repeats):
+    '''
+    :param module: module name
+    :param repeats: number of measurements
+    :return: best import time in seconds, list of loaded heavy libraries
+    '''
+    times = []
+    heavy = []
+    for _ in range(repeats):
+        res = subprocess.run([sys.executable, '-c', CHECK_CODE.format(module=module, heavy=HEAVY_LIBRARIES)],
+                             capture_output=True, text=True, check=True)
+        duration, heavy = res.stdout.strip().split('|')
+        times.append(float(duration))
+        heavy = [name for name in heavy.split(',') if name]
+    return min(times), heavy
+
+
+def measure_help(module, repeats):
+    '''
+    :param module: module name with main function
+    :param repeats: number of measurements
+    :return: best wall time of the whole process in seconds
+    '''
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', f'import sys; sys.argv = ["{module}", "--help"]; '
+                                              f'from {module} import main; main()'],
+                       capture_output=True, check=False)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the import time of StreaMD command line tools.')
+    parser.add_argument('-m', '--modules', nargs='+', default=MODULES,
+                        help='modules to import')
+    parser.add_argument('-n', '--repeats', type=int, default=5,
+                        help='number of measurements, the best time is reported')
+    parser.add_argument('--help_time', action='store_true', default=False,
+                        help='measure also the wall time of "--help" call of each tool, '
+                             'including the start of the python interpreter')
+    args = parser.parse_args()
+
+    for module in args.modules:
+        duration, heavy = measure_import(module, args.repeats)
+        line = f'{module:40s} import {duration:7.3f} s'
+        if args.help_time:
+            line += f'  --help {measure_help(module, args.repeats):7.3f} s'
+        print(f'{line}  heavy libraries: {", ".join(heavy) if heavy else "-"}')
+
+
+if __name__ == '__main__':
+    main()
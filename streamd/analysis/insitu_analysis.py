@@ -0,0 +1,265 @@
+import logging
+import os
+import time
+from glob import glob
+
+from streamd.analysis.md_system_analysis import get_rmsd_groupselections, save_gyrate, save_rmsf
+from streamd.utils.utils import get_mol_resid_pair
+from streamd.utils.xtc_tail import (read_new_frames, tail_xtc, get_xtc_n_frames, minimum_image,
+                                    fit_transform)
+
+
+class StreamingAnalysis:
+    '''
+    Accumulators of RMSD (fitted on the backbone, the first frame is the reference), radius of gyration and RMSF
+    of the protein updated frame by frame from raw mdrun frames. Molecules are made whole and placed next to
+    the protein in the first frame, periodic jumps are removed in the next frames (as trjconv -pbc nojump)
+    '''
+    def __init__(self, tpr, molid_resid_pairs, ligand_resid='UNL', active_site_dist=5.0):
+        '''
+        :param tpr:
+        :param molid_resid_pairs: dict {molid: resid} of ligands and cofactors of the system
+        :param ligand_resid:
+        :param active_site_dist:
+        '''
+        import MDAnalysis as mda
+
+        self.universe = mda.Universe(tpr)
+        self.molid_resid_pairs = dict(molid_resid_pairs)
+        self.ligand_resid = ligand_resid
+        self.active_site_dist = active_site_dist
+        self.groupselections, self.ligand_name = get_rmsd_groupselections(self.molid_resid_pairs,
+                                                                          ligand_resid=ligand_resid,
+                                                                          active_site_dist=active_site_dist)
+        resnames = ' '.join(self.molid_resid_pairs.values())
+        self.atoms = self.universe.select_atoms(f'protein or resname {resnames}' if resnames else 'protein')
+        self.n_frames = 0
+        self.last_time = None
+        self.group_ids = None
+
+    def _local(self, atomgroup):
+        import numpy as np
+
+        return np.searchsorted(self.atoms.indices, atomgroup.indices)
+
+    def _first_frame(self, coords, box):
+        import numpy as np
+        from MDAnalysis.lib.mdamath import triclinic_box
+
+        self.universe.atoms.positions = coords
+        self.universe.dimensions = triclinic_box(*box)
+        self.atoms.unwrap(compound='fragments')
+        # fragments are placed into the nearest image to the largest fragment (the protein)
+        fragments = sorted(self.atoms.fragments, key=len, reverse=True)
+        center = fragments[0].center_of_geometry()
+        for fragment in fragments[1:]:
+            fragment_center = fragment.center_of_geometry()
+            fragment.positions += center + minimum_image([fragment_center - center], box)[0] - fragment_center
+        x = self.atoms.positions.astype(np.float64)
+
+        self.group_ids = [self._local(self.atoms.select_atoms(selection))
+                          for selection in ['backbone', *self.groupselections]]
+        protein = self.atoms.select_atoms('protein')
+        self.protein_ids = self._local(protein)
+        self.protein_masses = protein.masses.astype(np.float64)
+        self.ref = x
+        self.prev = x
+        self.rmsd = []
+        self.rg = []
+        self.times = []
+        self.mean = np.zeros((len(protein), 3))
+        self.m2 = np.zeros((len(protein), 3))
+        return x
+
+    def add_frame(self, t, coords, box):
+        '''
+        :param t: time in ps
+        :param coords: coordinates of all atoms in A
+        :param box: box vectors in A
+        '''
+        import numpy as np
+
+        # duplicated frames of continued simulations
+        if self.last_time is not None and t <= self.last_time:
+            return
+        if self.group_ids is None:
+            x = self._first_frame(coords, box)
+        else:
+            x = self.prev + minimum_image(coords[self.atoms.indices] - self.prev, box)
+        self.prev = x
+
+        backbone = self.group_ids[0]
+        rotation, mobile_center, ref_center = fit_transform(x[backbone], self.ref[backbone])
+        fitted = (x - mobile_center) @ rotation.T + ref_center
+        self.rmsd.append([np.sqrt(((fitted[ids] - self.ref[ids]) ** 2).sum(axis=1).mean()) if len(ids) else np.nan
+                          for ids in self.group_ids])
+
+        # radius of gyration and fluctuations of the protein, mass weighted fit to the first frame as gmx rmsf
+        protein, masses = x[self.protein_ids], self.protein_masses
+        rotation, mobile_center, ref_center = fit_transform(protein, self.ref[self.protein_ids], weights=masses)
+        protein = (protein - mobile_center) @ rotation.T + ref_center
+        d = protein - np.average(protein, axis=0, weights=masses)
+        self.rg.append([np.sqrt((masses[:, None] * d ** 2).sum(axis=0)[list(axes)].sum() / masses.sum())
+                        for axes in ((0, 1, 2), (1, 2), (0, 2), (0, 1))])
+        # Welford accumulator of positions
+        self.n_frames += 1
+        delta = protein - self.mean
+        self.mean += delta / self.n_frames
+        self.m2 += delta * (protein - self.mean)
+        self.times.append(t)
+        self.last_time = t
+
+    def get_rmsd_df(self):
+        import numpy as np
+        import pandas as pd
+
+        rmsd_df = pd.DataFrame(np.round(self.rmsd, 2), columns=['backbone', *self.groupselections])
+        rmsd_df.index.name = 'frame'
+        rmsd_df = rmsd_df.reset_index()
+        # transform to ns, frames of continued simulations may have a different time step
+        rmsd_df['time(ns)'] = np.asarray(self.times) / 1000
+        return rmsd_df.drop('frame', axis='columns')
+
+    def save_state(self, fname):
+        import numpy as np
+
+        np.savez(fname, n_frames=self.n_frames, last_time=self.last_time, ref=self.ref, prev=self.prev,
+                 rmsd=np.array(self.rmsd), rg=np.array(self.rg), times=np.array(self.times),
+                 mean=self.mean, m2=self.m2, groupselections=np.array(self.groupselections, dtype=str),
+                 n_groups=len(self.group_ids),
+                 **{f'group_{n}': ids for n, ids in enumerate(self.group_ids)})
+
+    def load_state(self, fname):
+        import numpy as np
+
+        with np.load(fname) as state:
+            self.group_ids = [state[f'group_{n}'] for n in range(int(state['n_groups']))]
+            protein = self.atoms.select_atoms('protein')
+            self.protein_ids = self._local(protein)
+            self.protein_masses = protein.masses.astype(np.float64)
+            self.n_frames = int(state['n_frames'])
+            self.last_time = float(state['last_time'])
+            self.ref, self.prev = state['ref'], state['prev']
+            self.rmsd, self.rg, self.times = state['rmsd'].tolist(), state['rg'].tolist(), state['times'].tolist()
+            self.mean, self.m2 = state['mean'], state['m2']
+
+    def write_outputs(self, wdir_out_analysis, system_name):
+        '''
+        Save radius of gyration, RMSF and B-factors of the protein as md_trajectory_analysis does
+        :return: rmsd pandas DataFrame
+        '''
+        save_gyrate(self.times, self.rg, wdir_out_analysis=wdir_out_analysis, system_name=system_name)
+        # B-factors of the protein atoms in the first frame
+        save_rmsf(self.atoms.select_atoms('protein'), self.ref[self.protein_ids],
+                  self.m2.sum(axis=1) / max(self.n_frames, 1), wdir_out_analysis=wdir_out_analysis,
+                  system_name=system_name)
+        return self.get_rmsd_df()
+
+
+def get_insitu_state_file(wdir, deffnm, analysis_dirname='md_analysis'):
+    return os.path.join(wdir, analysis_dirname, f'insitu_{deffnm}.npz')
+
+
+def is_insitu_analysis_finished(wdir, deffnm, analysis_dirname='md_analysis', groupselections=None, xtc=None):
+    '''
+    :param groupselections: None or RMSD selections which should be calculated by the in-situ analysis
+    :param xtc: None or trajectory ({deffnm}.xtc of the complex by default)
+    :return: True if the in-situ analysis covers all frames of the final trajectory
+    '''
+    import numpy as np
+
+    state_file = get_insitu_state_file(wdir, deffnm, analysis_dirname)
+    xtc = xtc or os.path.join(wdir, f'{deffnm}.xtc')
+    if not os.path.isfile(state_file) or not os.path.isfile(xtc):
+        return False
+    with np.load(state_file) as state:
+        if groupselections is not None and state['groupselections'].tolist() != list(groupselections):
+            return False
+        return int(state['n_frames']) == get_xtc_n_frames(xtc)
+
+
+def tail_part_xtc(wdir, deffnm_next, is_running, interval=60):
+    '''
+    Frames of the part trajectory of a continued simulation ({deffnm_next}.partNNNN.xtc, continue_md.sh),
+    the file is created by mdrun after the start
+    '''
+    while True:
+        running = is_running()
+        parts = sorted(glob(os.path.join(wdir, f'{deffnm_next}.part*.xtc')))
+        if parts:
+            yield from tail_xtc(parts[-1], is_running, interval=interval)
+            return
+        if not running:
+            return
+        time.sleep(interval)
+
+
+def run_insitu_analysis(wdir, deffnm, is_running, deffnm_next=None, tpr=None, xtc=None, ligand_resid='UNL',
+                        active_site_dist=5.0, ligand_list_file=None, analysis_dirname='md_analysis', interval=60):
+    '''
+    Analyse the trajectory while mdrun is writing it. Accumulators are saved to md_analysis/insitu_{deffnm}.npz
+    when the simulation is finished, so md analysis only plots the results
+    :param wdir: directory of the complex
+    :param deffnm: name of mdrun output files
+    :param is_running: function returning False when the simulation is finished
+    :param deffnm_next: name of output files of the continued simulation (continue_md.sh) or None.
+                        The accumulators of the previous part are loaded (or recalculated from xtc)
+                        and updated by frames of {deffnm_next}.partNNNN.xtc
+    :param tpr: None or tpr file of the simulation
+    :param xtc: None or trajectory of the previous part of the continued simulation
+    :param ligand_list_file: None or file with molid resid pairs (all_ligand_resid.txt of the complex by default)
+    :param interval: time in seconds between reads of new frames
+    :return: state file or None if the analysis failed
+    '''
+    tpr = tpr or os.path.join(wdir, f'{deffnm}.tpr')
+    xtc = xtc or os.path.join(wdir, f'{deffnm}.xtc')
+    ligand_list_file = ligand_list_file or os.path.join(wdir, 'all_ligand_resid.txt')
+    state_file = get_insitu_state_file(wdir, deffnm, analysis_dirname)
+    os.makedirs(os.path.dirname(state_file), exist_ok=True)
+    try:
+        if deffnm_next is None:
+            frames = tail_xtc(xtc, is_running, interval=interval)
+            # tpr is created by grompp before mdrun starts writing the trajectory
+            first_frame = next(frames, None)
+            if first_frame is None:
+                return None
+        molid_resid_pairs = list(get_mol_resid_pair(ligand_list_file)) \
+            if os.path.isfile(ligand_list_file) and os.path.getsize(ligand_list_file) > 0 else []
+        analysis = StreamingAnalysis(tpr, molid_resid_pairs, ligand_resid=ligand_resid,
+                                     active_site_dist=active_site_dist)
+        if deffnm_next is None:
+            analysis.add_frame(*first_frame)
+        else:
+            if is_insitu_analysis_finished(wdir, deffnm, analysis_dirname, xtc=xtc):
+                analysis.load_state(state_file)
+            else:
+                logging.info(f'{wdir}: in-situ analysis of {xtc} is not found and will be calculated')
+                offset = 0
+                while True:
+                    chunk, offset = read_new_frames(xtc, offset, max_frames=1000)
+                    if not chunk:
+                        break
+                    for frame in chunk:
+                        analysis.add_frame(*frame)
+            frames = tail_part_xtc(wdir, deffnm_next, is_running, interval=interval)
+        for frame in frames:
+            analysis.add_frame(*frame)
+        analysis.save_state(state_file)
+    except Exception as e:
+        logging.warning(f'{wdir}: in-situ analysis failed, the trajectory will be analysed after the simulation: {e}')
+        if os.path.isfile(state_file):
+            os.remove(state_file)
+        return None
+    return state_file
+
+
+def write_insitu_analysis(wdir, deffnm, tpr, wdir_out_analysis, system_name, molid_resid_pairs,
+                          ligand_resid='UNL', active_site_dist=5.0, analysis_dirname='md_analysis'):
+    '''
+    Write RMSD, radius of gyration and RMSF files from accumulators of the in-situ analysis
+    :return: rmsd pandas DataFrame, name of the ligand
+    '''
+    analysis = StreamingAnalysis(tpr, molid_resid_pairs, ligand_resid=ligand_resid,
+                                 active_site_dist=active_site_dist)
+    analysis.load_state(get_insitu_state_file(wdir, deffnm, analysis_dirname))
+    return analysis.write_outputs(wdir_out_analysis, system_name), analysis.ligand_name
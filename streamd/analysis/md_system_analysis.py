@@ -1,12 +1,13 @@
 from glob import glob
+import logging
 import os
 import shutil
-import pandas as pd
-import numpy as np
-import MDAnalysis as mda
-from MDAnalysis.analysis import rms
-from streamd.analysis.xvg2png import convertxvg2png
+from streamd.analysis.xvg2png import convertxvg2png, plot_xvg_data
 from streamd.analysis.plot_build import plot_rmsd
+from streamd.analysis.trajectory_processing import postprocess_trajectory, read_ndx_groups
+from streamd.utils.coordinate_cache import is_coordinate_cache_valid, remove_coordinate_cache, write_coordinate_cache
+from streamd.utils.trajectory_index import get_index_file, load_universe
+from streamd.utils.replicas import split_replica_name
 from streamd.utils.utils import get_index, make_group_ndx, get_mol_resid_pair, run_check_subprocess, backup_prev_files
 
 
@@ -28,13 +29,28 @@ def rmsd_for_atomgroups(universe, selection1, selection2=None):
     rmsd_df: pandas.core.frame.DataFrame
         DataFrame containing RMSD of the selected atom groups over time.
     """
+    import numpy as np
+    import pandas as pd
+    from MDAnalysis.analysis import rms
 
     universe.trajectory[0]
     ref = universe
     rmsd_analysis = rms.RMSD(universe, ref, select=selection1, groupselections=selection2, in_memory=False)
     rmsd_analysis.run()
     columns = [selection1, *selection2] if selection2 else [selection1]
-    rmsd_df = pd.DataFrame(np.round(rmsd_analysis.results.rmsd[:, 2:], 2), columns=columns)
+    return get_rmsd_df(rmsd_analysis.results.rmsd[:, 2:], columns)
+
+
+def get_rmsd_df(rmsd, columns):
+    '''
+    :param rmsd: numpy array (n_frames x n_groups) of RMSD values
+    :param columns: selections of groups
+    :return: pandas DataFrame of rounded RMSD and time
+    '''
+    import numpy as np
+    import pandas as pd
+
+    rmsd_df = pd.DataFrame(np.round(rmsd, 2), columns=columns)
     rmsd_df.index.name = "frame"
     rmsd_df = rmsd_df.reset_index()
     # transform to ns
@@ -43,14 +59,232 @@ def rmsd_for_atomgroups(universe, selection1, selection2=None):
     return rmsd_df
 
 
-def md_rmsd_analysis(tpr, xtc, wdir_out_analysis, system_name,
-                     molid_resid_pairs,
-                     ligand_resid="UNL", active_site_dist=5.0):
-    #groupselections = ['protein']
-    rmsd_out_file = os.path.join(wdir_out_analysis, f'rmsd_{system_name}.csv')
-    universe = mda.Universe(tpr, xtc, in_memory=False, in_memory_step=1)
+def kabsch_batch(mobile, ref, weights=None):
+    '''
+    :param mobile: centered coordinates of frames (frames x atoms x 3)
+    :param ref: centered reference coordinates (atoms x 3)
+    :param weights: None or weights of atoms
+    :return: rotation matrices (frames x 3 x 3) superimposing frames on the reference: mobile @ rotation ~ ref
+    '''
+    import numpy as np
+
+    weighted_ref = ref if weights is None else ref * weights[:, None]
+    u, _, vt = np.linalg.svd(np.einsum('bni,nj->bij', mobile, weighted_ref))
+    u[:, :, 2] *= np.sign(np.linalg.det(u @ vt))[:, None]
+    return u @ vt
+
+
+def merge_welford(acc1, acc2):
+    '''
+    Merge Welford accumulators of two sets of frames (Chan et al. parallel algorithm)
+    :param acc1: (number of frames, mean, sum of squared deviations)
+    :param acc2: (number of frames, mean, sum of squared deviations)
+    :return: merged accumulator
+    '''
+    n1, mean1, m2_1 = acc1
+    n2, mean2, m2_2 = acc2
+    n = n1 + n2
+    if not n1 or not n2:
+        return acc1 if n1 else acc2
+    delta = mean2 - mean1
+    return n, mean1 + delta * n2 / n, m2_1 + m2_2 + delta ** 2 * n1 * n2 / n
+
+
+def calc_frames_metrics(tpr, xtc, selection1, selection2, ref, start, stop, batch_size=100, protein_ref=None):
+    '''
+    Metrics of frames from start to stop (not included) calculated by batches of frames from a single read.
+    RMSD is calculated as MDAnalysis RMSD: the selection1 group is superimposed on the reference
+    (without weights), groups of selection2 are moved by the same transformation without their own fitting
+    :param ref: centered coordinates of selection1, center of selection1 and coordinates of selection2 groups
+                in the reference frame
+    :param protein_ref: None or (protein selection, protein coordinates in the reference frame). If set,
+                        radius of gyration (mass weighted, total and around axes, as gmx gyrate) and
+                        Welford accumulators of protein positions after the mass weighted fit on the reference
+                        (as gmx rmsf) are calculated
+    :return: dict of rmsd (frames x (1 + number of selection2 groups)), time (ps) and
+             rg (frames x 4), welford (number of frames, mean, sum of squared deviations) if protein_ref is set
+    '''
+    import numpy as np
+
+    universe = load_universe(tpr, xtc)
+    mobile_atoms = universe.select_atoms(selection1)
+    groups = [universe.select_atoms(i) for i in selection2]
+    ref_coordinates, ref_com, groups_ref = ref
+    if protein_ref is not None:
+        protein = universe.select_atoms(protein_ref[0])
+        masses = protein.masses.astype(np.float64)
+        weights = masses / masses.sum()
+        protein_ref_centered = protein_ref[1] - np.average(protein_ref[1], axis=0, weights=masses)
+        welford = (0, np.zeros((len(protein), 3)), np.zeros((len(protein), 3)))
+
+    rmsd, rg, time = [], [], []
+    for batch_start in range(start, stop, batch_size):
+        mobile, groups_pos, protein_pos = [], [[] for _ in groups], []
+        for ts in universe.trajectory[batch_start:min(batch_start + batch_size, stop)]:
+            time.append(ts.time)
+            mobile.append(mobile_atoms.positions)
+            for pos, group in zip(groups_pos, groups):
+                pos.append(group.positions)
+            if protein_ref is not None:
+                protein_pos.append(protein.positions)
+        mobile = np.array(mobile, dtype=np.float64)
+        mobile_com = mobile.mean(axis=1, keepdims=True)
+        mobile -= mobile_com
+
+        # Kabsch superposition of all frames of the batch
+        rotation = kabsch_batch(mobile, ref_coordinates)
+        batch_rmsd = [np.sqrt(((mobile @ rotation - ref_coordinates) ** 2).sum(axis=(1, 2)) / mobile.shape[1])]
+        for pos, group_ref in zip(groups_pos, groups_ref):
+            pos = (np.array(pos, dtype=np.float64) - mobile_com) @ rotation + ref_com
+            batch_rmsd.append(np.sqrt(((pos - group_ref) ** 2).sum(axis=(1, 2)) / pos.shape[1]))
+        rmsd.append(np.stack(batch_rmsd, axis=1))
+
+        if protein_ref is not None:
+            protein_pos = np.array(protein_pos, dtype=np.float64)
+            protein_pos -= np.einsum('bni,n->bi', protein_pos, weights)[:, None, :]
+            # squared mass weighted deviations along x, y and z
+            sq = np.einsum('bni,n->bi', protein_pos ** 2, weights)
+            rg.append(np.sqrt(np.stack([sq.sum(axis=1), sq[:, 1] + sq[:, 2], sq[:, 0] + sq[:, 2],
+                                        sq[:, 0] + sq[:, 1]], axis=1)))
+            protein_pos = protein_pos @ kabsch_batch(protein_pos, protein_ref_centered, weights=weights)
+            batch_mean = protein_pos.mean(axis=0)
+            welford = merge_welford(welford, (len(protein_pos), batch_mean,
+                                              ((protein_pos - batch_mean) ** 2).sum(axis=0)))
+
+    res = dict(rmsd=np.vstack(rmsd) if rmsd else np.zeros((0, 1 + len(groups))), time=np.array(time))
+    if protein_ref is not None:
+        res.update(rg=np.vstack(rg) if rg else np.zeros((0, 4)), welford=welford)
+    return res
+
+
+def analyse_trajectory(tpr, xtc, selection1, selection2=None, protein_selection=None, ncpu=1, batch_size=100):
+    '''
+    Single read of the trajectory calculating RMSD of atom groups and, optionally, radius of gyration and RMSF
+    of the protein. The trajectory is split into chunks of frames processed in parallel and calculations
+    are vectorized over batches of frames
+    :param tpr:
+    :param xtc:
+    :param selection1: selection string for main atom group, also used during alignment
+    :param selection2: list of selection strings for additional atom groups
+    :param protein_selection: None or selection of the protein for radius of gyration and RMSF
+    :param ncpu: number of processes
+    :param batch_size: number of frames processed at once
+    :return: dict of rmsd_df (pandas DataFrame of RMSD as rmsd_for_atomgroups), time (ps) and, if protein_selection
+             is set, rg (frames x 4, A), msf (mean square fluctuations of protein atoms, A^2), protein (AtomGroup)
+             and protein_ref (protein coordinates in the first frame)
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    import numpy as np
+
+    selection2 = selection2 or []
+    universe = load_universe(tpr, xtc)
+    universe.trajectory[0]
+    ref_atoms = universe.select_atoms(selection1)
+    ref_com = ref_atoms.center(None)
+    ref = ((ref_atoms.positions - ref_com).astype(np.float64), ref_com.astype(np.float64),
+           [universe.select_atoms(i).positions.astype(np.float64) for i in selection2])
+    protein_ref = None
+    if protein_selection is not None:
+        protein = universe.select_atoms(protein_selection)
+        protein_ref = (protein_selection, protein.positions.astype(np.float64))
+    n_frames = len(universe.trajectory)
+
+    nchunks = max(1, min(ncpu, n_frames // batch_size))
+    bounds = [n_frames * i // nchunks for i in range(nchunks + 1)]
+    args = [(tpr, xtc, selection1, selection2, ref, start, stop, batch_size, protein_ref)
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+    chunks = None
+    if nchunks > 1:
+        try:
+            with ProcessPoolExecutor(max_workers=nchunks, mp_context=multiprocessing.get_context('fork')) as pool:
+                chunks = list(pool.map(calc_frames_metrics, *zip(*args)))
+        except AssertionError as e:
+            # daemonic processes cannot start child processes (e.g. dask workers started outside of init_dask_cluster)
+            logging.warning(f'{xtc}: cannot analyse the trajectory in parallel and it will be analysed '
+                            f'in a single process: {e}')
+    if chunks is None:
+        chunks = [calc_frames_metrics(tpr, xtc, selection1, selection2, ref, 0, n_frames, batch_size=batch_size,
+                                      protein_ref=protein_ref)]
+
+    res = dict(rmsd_df=get_rmsd_df(np.vstack([i['rmsd'] for i in chunks]), [selection1, *selection2]),
+               time=np.concatenate([i['time'] for i in chunks]))
+    if protein_selection is not None:
+        welford = chunks[0]['welford']
+        for chunk in chunks[1:]:
+            welford = merge_welford(welford, chunk['welford'])
+        n, _, m2 = welford
+        res.update(rg=np.vstack([i['rg'] for i in chunks]), msf=m2.sum(axis=1) / max(n, 1), protein=protein,
+                   protein_ref=protein_ref[1])
+    return res
+
+
+def rmsd_for_atomgroups_parallel(tpr, xtc, selection1, selection2=None, ncpu=1, batch_size=100):
+    '''
+    The same as rmsd_for_atomgroups, but the trajectory is split into chunks of frames processed in parallel
+    and the superposition and RMSD are vectorized over batches of frames
+    :return: pandas DataFrame containing RMSD of the selected atom groups over time
+    '''
+    return analyse_trajectory(tpr, xtc, selection1, selection2, ncpu=ncpu, batch_size=batch_size)['rmsd_df']
+
+
+def save_gyrate(time, rg, wdir_out_analysis, system_name):
+    '''
+    Save radius of gyration to gyrate_{system_name}.csv and png as the xvg output of gmx gyrate
+    :param time: time of frames in ps
+    :param rg: radius of gyration (total and around x, y and z axes) of frames in A
+    :return: csv file
+    '''
+    import numpy as np
+
+    csv_file = os.path.join(wdir_out_analysis, f'gyrate_{system_name}.csv')
+    coords = np.column_stack([np.round(time, 3), np.round(np.asarray(rg) / 10, 5)]).tolist()
+    plot_xvg_data(coords, title=f'Radius of gyration (total and around axes) {system_name} complex', subtitle='',
+                  xaxis='Time (ps)', yaxis='Rg (nm)', legend_list=['Rg', 'RgX', 'RgY', 'RgZ'],
+                  csv_file=csv_file, png_file=csv_file.replace('.csv', '.png'), transform_nm_to_A=True)
+    return csv_file
+
+
+def save_rmsf(protein, protein_ref, msf, wdir_out_analysis, system_name):
+    '''
+    Save RMSF of residues (mass weighted average of atoms) to rmsf_{system_name}.csv and png and B-factors of
+    protein atoms to rmsf_{system_name}.pdb as gmx rmsf -res -oq
+    :param protein: AtomGroup of the protein
+    :param protein_ref: coordinates of the protein written to pdb
+    :param msf: mean square fluctuations of protein atoms in A^2
+    :return: csv file
+    '''
+    import numpy as np
+
+    masses = protein.masses.astype(np.float64)
+    rmsf = np.sqrt(msf)
+    resindices = protein.resindices
+    coords = []
+    for residue in protein.residues:
+        mask = resindices == residue.resindex
+        coords.append([residue.resid, round(float(np.average(rmsf[mask], weights=masses[mask])) / 10, 4)])
+    csv_file = os.path.join(wdir_out_analysis, f'rmsf_{system_name}.csv')
+    plot_xvg_data(coords, title=f'RMS fluctuation {system_name} complex', subtitle='', xaxis='Residue',
+                  yaxis='(nm)', legend_list=[], csv_file=csv_file, png_file=csv_file.replace('.csv', '.png'),
+                  transform_nm_to_A=True)
+
+    protein.positions = protein_ref
+    if not hasattr(protein, 'tempfactors'):
+        protein.universe.add_TopologyAttr('tempfactors')
+    protein.tempfactors = np.round(8 * np.pi ** 2 / 3 * msf, 2)
+    protein.write(os.path.join(wdir_out_analysis, f'rmsf_{system_name}.pdb'))
+    return csv_file
+
+
+def get_rmsd_groupselections(molid_resid_pairs, ligand_resid="UNL", active_site_dist=5.0):
+    '''
+    :param molid_resid_pairs: dict {molid: resid} of ligands and cofactors of the system
+    :param ligand_resid:
+    :param active_site_dist:
+    :return: selections of atom groups for RMSD calculation after fitting on the backbone, name of the ligand or None
+    '''
     groupselections = []
-    molid_resid_pairs = dict(molid_resid_pairs)
     ligand_name = None
     if molid_resid_pairs:
         if ligand_resid in molid_resid_pairs.values():
@@ -61,10 +295,17 @@ def md_rmsd_analysis(tpr, xtc, wdir_out_analysis, system_name,
             groupselections.append(f'backbone and (around {active_site_dist} resname {ligand_resid})')
 
         groupselections.extend([f"resname {i} and not name H*" for i in molid_resid_pairs.values()])
+    return groupselections, ligand_name
+
 
-    rmsd_df = rmsd_for_atomgroups(universe, selection1="backbone",
-                                  selection2 = groupselections)
-    del universe
+def save_rmsd(rmsd_df, wdir_out_analysis, system_name, molid_resid_pairs, ligand_name,
+              ligand_resid="UNL", active_site_dist=5.0):
+    '''
+    Rename columns of RMSD selections, plot RMSD and save it to rmsd_{system_name}.csv
+    :param rmsd_df: pandas DataFrame returned by rmsd_for_atomgroups
+    :return: rmsd_out_file
+    '''
+    rmsd_out_file = os.path.join(wdir_out_analysis, f'rmsd_{system_name}.csv')
     rmsd_df = rmsd_df.rename(
         {f'backbone and (around {active_site_dist} resname {ligand_resid})': f'ActiveSite{active_site_dist}A',
          f'resname {ligand_resid} and not name H*': 'ligand'}, axis='columns')
@@ -74,18 +315,56 @@ def md_rmsd_analysis(tpr, xtc, wdir_out_analysis, system_name,
     plot_rmsd(rmsd_df=rmsd_df, system_name=system_name, out=os.path.join(wdir_out_analysis, f'rmsd_{system_name}.png'))
 
     rmsd_df.loc[:, 'ligand_name'] = ligand_name
-    rmsd_df.loc[:, 'system'] = system_name.replace(f'_{ligand_name}', '') if ligand_name else system_name
+    # replicas of a complex have the same system name and differ by the directory
+    system_name_base = split_replica_name(system_name)[0]
+    rmsd_df.loc[:, 'system'] = system_name_base.replace(f'_{ligand_name}', '') if ligand_name else system_name_base
     rmsd_df.loc[:, 'directory'] = wdir_out_analysis
 
     rmsd_df.to_csv(rmsd_out_file, sep='\t', index=False)
     return rmsd_out_file
 
 
+def md_rmsd_analysis(tpr, xtc, wdir_out_analysis, system_name,
+                     molid_resid_pairs,
+                     ligand_resid="UNL", active_site_dist=5.0, ncpu=1):
+    #groupselections = ['protein']
+    molid_resid_pairs = dict(molid_resid_pairs)
+    groupselections, ligand_name = get_rmsd_groupselections(molid_resid_pairs, ligand_resid=ligand_resid,
+                                                            active_site_dist=active_site_dist)
+
+    rmsd_df = rmsd_for_atomgroups_parallel(tpr, xtc, selection1="backbone",
+                                           selection2=groupselections, ncpu=ncpu)
+    return save_rmsd(rmsd_df, wdir_out_analysis=wdir_out_analysis, system_name=system_name,
+                     molid_resid_pairs=molid_resid_pairs, ligand_name=ligand_name,
+                     ligand_resid=ligand_resid, active_site_dist=active_site_dist)
+
+
+def md_trajectory_analysis(tpr, xtc, wdir_out_analysis, system_name, molid_resid_pairs,
+                           ligand_resid="UNL", active_site_dist=5.0, ncpu=1):
+    '''
+    RMSD, radius of gyration, RMSF and B-factors of the protein from a single read of the fitted trajectory
+    :return: rmsd_out_file
+    '''
+    molid_resid_pairs = dict(molid_resid_pairs)
+    groupselections, ligand_name = get_rmsd_groupselections(molid_resid_pairs, ligand_resid=ligand_resid,
+                                                            active_site_dist=active_site_dist)
+    res = analyse_trajectory(tpr, xtc, selection1="backbone", selection2=groupselections,
+                             protein_selection='protein', ncpu=ncpu)
+    save_gyrate(res['time'], res['rg'], wdir_out_analysis=wdir_out_analysis, system_name=system_name)
+    save_rmsf(res['protein'], res['protein_ref'], res['msf'], wdir_out_analysis=wdir_out_analysis,
+              system_name=system_name)
+    return save_rmsd(res['rmsd_df'], wdir_out_analysis=wdir_out_analysis, system_name=system_name,
+                     molid_resid_pairs=molid_resid_pairs, ligand_name=ligand_name,
+                     ligand_resid=ligand_resid, active_site_dist=active_site_dist)
+
+
 def run_md_analysis(var_md_dirs_deffnm, mdtime_ns, project_dir, bash_log,
                     active_site_dist=5.0, ligand_resid='UNL',
                     save_traj_without_water = False,
                     analysis_dirname = 'md_analysis',
-                    ligand_list_file_prev=None, env=None):
+                    ligand_list_file_prev=None, ncpu=1, coordinate_cache=False, env=None):
+    from streamd.analysis.insitu_analysis import is_insitu_analysis_finished, write_insitu_analysis
+
     wdir, deffnm = var_md_dirs_deffnm
 
     # create subdir for analysis files only
@@ -105,7 +384,7 @@ def run_md_analysis(var_md_dirs_deffnm, mdtime_ns, project_dir, bash_log,
         q
         INPUT
         '''
-        if not run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log), env=env):
+        if not run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log), env=env, stage='analysis'):
             return None
 
     index_list = get_index(os.path.join(wdir, 'index.ndx'), env=env)
@@ -130,29 +409,74 @@ def run_md_analysis(var_md_dirs_deffnm, mdtime_ns, project_dir, bash_log,
 
     system_name = os.path.split(wdir)[-1]
 
+    # RMSD, radius of gyration and RMSF were calculated during the simulation (see insitu_analysis)
+    insitu = is_insitu_analysis_finished(wdir, deffnm, analysis_dirname,
+                                         groupselections=get_rmsd_groupselections(
+                                             dict(molid_resid_pairs), ligand_resid=ligand_resid,
+                                             active_site_dist=active_site_dist)[0])
+
+    # md_fit.xtc, md_fit_nowater.xtc and md_short_forcheck.xtc are written by a single pass over the trajectory,
+    # the chain of trjconv calls of md_analysis.sh is used if it fails
+    try:
+        postprocess_trajectory(tpr=tpr, xtc=xtc, index_file=os.path.join(wdir, 'index.ndx'), index_group=index_group,
+                               outputs=[(os.path.join(wdir, 'md_fit.xtc'), None, None),
+                                        (os.path.join(wdir, 'md_fit_nowater.xtc'), 'non-Water', None),
+                                        (os.path.join(wdir, 'md_short_forcheck.xtc'), None, dtstep)],
+                               ncpu=ncpu)
+        single_pass = True
+    except Exception as e:
+        logging.warning(f'{wdir}: single-pass processing of the trajectory failed, trjconv will be used. Error: {e}')
+        single_pass = False
+
     cmd = f'wdir={wdir} index_group={index_group} dtstep={dtstep} deffnm={deffnm} tpr={tpr} xtc={xtc} wdir_out_analysis={wdir_out_analysis} system_name={system_name} ' \
-           f'bash {os.path.join(project_dir, "scripts/script_sh/md_analysis.sh")} >> {os.path.join(wdir, bash_log)} 2>&1'
+          f'{"single_pass=1 " if single_pass else ""}' \
+          f'bash {os.path.join(project_dir, "scripts/script_sh/md_analysis.sh")} >> {os.path.join(wdir, bash_log)} 2>&1'
 
-    if not run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log), env=env):
+    if not run_check_subprocess(cmd, key=wdir, log=os.path.join(wdir, bash_log), env=env, stage='analysis'):
         return None
 
+    if coordinate_cache:
+        try:
+            write_coordinate_cache(os.path.join(wdir, 'md_fit.xtc'),
+                                   atom_ids=dict(read_ndx_groups(os.path.join(wdir, 'index.ndx')))['non-Water'])
+        except Exception as e:
+            logging.warning(f'{wdir}: failed to write the coordinate cache of md_fit.xtc. Error: {e}')
+            remove_coordinate_cache(os.path.join(wdir, 'md_fit.xtc'))
+
     # molid resid pairs for all ligands in the MD system
     # calc rmsd
     # universe = mda.Universe(tpr, os.path.join(wdir, f'md_fit.xtc'))
 
-    rmsd_out_file = md_rmsd_analysis(
-        tpr=os.path.join(wdir, 'md_out_nowater.tpr'),
-        xtc=os.path.join(wdir, f'md_fit_nowater.xtc'),
-        # tpr=os.path.join(wdir, 'md_out.tpr'), xtc=os.path.join(wdir, f'md_fit.xtc'),
-                     wdir_out_analysis=wdir_out_analysis,
-                     system_name=system_name,
-                     ligand_resid=ligand_resid,
-                     molid_resid_pairs=molid_resid_pairs,
-                     active_site_dist=active_site_dist)
+    if insitu:
+        rmsd_df, ligand_name = write_insitu_analysis(wdir, deffnm, tpr=tpr, wdir_out_analysis=wdir_out_analysis,
+                                                     system_name=system_name,
+                                                     molid_resid_pairs=dict(molid_resid_pairs),
+                                                     ligand_resid=ligand_resid, active_site_dist=active_site_dist,
+                                                     analysis_dirname=analysis_dirname)
+        rmsd_out_file = save_rmsd(rmsd_df, wdir_out_analysis=wdir_out_analysis, system_name=system_name,
+                                  molid_resid_pairs=dict(molid_resid_pairs), ligand_name=ligand_name,
+                                  ligand_resid=ligand_resid, active_site_dist=active_site_dist)
+    else:
+        # non-water atoms of md_fit.xtc are read from the coordinate cache if it exists
+        cached = is_coordinate_cache_valid(os.path.join(wdir, 'md_fit.xtc'))
+        # RMSD, radius of gyration and RMSF are calculated by a single read of the trajectory
+        rmsd_out_file = md_trajectory_analysis(
+            tpr=tpr if cached else os.path.join(wdir, 'md_out_nowater.tpr'),
+            xtc=os.path.join(wdir, 'md_fit.xtc' if cached else 'md_fit_nowater.xtc'),
+            # tpr=os.path.join(wdir, 'md_out.tpr'), xtc=os.path.join(wdir, f'md_fit.xtc'),
+                         wdir_out_analysis=wdir_out_analysis,
+                         system_name=system_name,
+                         ligand_resid=ligand_resid,
+                         molid_resid_pairs=molid_resid_pairs,
+                         active_site_dist=active_site_dist,
+                         ncpu=ncpu)
     if not save_traj_without_water:
         os.remove(os.path.join(wdir, 'md_out_nowater.tpr'))
         os.remove(os.path.join(wdir, f'md_fit_nowater.xtc'))
+        if os.path.isfile(get_index_file(os.path.join(wdir, f'md_fit_nowater.xtc'))):
+            os.remove(get_index_file(os.path.join(wdir, f'md_fit_nowater.xtc')))
 
+    # xvg files of gmx energy of the equilibration, radius of gyration and RMSF are saved to csv directly
     for xvg_file in glob(os.path.join(wdir_out_analysis, '*.xvg')):
         convertxvg2png(xvg_file, system_name=system_name, transform_nm_to_A=True)
     return rmsd_out_file, wdir_out_analysis, wdir
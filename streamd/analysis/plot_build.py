@@ -1,20 +1,29 @@
-import matplotlib.pyplot as plt
-import pandas as pd
-import seaborn as sns
-from matplotlib import rcParams
-import plotly.offline
-import plotly.express as px
+# plotting libraries are imported inside functions to keep the start up of the command line tools fast
+from functools import lru_cache
 
-# figure size in inches
-#rcParams['figure.figsize'] = 15,10
 
-#sns.set_theme(rc={'figure.figsize':(11.7,8.27)})
-sns.set_context("paper", rc={"font.size":15,"axes.titlesize":15,"axes.labelsize":15},
-                font_scale=1.5)
+@lru_cache(maxsize=None)
+def setup_plot_style():
+    '''
+    Set the style of matplotlib plots once per process, the first plot pays the cost of the seaborn import
+    '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+
+    # figure size in inches
+    #rcParams['figure.figsize'] = 15,10
+
+    #sns.set_theme(rc={'figure.figsize':(11.7,8.27)})
+    sns.set_context("paper", rc={"font.size":15,"axes.titlesize":15,"axes.labelsize":15},
+                    font_scale=1.5)
+    plt.ioff()
 
-plt.ioff()
 
 def plot_rmsd(rmsd_df, system_name, out):
+    import matplotlib.pyplot as plt
+
+    setup_plot_style()
+
     plot = rmsd_df.set_index('time(ns)').plot(title=f"RMSD of {system_name}")
     plt.ylabel("RMSD (Å)")
     plt.xlabel("Time (ns)")
@@ -38,6 +47,9 @@ def plot_rmsd_mean_std(data, paint_by_col, show_legend, out_name, title=None):
     #              xycoords=plt.gca().get_yaxis_transform(), ha="right")
     # g.tight_layout()
     # g.savefig(out+'.png', dpi=350)
+    import plotly.offline
+    import plotly.express as px
+
     hover_data = {'system': True, 'time_range': False, 'rmsd_system': False}
     if 'ligand_name' in data:
         hover_data['ligand_name'] = True
@@ -2,13 +2,15 @@ import argparse
 from datetime import datetime
 from functools import partial
 import os
-import pandas as pd
 import logging
 
 from streamd.analysis.plot_build import plot_rmsd_mean_std
+from streamd.utils.replicas import has_replicas, summarize_replicas
 from streamd.utils.utils import filepath_type
 
 def merge_rmsd_csv(csv_files, out):
+    import pandas as pd
+
     all_data_list = []
     csv_files.sort()
     for i in csv_files:
@@ -21,6 +23,8 @@ def merge_rmsd_csv(csv_files, out):
 
 
 def calc_mean_std_by_ranges_time(rmsd_data, time_ranges, rmsd_system='backbone', system_cols=['ligand_name','system']):
+    import pandas as pd
+
     res_list = []
     for start, end in time_ranges:
         key = f'{start}-{end}ns'
@@ -45,6 +49,8 @@ def make_lower_case(df, cols):
 def run_rmsd_analysis(rmsd_files, wdir, unique_id, time_ranges=None,
                       rmsd_type_list=['backbone', 'ligand'], paint_by_fname=None,
                       title=None):
+    import pandas as pd
+
     if len(rmsd_files) > 1:
         rmsd_merged_data = merge_rmsd_csv(rmsd_files, os.path.join(wdir, f'rmsd_all_systems_{unique_id}.csv'))
     else:
@@ -78,6 +84,16 @@ def run_rmsd_analysis(rmsd_files, wdir, unique_id, time_ranges=None,
 
     df_mean_std = pd.concat(mean_std_list)
     df_mean_std.to_csv(os.path.join(wdir, f'rmsd_mean_std_time-ranges_{unique_id}.csv'), index=False, sep='\t')
+
+    # mean and SD of RMSD between replicas of each complex
+    if 'directory' in system_cols:
+        complex_dirs = df_mean_std['directory'].map(lambda x: os.path.basename(os.path.dirname(x.rstrip(os.sep))))
+        if has_replicas(complex_dirs.unique()):
+            df_replicas = summarize_replicas(df_mean_std.assign(complex_dir=complex_dirs), name_col='complex_dir',
+                                             value_cols=['RMSD_mean', 'RMSD_std'],
+                                             group_cols=[i for i in system_cols if i not in ('system', 'directory')] +
+                                                        ['rmsd_system', 'time_range'])
+            df_replicas.to_csv(os.path.join(wdir, f'rmsd_mean_std_replicas_{unique_id}.csv'), index=False, sep='\t')
     if paint_by_fname:
         paint_by_data = pd.read_csv(paint_by_fname, sep='\t')
         if not all([i in paint_by_data.columns for i in system_cols]):
@@ -0,0 +1,274 @@
+import logging
+import os
+import re
+
+from streamd.utils.trajectory_index import get_trajectory_index
+from streamd.utils.xtc_tail import minimum_image, fit_transform
+
+
+def read_ndx_groups(index_file):
+    '''
+    :param index_file: GROMACS index file
+    :return: list of (group name, numpy array of 0-based atom indices) in the order of the file
+    '''
+    import numpy as np
+
+    with open(index_file) as inp:
+        data = inp.read()
+    groups = []
+    for name, atoms in re.findall(r'\[\s*(.*?)\s*\]([^\[]*)', data):
+        groups.append((name, np.array(atoms.split(), dtype=np.int64) - 1))
+    return groups
+
+
+def init_processing(tpr, center_ids):
+    '''
+    :param tpr:
+    :param center_ids: indices of atoms of the group used for centering and fitting (e.g. Protein_UNL)
+    :return: dict of the topology data used to process frames
+    '''
+    import MDAnalysis as mda
+    import numpy as np
+
+    universe = mda.Universe(tpr)
+    masses = universe.atoms.masses.astype(np.float64)
+    fragindices = universe.atoms.fragindices
+    # reference structure of the fit is the structure of tpr file, as trjconv -fit rot+trans -s tpr
+    return dict(universe=universe, masses=masses, fragindices=fragindices,
+                fragment_masses=np.bincount(fragindices, weights=masses),
+                center_ids=center_ids, ref=universe.atoms.positions[center_ids].astype(np.float64))
+
+
+def make_molecules_whole(topology, coords, box):
+    '''
+    Make molecules whole in the first frame using bonds of the topology
+    :return: coordinates (A)
+    '''
+    import numpy as np
+    from MDAnalysis.lib.mdamath import triclinic_box
+
+    universe = topology['universe']
+    universe.atoms.positions = coords
+    universe.dimensions = triclinic_box(*box)
+    universe.atoms.unwrap(compound='fragments')
+    return universe.atoms.positions.astype(np.float64)
+
+
+def remove_jumps(coords, prev, box):
+    '''
+    trjconv -pbc nojump: each atom is placed into the nearest image of its position in the previous frame
+    '''
+    return prev + minimum_image(coords - prev, box)
+
+
+def center_molecules(topology, x, box):
+    '''
+    trjconv -pbc mol -center: the center of the group is placed into the center of the box and the center of mass
+    of each molecule is put into the rectangular unit cell
+    '''
+    import numpy as np
+
+    x = x + box.sum(axis=0) / 2 - x[topology['center_ids']].mean(axis=0)
+    masses, fragindices = topology['masses'], topology['fragindices']
+    com = np.stack([np.bincount(fragindices, weights=masses * x[:, dim]) for dim in range(3)], axis=1) / \
+        topology['fragment_masses'][:, None]
+    shifts = np.zeros_like(com)
+    for dim in (2, 1, 0):
+        if box[dim][dim] > 0:
+            n = np.floor((com[:, dim] + shifts[:, dim]) / box[dim][dim])
+            shifts -= np.outer(n, box[dim])
+    return x + shifts[fragindices]
+
+
+def fit_frame(topology, x):
+    '''
+    trjconv -fit rot+trans: mass weighted fit of the group to the reference structure
+    '''
+    center_ids = topology['center_ids']
+    rotation, mobile_center, ref_center = fit_transform(x[center_ids], topology['ref'],
+                                                        weights=topology['masses'][center_ids])
+    return (x - mobile_center) @ rotation.T + ref_center
+
+
+def process_frames(topology, frames, prev=None):
+    '''
+    Generator of processed frames: periodic jumps are removed, the group is centered and molecules are put
+    into the box, then the group is fitted to the reference structure
+    :param topology: dict returned by init_processing
+    :param frames: iterable of XTC frames (x, box, step, time, prec in nm)
+    :param prev: None or coordinates (A) of the previous frame with removed jumps. If None molecules of the first
+                 frame are made whole
+    :return: (frame, fitted coordinates in A, coordinates with removed jumps in A)
+    '''
+    import numpy as np
+
+    for frame in frames:
+        coords, box = frame.x.astype(np.float64) * 10, frame.box.astype(np.float64) * 10
+        x = make_molecules_whole(topology, coords, box) if prev is None else remove_jumps(coords, prev, box)
+        prev = x
+        yield frame, fit_frame(topology, center_molecules(topology, x, box)), x
+
+
+def read_block(xtc, offset, n_frames):
+    '''
+    Generator of n_frames frames of xtc file starting from the byte offset
+    '''
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    with XTCFile(xtc) as inp:
+        inp._bytes_seek(offset)
+        for _ in range(n_frames):
+            yield inp.read()
+
+
+def write_frames(topology, frames, outputs, group_ids, t0, prev=None):
+    '''
+    Process frames and write them to outputs
+    :param outputs: list of (xtc file, group name in index file or None for the whole system, dt in ps or None)
+    :param group_ids: dict {group name: atom indices}
+    :param t0: time of the first frame of the trajectory used to select frames by dt
+    :param prev: see process_frames
+    '''
+    import numpy as np
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    writers = [(XTCFile(fname, 'w'), group_ids[group] if group else None, dt) for fname, group, dt in outputs]
+    try:
+        for frame, x, _ in process_frames(topology, frames, prev=prev):
+            x = (x / 10).astype(np.float32)
+            for writer, ids, dt in writers:
+                # trjconv -dt writes frames with (t - t0) MOD dt = 0
+                if dt and not np.isclose(np.fmod(frame.time - t0 + dt / 2, dt), dt / 2, atol=1e-3):
+                    continue
+                writer.write(x if ids is None else x[ids], frame.box, frame.step, frame.time, frame.prec)
+    finally:
+        for writer, _, _ in writers:
+            writer.close()
+
+
+def get_image_counts(x, coords, box):
+    '''
+    :return: integer numbers of box vectors for each atom: x = coords + counts @ box
+    '''
+    import numpy as np
+
+    return np.rint((x - coords) @ np.linalg.inv(box)).astype(np.int32)
+
+
+def get_block_jumps(xtc, offset, n_frames):
+    '''
+    Remove periodic jumps within a block of frames starting from the unmodified first frame
+    :return: (first frame coordinates, first frame box, image counts of the last frame relative to the first frame,
+              last frame coordinates, last frame box, True if the box changes within the block) in A
+    '''
+    import numpy as np
+
+    first, prev = None, None
+    box_changed = False
+    for frame in read_block(xtc, offset, n_frames):
+        coords, box = frame.x.astype(np.float64) * 10, frame.box.astype(np.float64) * 10
+        if first is None:
+            first = (coords, box)
+            prev = coords
+        else:
+            prev = remove_jumps(coords, prev, box)
+            box_changed = box_changed or not np.allclose(box, first[1], rtol=0, atol=1e-4)
+    return first[0], first[1], get_image_counts(prev, coords, box), coords, box, box_changed
+
+
+def process_block(tpr, index_file, index_group, xtc, offset, n_frames, outputs, t0, prev):
+    groups = read_ndx_groups(index_file)
+    topology = init_processing(tpr, center_ids=groups[index_group][1])
+    write_frames(topology, read_block(xtc, offset, n_frames), outputs, dict(groups), t0=t0, prev=prev)
+    return [i[0] for i in outputs]
+
+
+def postprocess_trajectory_blocks(tpr, xtc, index_file, index_group, outputs, ncpu):
+    '''
+    Process time blocks of the trajectory in parallel and concatenate results in order.
+    Jumps are removed within each block in parallel first, then the positions of the last frames of blocks
+    (the starting points of the next blocks) are connected sequentially, so the result is the same as for
+    a single pass. Images of a block are shifted by box vectors of the block, this is exact only for a constant
+    box, so trajectories with a changing box (NPT) are not processed by blocks
+    :return: list of output files or None if the box of the trajectory is not constant
+    '''
+    import multiprocessing
+    import shutil
+    from concurrent.futures import ProcessPoolExecutor
+
+    import numpy as np
+
+    index = get_trajectory_index(xtc)
+    offsets, t0 = index['offsets'], index['t0']
+    nblocks = min(ncpu, len(offsets))
+    bounds = [len(offsets) * i // nblocks for i in range(nblocks + 1)]
+    blocks = [(offsets[bounds[i]], bounds[i + 1] - bounds[i]) for i in range(nblocks)]
+
+    with ProcessPoolExecutor(max_workers=nblocks, mp_context=multiprocessing.get_context('fork')) as pool:
+        block_jumps = list(pool.map(get_block_jumps, [xtc] * nblocks, *zip(*blocks)))
+        if any(i[5] or not np.allclose(i[1], block_jumps[0][1], rtol=0, atol=1e-4) for i in block_jumps):
+            logging.info(f'{xtc}: the box is not constant, the trajectory will be processed in a single pass')
+            return None
+
+        # starting points of blocks: the first block starts from the frame with whole molecules
+        groups = read_ndx_groups(index_file)
+        topology = init_processing(tpr, center_ids=groups[index_group][1])
+        prevs = [None]
+        first, first_box, counts, last, last_box, _ = block_jumps[0]
+        x_first = make_molecules_whole(topology, first, first_box)
+        for i in range(1, nblocks):
+            x_last = last + (get_image_counts(x_first, first, first_box) + counts) @ last_box
+            prevs.append(x_last)
+            first, first_box, counts, last, last_box, _ = block_jumps[i]
+            x_first = remove_jumps(first, x_last, first_box)
+
+        block_outputs = [[(f'{fname}.block{i}', group, dt) for fname, group, dt in outputs] for i in range(nblocks)]
+        futures = [pool.submit(process_block, tpr, index_file, index_group, xtc, offset, n_frames,
+                               block_outputs[i], t0, prevs[i]) for i, (offset, n_frames) in enumerate(blocks)]
+        for future in futures:
+            future.result()
+
+    # xtc frames are independent, so the files of blocks are concatenated
+    for n, (fname, _, _) in enumerate(outputs):
+        with open(fname, 'wb') as out:
+            for i in range(nblocks):
+                with open(block_outputs[i][n][0], 'rb') as inp:
+                    shutil.copyfileobj(inp, out)
+                os.remove(block_outputs[i][n][0])
+    logging.info(f'{xtc} was processed by {nblocks} blocks: {", ".join(os.path.basename(i[0]) for i in outputs)}')
+    return [i[0] for i in outputs]
+
+
+def postprocess_trajectory(tpr, xtc, index_file, index_group, outputs, ncpu=1):
+    '''
+    Single-pass replacement of the chain of trjconv calls of md_analysis.sh (nojump, -pbc mol -center,
+    -fit rot+trans, -dt): the trajectory is read once and processed frames are written to several outputs
+    :param tpr:
+    :param xtc:
+    :param index_file:
+    :param index_group: number of the group in index file used for centering and fitting
+    :param outputs: list of (xtc file, group name in index file or None for the whole system, dt in ps or None)
+    :param ncpu: if > 1 time blocks of the trajectory with a constant box are processed in parallel
+    :return: list of output files
+    '''
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    if ncpu > 1:
+        try:
+            res = postprocess_trajectory_blocks(tpr, xtc, index_file, index_group, outputs, ncpu)
+            if res is not None:
+                return res
+        except Exception as e:
+            # e.g. daemonic processes cannot start child processes (dask workers started outside
+            # of init_dask_cluster), a worker process was killed or the trajectory index is broken
+            logging.warning(f'{xtc}: cannot process the trajectory in parallel and it will be processed '
+                            f'in a single process: {e!r}')
+
+    groups = read_ndx_groups(index_file)
+    topology = init_processing(tpr, center_ids=groups[index_group][1])
+    with XTCFile(xtc) as inp:
+        t0 = inp.read().time
+        # iteration over XTCFile starts from the first frame
+        write_frames(topology, inp, outputs, dict(groups), t0=t0)
+    logging.info(f'{xtc} was processed: {", ".join(os.path.basename(i[0]) for i in outputs)}')
+    return [i[0] for i in outputs]
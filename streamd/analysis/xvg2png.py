@@ -1,7 +1,6 @@
 import argparse
 import os
-import matplotlib.pyplot as plt
-import pandas as pd
+from functools import lru_cache
 
 from streamd.utils.utils import backup_prev_files
 
@@ -13,14 +12,6 @@ def convertxvg2png(xvg_file, system_name=None, transform_nm_to_A=False):
         else:
             return ''
 
-    csv_file = xvg_file.replace('.xvg', '.csv')
-    png_file = xvg_file.replace('.xvg', '.png')
-
-    if os.path.isfile(csv_file):
-        backup_prev_files(file_to_backup=csv_file)
-    if os.path.isfile(png_file):
-        backup_prev_files(file_to_backup=png_file)
-
     with open(xvg_file) as inp:
         data = inp.readlines()
 
@@ -40,9 +31,45 @@ def convertxvg2png(xvg_file, system_name=None, transform_nm_to_A=False):
     xaxis = xaxis[0].strip().replace('@    xaxis  label ', '').replace('"', '') if xaxis else 'OX'
     yaxis = yaxis[0].strip().replace('@    yaxis  label ', '').replace('"', '') if yaxis else 'OY'
 
-    plot1 = None
+    plot_xvg_data(coords, title=title, subtitle=subtitle, xaxis=xaxis, yaxis=yaxis, legend_list=legend_list,
+                  csv_file=xvg_file.replace('.xvg', '.csv'), png_file=xvg_file.replace('.xvg', '.png'),
+                  transform_nm_to_A=transform_nm_to_A)
+
+
+@lru_cache(maxsize=None)
+def setup_plot_style():
+    '''
+    Set the style of matplotlib plots once per process
+    '''
+    import matplotlib.pyplot as plt
+
     plt.ioff()
     plt.rcParams.update({'font.size': 15})
+
+
+def plot_xvg_data(coords, title, subtitle, xaxis, yaxis, legend_list, csv_file, png_file, transform_nm_to_A=False):
+    '''
+    Save data of xvg format to csv file and plot it
+    :param coords: list of rows: x value and one or several y values
+    :param title:
+    :param subtitle:
+    :param xaxis: label of x axis
+    :param yaxis: label of y axis
+    :param legend_list: names of y columns if there are several y values
+    :param csv_file:
+    :param png_file:
+    :param transform_nm_to_A: y values in nm are plotted in A
+    '''
+    import matplotlib.pyplot as plt
+    import pandas as pd
+
+    if os.path.isfile(csv_file):
+        backup_prev_files(file_to_backup=csv_file)
+    if os.path.isfile(png_file):
+        backup_prev_files(file_to_backup=png_file)
+
+    plot1 = None
+    setup_plot_style()
     plt.figure(figsize=(15, 12))
     plt.title(title)
     plt.xlabel(xaxis)
@@ -78,6 +105,7 @@ def convertxvg2png(xvg_file, system_name=None, transform_nm_to_A=False):
     plt.clf()
     plt.close('all')
 
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='''Draw png plot for xvg outputs of md analysis''')
     parser.add_argument('-i', '--input', metavar='FILENAME', required=True,
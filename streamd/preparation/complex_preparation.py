@@ -90,7 +90,8 @@ def run_complex_preparation(wdir_var_ligand,  wdir_system_ligand_list,
     if not os.path.isfile(os.path.join(wdir_md_cur, 'solv_ions.gro')):
         cmd = (f'wdir={wdir_md_cur} bash {os.path.join(project_dir, "scripts/script_sh/solv_ions.sh")} '
                f'>> {os.path.join(wdir_md_cur, bash_log)} 2>&1')
-        if not run_check_subprocess(cmd=cmd, key=wdir_md_cur, log=os.path.join(wdir_md_cur, bash_log), env=env):
+        if not run_check_subprocess(cmd=cmd, key=wdir_md_cur, log=os.path.join(wdir_md_cur, bash_log), env=env,
+                                    stage='complex'):
             return None
     else:
         logging.warning(f'{wdir_md_cur}. Prepared solv_ions.gro file exists. Skip solvation and ion preparation step')
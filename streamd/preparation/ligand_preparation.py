@@ -3,20 +3,41 @@ import logging
 import os
 from glob import glob
 import re
+from functools import partial
 
-import parmed as pmd
+from streamd.utils.cost_model import sort_by_cost, estimate_ligand_cost
+from streamd.utils.dask_init import calc_dask, get_worker_resources, parse_memory
+from streamd.utils.state_db import split_finished_tasks, get_task_callback, get_input_signature
+from streamd.utils.utils import run_check_subprocess
+
+def set_mol_pickle_properties():
+    '''
+    Keep all properties of RDKit molecules (e.g. names of ligands) when they are passed to workers
+    '''
+    from rdkit import Chem
 
-from rdkit import Chem
-from rdkit.Chem import rdmolops
+    Chem.SetDefaultPickleProperties(Chem.PropertyPickleOptions.AllProps)
+
+
+def get_ligand_signature(mol_tuple, **params):
+    '''
+    :param mol_tuple: (mol, molid, resid)
+    :param params: parameters of the preparation
+    :return: signature of the molecule and parameters of its preparation (see state_db.get_task_signature)
+    '''
+    from rdkit import Chem
+
+    mol, molid, resid = mol_tuple
+    return get_input_signature(mol=Chem.MolToMolBlock(mol), resid=resid, **params)
 
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
-from streamd.utils.utils import run_check_subprocess
 
 def reorder_hydrogens(mol):
     """
     Reorders the atoms in the molecule so that all hydrogens bonded to a heavy atom
     are listed immediately after that heavy atom.
     """
+    from rdkit.Chem import rdmolops
+
     new_order = []
     for atom in mol.GetAtoms():
         if atom.GetAtomicNum() != 1:  # Not a hydrogen
@@ -28,6 +49,9 @@ def reorder_hydrogens(mol):
     return mol
 
 def supply_mols_tuple(fname, preset_resid=None, protein_resid_set=None):
+    import parmed as pmd
+    from rdkit import Chem
+
     def generate_resid(protein_resid_list):
         ascii_uppercase_digits = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ'
         for i in itertools.product(ascii_uppercase_digits, repeat=3):
@@ -76,6 +100,9 @@ def check_mols(fname):
     :param fname:
     :return: number of mols, list of problem_mols
     '''
+    import parmed as pmd
+    from rdkit import Chem
+
     def check_if_problem(mol, n):
         molid = mol.GetProp('_Name') if mol.HasProp('_Name') else n
         try:
@@ -159,6 +186,10 @@ def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, no_dr,
                 conda_env_path, bash_log, gaussian_exe=None,
                 activate_gaussian=None, gaussian_basis='B3LYP/6-31G*', gaussian_memory='60GB', ncpu=1,
                 mol2_file=None, env=None):
+    import parmed as pmd
+    from rdkit import Chem
+    from rdkit.Chem import rdmolops
+
     mol, molid, resid = mol_tuple
 
     wdir_ligand_cur = os.path.join(wdir_ligand, molid)
@@ -202,7 +233,8 @@ def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, no_dr,
                           f'activate_gaussian="{activate_gaussian if activate_gaussian else ""}" ' \
                           f'bash {os.path.join(project_dir, "scripts/script_sh/ligand_mol2prep_by_gaussian.sh")} ' \
                           f' >> {os.path.join(wdir_ligand_cur, bash_log)} 2>&1'
-                    if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env):
+                    if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env,
+                                                stage='ligand'):
                         return None
                 else:
                     return None
@@ -211,7 +243,7 @@ def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, no_dr,
                       f'resid={resid} molid={molid} charge={charge} dr=yes bash {os.path.join(project_dir, "scripts/script_sh/ligand_mol2prep.sh")} ' \
                       f' >> {os.path.join(wdir_ligand_cur, bash_log)} 2>&1',
                 if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env,
-                                            ignore_error=True if no_dr else False):
+                                            ignore_error=True if no_dr else False, stage='ligand'):
                     if not no_dr:
                         return None
                     else:
@@ -220,7 +252,8 @@ def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, no_dr,
                         cmd = f'script_path={script_path} lfile={mol_file} input_dirname={wdir_ligand_cur} ' \
                           f'resid={resid} molid={molid} charge={charge} dr=no bash {os.path.join(project_dir, "scripts/script_sh/ligand_mol2prep.sh")} ' \
                           f' >> {os.path.join(wdir_ligand_cur, bash_log)} 2>&1',
-                        if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env):
+                        if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env,
+                                                    stage='ligand'):
                             return None
     else:
         mol2 = pmd.load_file(mol2_file).to_structure()
@@ -233,7 +266,8 @@ def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, no_dr,
     cmd = f'script_path={script_path} input_dirname={wdir_ligand_cur} ' \
           f'molid={molid} bash {os.path.join(project_dir, "scripts/script_sh/ligand_prep.sh")} ' \
           f' >> {os.path.join(wdir_ligand_cur, bash_log)} 2>&1'
-    if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env):
+    if not run_check_subprocess(cmd, molid, log=os.path.join(wdir_ligand_cur, bash_log), env=env,
+                                stage='ligand'):
         return None
 
     # create log for molid resid corresponding
@@ -242,9 +276,104 @@ def prep_ligand(mol_tuple, script_path, project_dir, wdir_ligand, no_dr,
     return wdir_ligand_cur
 
 
+def split_mols_by_preparation_type(ligand_fname, preset_resid, protein_resid_set):
+    '''
+    Split input molecules to the ones prepared by the standard antechamber procedure and boron-containing ones
+    which require Gaussian
+    :param ligand_fname: sdf or mol file
+    :param preset_resid:
+    :param protein_resid_set:
+    :return: list of standard mol tuples, list of boron-containing mol tuples
+    '''
+    from rdkit import Chem
+
+    standard_mols, boron_containing_mols = [], []
+    for mol_tuple in supply_mols_tuple(ligand_fname, preset_resid=preset_resid, protein_resid_set=protein_resid_set):
+        mol = mol_tuple[0]
+        if mol.HasSubstructMatch(Chem.MolFromSmarts("[#5]")):
+            boron_containing_mols.append(mol_tuple)
+        else:
+            standard_mols.append(mol_tuple)
+    return standard_mols, boron_containing_mols
+
+
+def prepare_boron_containing_mols(boron_containing_mols, ligand_fname, script_path, project_dir, wdir_ligand,
+                                  gaussian_exe, activate_gaussian, gaussian_basis, gaussian_memory,
+                                  dask_client, ncpu, bash_log, state_db=None, state_stage='ligand'):
+    '''
+    Gaussian calculations occupy all cores and memory of a dask worker
+    :param dask_client:
+    :param ncpu: number of cpu per worker
+    :param state_db: None or file of the state database. Already prepared molecules are skipped
+    :param state_stage: name of the stage in the state database
+    :return: list of prepared ligand dirs
+    '''
+    lig_wdirs = []
+    if not boron_containing_mols:
+        return lig_wdirs
+
+    if not gaussian_exe:
+        logging.warning(
+            f'There are molecules from {ligand_fname} which have Boron atom and to prepare such molecules you need to set up Gaussian.'
+            f' Please restart the run again and use --gaussian_exe arguments')
+        return lig_wdirs
+
+    signature = partial(get_ligand_signature, gaussian_basis=gaussian_basis)
+    lig_wdirs, boron_containing_mols = split_finished_tasks(state_db, state_stage, boron_containing_mols, signature)
+    set_mol_pickle_properties()
+    for res in calc_dask(prep_ligand, sort_by_cost(boron_containing_mols, estimate_ligand_cost), dask_client,
+                         resources=get_gaussian_resources(dask_client, ncpu=ncpu, gaussian_memory=gaussian_memory),
+                         task_callback=get_task_callback(state_db, state_stage, signature),
+                         script_path=script_path, project_dir=project_dir,
+                         wdir_ligand=wdir_ligand, conda_env_path=os.environ["CONDA_PREFIX"],
+                         gaussian_exe=gaussian_exe, activate_gaussian=activate_gaussian,
+                         gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
+                         ncpu=ncpu, bash_log=bash_log,
+                         env=os.environ.copy()):
+        if res:
+            lig_wdirs.append(res)
+    return lig_wdirs
+
+
+def get_gaussian_resources(dask_client, ncpu, gaussian_memory):
+    '''
+    :param dask_client:
+    :param ncpu: number of cpu per worker
+    :param gaussian_memory: str, e.g. 120GB
+    :return: dict of worker resources required by a single Gaussian (or MCPBPY) task
+    '''
+    resources = {'CPU': ncpu}
+    worker_memory = get_worker_resources(dask_client).get('MEMORY')
+    memory = parse_memory(gaussian_memory)
+    if worker_memory and memory:
+        resources['MEMORY'] = min(memory, worker_memory)
+    return resources
+
+
+def prepare_standard_mols(standard_mols, script_path, project_dir, wdir_ligand, no_dr, dask_client, ncpu, bash_log,
+                          state_db=None, state_stage='ligand'):
+    lig_wdirs = []
+    if not standard_mols:
+        return lig_wdirs
+
+    signature = partial(get_ligand_signature, no_dr=no_dr)
+    lig_wdirs, standard_mols = split_finished_tasks(state_db, state_stage, standard_mols, signature)
+    set_mol_pickle_properties()
+    for res in calc_dask(prep_ligand, sort_by_cost(standard_mols, estimate_ligand_cost), dask_client,
+                         resources={'CPU': 1}, task_callback=get_task_callback(state_db, state_stage, signature),
+                         script_path=script_path, project_dir=project_dir,
+                         wdir_ligand=wdir_ligand, no_dr=no_dr,
+                         conda_env_path=os.environ["CONDA_PREFIX"],
+                         ncpu=ncpu, bash_log=bash_log,
+                         env=os.environ.copy()):
+        if res:
+            lig_wdirs.append(res)
+    return lig_wdirs
+
+
 def prepare_input_ligands(ligand_fname, preset_resid, protein_resid_set, script_path, project_dir, wdir_ligand,
                           no_dr, gaussian_exe, activate_gaussian, gaussian_basis, gaussian_memory,
-                          hostfile, ncpu, bash_log):
+                          dask_client, ncpu, bash_log, state_db=None, state_stage='ligand'):
     '''
 
     :param ligand_fname:
@@ -255,9 +384,11 @@ def prepare_input_ligands(ligand_fname, preset_resid, protein_resid_set, script_
     :param no_dr:
     :param gaussian_exe: str or None
     :param activate_gaussian: str or None
-    :param hostfile:
-    :param ncpu:
+    :param dask_client: dask client shared by all steps of the run
+    :param ncpu: number of cpu per worker
     :param bash_log:
+    :param state_db: None or file of the state database. Already prepared molecules are skipped
+    :param state_stage: name of the stage in the state database
     :return:
     '''
     lig_wdirs = []
@@ -274,60 +405,19 @@ def prepare_input_ligands(ligand_fname, preset_resid, protein_resid_set, script_
             lig_wdirs.append(res)
 
     else:
-        standard_mols, boron_containing_mols = [], []
-        for mol_tuple in supply_mols_tuple(ligand_fname, preset_resid=preset_resid, protein_resid_set=protein_resid_set):
-            mol = mol_tuple[0]
-            if mol.HasSubstructMatch(Chem.MolFromSmarts("[#5]")):
-                boron_containing_mols.append(mol_tuple)
-            else:
-                standard_mols.append(mol_tuple)
-
-        dask_client, cluster = None, None
+        standard_mols, boron_containing_mols = split_mols_by_preparation_type(ligand_fname, preset_resid=preset_resid,
+                                                                              protein_resid_set=protein_resid_set)
         # prepare boron-containig mols
-        if boron_containing_mols:
-            if gaussian_exe:
-                try:
-                    dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                             n_tasks_per_node=1,
-                                                             use_multi_servers=True if len(boron_containing_mols) > 1 else False,
-                                                             ncpu=ncpu)
-                    for res in calc_dask(prep_ligand, boron_containing_mols, dask_client,
-                                         script_path=script_path, project_dir=project_dir,
-                                         wdir_ligand=wdir_ligand, conda_env_path=os.environ["CONDA_PREFIX"],
-                                         gaussian_exe=gaussian_exe, activate_gaussian=activate_gaussian,
-                                         gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
-                                         ncpu=ncpu, bash_log=bash_log,
-                                         env=os.environ.copy()):
-                        if res:
-                            lig_wdirs.append(res)
-                finally:
-                    if dask_client:
-                        dask_client.shutdown()
-                    if cluster:
-                        cluster.close()
-            else:
-                logging.warning(
-                    f'There are molecules from {ligand_fname} which have Boron atom and to prepare such molecules you need to set up Gaussian.'
-                    f' Please restart the run again and use --gaussian_exe arguments')
-
-        if standard_mols:
-            try:
-                dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                         n_tasks_per_node=min(ncpu, len(standard_mols)),
-                                                         use_multi_servers= True if len(standard_mols) > ncpu else False,
-                                                         ncpu=ncpu)
-                for res in calc_dask(prep_ligand, standard_mols, dask_client,
-                                     script_path=script_path, project_dir=project_dir,
-                                     wdir_ligand=wdir_ligand, no_dr=no_dr,
-                                     conda_env_path=os.environ["CONDA_PREFIX"],
-                                     ncpu=ncpu, bash_log=bash_log,
-                                     env=os.environ.copy()):
-                    if res:
-                        lig_wdirs.append(res)
-            finally:
-                if dask_client:
-                    dask_client.shutdown()
-                if cluster:
-                    cluster.close()
+        lig_wdirs.extend(prepare_boron_containing_mols(boron_containing_mols, ligand_fname=ligand_fname,
+                                                       script_path=script_path, project_dir=project_dir,
+                                                       wdir_ligand=wdir_ligand, gaussian_exe=gaussian_exe,
+                                                       activate_gaussian=activate_gaussian,
+                                                       gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
+                                                       dask_client=dask_client, ncpu=ncpu, bash_log=bash_log,
+                                                       state_db=state_db, state_stage=state_stage))
+        lig_wdirs.extend(prepare_standard_mols(standard_mols, script_path=script_path, project_dir=project_dir,
+                                               wdir_ligand=wdir_ligand, no_dr=no_dr,
+                                               dask_client=dask_client, ncpu=ncpu, bash_log=bash_log,
+                                               state_db=state_db, state_stage=state_stage))
 
     return lig_wdirs
@@ -3,9 +3,6 @@ import logging
 import os
 import shutil
 
-import MDAnalysis as mda
-import parmed as pmd
-
 from streamd.utils.utils import run_check_subprocess, get_mol_resid_pair, get_index, make_group_ndx
 from streamd.preparation.ligand_preparation import prepare_gaussian_files
 from streamd.preparation.md_files_preparation import check_if_info_already_added_to_topol, edit_topology_file
@@ -41,6 +38,8 @@ def split_metal(protein_fname, metal_resnames, wdir):
     :param wdir:
     :return: clean_protein pdb file path, list of each metal pdb file path
     '''
+    import MDAnalysis as mda
+
     protein = mda.Universe(protein_fname)
 
     me_selection = ' or '.join([f'resname {i}' for i in metal_resnames])
@@ -61,6 +60,8 @@ def split_metal(protein_fname, metal_resnames, wdir):
     return protein_clean_pdb, metal_pdb_list
 
 def get_new_metal_ids(protein_fname, metal_resnames):
+    import MDAnalysis as mda
+
     protein = mda.Universe(protein_fname)
     me_selection = ' or '.join([f'resname {i}' for i in metal_resnames])
     metal_atoms = list(protein.select_atoms(me_selection))
@@ -78,6 +79,8 @@ def merge_complex(protein_pdb, ligand_mol2_list, metal_mol2_list, wdir):
     :param metal_mol2_list: list of mol2 file paths
     :return: merged complex pdb file path
     '''
+    import parmed as pmd
+
     def add_resids(protein, resid_list_fname):
         complex = protein
         for resid_fname in resid_list_fname:
@@ -97,6 +100,8 @@ def merge_complex(protein_pdb, ligand_mol2_list, metal_mol2_list, wdir):
     return complex_file
 
 def remove_allHs_from_pdb(complex_file):
+    import MDAnalysis as mda
+
     complex_mda = mda.Universe(complex_file)
     complex_mda_noH = complex_mda.atoms.select_atoms('not (type H and protein)')
 
@@ -231,6 +236,8 @@ def get_renamed_mcpbpy_residues(complex_original, complex_mcpbpy):
     :param complex_mcpbpy:
     :return: dict {mcpbpy_resname:orig_resname}
     '''
+    import MDAnalysis as mda
+
     pdb_orig = mda.Universe(complex_original)
     pdb_mcpbpy = mda.Universe(complex_mcpbpy)
 
@@ -254,6 +261,7 @@ def amber2gmx(complex_original, complex_mcpbpy, prmtop, inpcrd, wdir):
     :param wdir:
     :return:
     '''
+    import parmed as pmd
 
     topol_top, solv_ions_gro = os.path.join(wdir, 'topol.top'), os.path.join(wdir, 'solv_ions.gro')
 
@@ -182,3 +182,40 @@ def prepare_mdp_files(wdir_md_cur, all_resids, nvt_time_ps, npt_time_ps, mdtime_
             return None
 
     return wdir_md_cur
+
+
+def make_replicas(wdir_md_cur, replicas, seed, deffnm='md_out'):
+    '''
+    Clone a prepared complex (solvated system, topology, index and mdp files) to simulate independent replicas.
+    The directory of the complex is used as the first replica, other replicas are created next to it
+    :param wdir_md_cur: directory of the prepared complex
+    :param replicas: number of replicas
+    :param seed: gen_seed of the first replica. Replica N gets seed + N - 1, if seed is -1 each replica
+                 gets its own random seed from gmx grompp
+    :param deffnm: name of simulation output files which should not be copied
+    :return: list of directories of all replicas
+    '''
+    from streamd.utils.replicas import get_replica_dir
+
+    output_ext = ('.tpr', '.cpt', '.edr', '.xtc', '.trr', '.log')
+    output_prefix = ('em.', 'nvt.', 'npt.', f'{deffnm}.', '#')
+    replica_dirs = [wdir_md_cur]
+    for replica in range(2, replicas + 1):
+        replica_dir = get_replica_dir(wdir_md_cur, replica)
+        replica_dirs.append(replica_dir)
+        if os.path.isfile(os.path.join(replica_dir, 'solv_ions.gro')):
+            continue
+        os.makedirs(replica_dir, exist_ok=True)
+        for fname in sorted(os.listdir(wdir_md_cur)):
+            f = os.path.join(wdir_md_cur, fname)
+            if not os.path.isfile(f) or fname == 'solv_ions.gro' or fname.endswith(output_ext) or \
+                    (fname.startswith(output_prefix) and not fname.endswith('.mdp')):
+                continue
+            shutil.copy(f, replica_dir)
+        if seed != -1:
+            edit_mdp(md_file=os.path.join(replica_dir, 'nvt.mdp'),
+                     pattern='gen_seed',
+                     replace=f'gen_seed                = {seed + replica - 1}        ;')
+        # solv_ions.gro is copied last, so an interrupted copy is repeated on restart
+        shutil.copy(os.path.join(wdir_md_cur, 'solv_ions.gro'), replica_dir)
+    return replica_dirs
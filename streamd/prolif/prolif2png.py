@@ -1,10 +1,6 @@
 import argparse
 import os
-import pandas as pd
 import re
-import matplotlib.pyplot as plt
-from plotnine import ggplot, geom_point, aes, theme, element_text, element_blank, theme_bw, scale_color_manual, element_rect, scale_x_discrete
-plt.ioff()
 
 # def calculate_figure_size(num_data_points_x, num_data_points_y):
 #     # aspect_ratio = (num_data_points_x/num_data_points_y)/10
@@ -30,6 +26,10 @@ plt.ioff()
 #     return f'{split_row[0]}{chain} {split_row[-1]}'
 
 def convertprolif2png(plif_out_file, occupancy=0.6, plot_width=None, plot_height=None, base_size=12):
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from plotnine import ggplot, geom_point, aes, theme, element_text, element_blank, theme_bw, scale_color_manual, element_rect, scale_x_discrete
+    plt.ioff()
 
     new_names = {"HBACCEPTOR": "A", "ANIONIC": "N", "HYDROPHOBIC": "H", 'METALACCEPTOR':'MeA',
                  "PISTACKING": "pi-s", "HBDONOR": "D", "PICATION": "pi+", "CATIONPI": "+pi", "CATIONIC": "P"}
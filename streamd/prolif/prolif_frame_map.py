@@ -1,13 +1,13 @@
 import argparse
 import os
 import re
-import pandas as pd
-import matplotlib.pyplot as plt
-from plotnine import (ggplot, geom_point, aes, theme, element_text, element_blank,
-                      theme_bw, scale_color_manual, element_rect, facet_wrap, labs, scale_x_continuous, element_line,facet_grid )
-plt.ioff()
 
 def convertplifbyframe2png(plif_out_file, plot_width=15, plot_height=10, occupancy=0, filter_only_hydrophobic=False, base_size=12):
+    import pandas as pd
+    import matplotlib.pyplot as plt
+    from plotnine import (ggplot, geom_point, aes, theme, element_text, element_blank,
+                          theme_bw, scale_color_manual, element_rect, facet_wrap, labs, scale_x_continuous, element_line,facet_grid )
+    plt.ioff()
 
     label_colors = {"hbacceptor": "red", "hbdonor": "forestgreen", "anionic": "blue", "cationic": "magenta",
                     "hydrophobic": "orange", "pication": "black", "cationpi": "darkblue",
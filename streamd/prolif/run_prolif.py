@@ -9,18 +9,15 @@ from glob import glob
 import logging
 import pathlib
 
-import MDAnalysis as mda
-import pandas as pd
-import prolif as plf
-from prolif.plotting.barcode import Barcode
-from prolif.plotting.network import LigNetwork
-import matplotlib.pyplot as plt
-
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
+from streamd.utils.cost_model import sort_by_cost, estimate_trajectory_cost
+from streamd.utils.dask_init import calc_dask
+from streamd.utils.executors import init_executor
+from streamd.utils.replicas import has_replicas, summarize_replicas
+from streamd.utils.shared_frames import SharedFrames, fill_shared_frames, get_shared_universe
+from streamd.utils.trajectory_index import load_universe
 from streamd.utils.utils import filepath_type
 from streamd.prolif.prolif2png import convertprolif2png
 from streamd.prolif.prolif_frame_map import convertplifbyframe2png
-plt.ioff()
 
 class RawTextArgumentDefaultsHelpFormatter(argparse.RawTextHelpFormatter, argparse.ArgumentDefaultsHelpFormatter):
     pass
@@ -33,6 +30,82 @@ def backup_output(output):
         shutil.move(output, os.path.join(os.path.dirname(output), f'#{os.path.basename(output)}.{n}#'))
 
 
+# MDAnalysis Universe of the atoms of the shared buffer in a worker process, see init_prolif_worker
+_worker_universe = None
+
+
+def init_prolif_worker(universe):
+    '''
+    Initializer of worker processes. Workers are forked, so the Universe is inherited without pickling
+    and tasks send only the specification of the buffer and atom indices
+    :param universe: MDAnalysis Universe of the atoms of the shared buffer
+    '''
+    global _worker_universe
+    _worker_universe = universe
+
+
+def calc_prolif_frames(shared_frames_spec, protein_ids, ligand_ids, interactions, start, stop):
+    '''
+    Interaction fingerprints of a chunk of frames read from the shared memory buffer
+    by the Universe of the worker (see init_prolif_worker)
+    :param shared_frames_spec: see SharedFrames.get_spec
+    :param protein_ids: indices of protein atoms in the universe
+    :param ligand_ids: indices of ligand atoms in the universe
+    :param interactions: list of ProLIF interactions
+    :param start: the first index of frames in the buffer
+    :param stop: the last index of frames in the buffer (not included)
+    :return: dict {original frame number: fingerprint}
+    '''
+    import prolif as plf
+
+    shared_frames = SharedFrames(**shared_frames_spec)
+    try:
+        universe = get_shared_universe(_worker_universe, shared_frames)
+        fp = plf.Fingerprint(interactions)
+        fp.run(universe.trajectory[start:stop], universe.atoms[ligand_ids], universe.atoms[protein_ids],
+               progress=False, n_jobs=1)
+        return {int(shared_frames.frames[frame]): ifp for frame, ifp in fp.ifp.items()}
+    finally:
+        shared_frames.close()
+
+
+def run_prolif_shared_frames(trajectory, protein, ligand, interactions, n_jobs):
+    '''
+    Decode frames once to a node-local shared memory buffer and calculate fingerprints of chunks of frames by
+    n_jobs processes attached to the buffer. It replaces the ProLIF parallel run where each process pickles
+    and reads the trajectory
+    :param trajectory: MDAnalysis trajectory or its slice
+    :param protein: AtomGroup
+    :param ligand: AtomGroup
+    :param interactions: list of ProLIF interactions
+    :param n_jobs:
+    :return: dict {frame number: fingerprint} as Fingerprint.ifp
+    '''
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+
+    import MDAnalysis as mda
+    import numpy as np
+
+    atoms = protein | ligand
+    # the topology of the buffer atoms keeps resids and segids set from pdb
+    universe = mda.Merge(atoms)
+    protein_ids = np.searchsorted(atoms.indices, protein.indices)
+    ligand_ids = np.searchsorted(atoms.indices, ligand.indices)
+
+    with fill_shared_frames(atoms, trajectory) as shared_frames:
+        nchunks = max(1, min(n_jobs, shared_frames.n_frames))
+        bounds = [shared_frames.n_frames * i // nchunks for i in range(nchunks + 1)]
+        with ProcessPoolExecutor(max_workers=nchunks, mp_context=multiprocessing.get_context('fork'),
+                                 initializer=init_prolif_worker, initargs=(universe,)) as pool:
+            futures = [pool.submit(calc_prolif_frames, shared_frames.get_spec(), protein_ids, ligand_ids,
+                                   interactions, start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+            ifp = {}
+            for future in futures:
+                ifp.update(future.result())
+    return ifp
+
+
 def run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, n_jobs,
                     occupancy = 0.6, save_viz=True, dpi=300, plot_width=15, plot_height=8, pdb=None):
     '''
@@ -51,7 +124,14 @@ def run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose
     :param plot_height: in inches
     :return: pandas dataframe
     '''
-    u = mda.Universe(tpr, xtc, in_memory=False, in_memory_step=1)
+    import MDAnalysis as mda
+    import prolif as plf
+    from prolif.plotting.barcode import Barcode
+    from prolif.plotting.network import LigNetwork
+    import matplotlib.pyplot as plt
+    plt.ioff()
+
+    u = load_universe(tpr, xtc)
 
     protein = u.atoms.select_atoms(protein_selection)
     ligand = u.atoms.select_atoms(ligand_selection)
@@ -64,9 +144,24 @@ def run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose
         if len(protein.segments.segids) == len(protein_pdb.segments.segids):
             protein.segments.segids = protein_pdb.segments.segids
 
-    fp = plf.Fingerprint(['Hydrophobic', 'HBDonor', 'HBAcceptor', 'Anionic', 'Cationic', 'CationPi', 'PiCation',
-                          'PiStacking', 'MetalAcceptor'])
-    fp.run(u.trajectory[::step] if step > 1 else u.trajectory, ligand, protein, progress=verbose, n_jobs=n_jobs)
+    interactions = ['Hydrophobic', 'HBDonor', 'HBAcceptor', 'Anionic', 'Cationic', 'CationPi', 'PiCation',
+                    'PiStacking', 'MetalAcceptor']
+    fp = plf.Fingerprint(interactions)
+    trajectory = u.trajectory[::step] if step > 1 else u.trajectory
+    ifp = None
+    if n_jobs > 1:
+        try:
+            ifp = run_prolif_shared_frames(trajectory, protein, ligand, interactions, n_jobs=n_jobs)
+        except Exception as e:
+            # e.g. daemonic processes of dask workers cannot start child processes, /dev/shm is too small,
+            # a worker was killed (BrokenProcessPool) or a fingerprint cannot be pickled
+            logging.warning(f'{xtc}: cannot use shared memory workers, ProLIF will be run by its own '
+                            f'parallelization by {min(12, n_jobs)} processes. Error: {e!r}')
+    if ifp is None:
+        # limit to 12 https://github.com/chemosim-lab/ProLIF/issues/110
+        fp.run(trajectory, ligand, protein, progress=verbose, n_jobs=min(12, n_jobs))
+    else:
+        fp.ifp = ifp
 
     df = fp.to_dataframe()
     df.columns = ['.'.join(item.strip().lower() for item in items[1:]) for items in df.columns]
@@ -104,6 +199,8 @@ def run_prolif_from_wdir(wdir, tpr, xtc, protein_selection, ligand_selection, st
 
 
 def collect_outputs(output_list, output):
+    import pandas as pd
+
     df_list = []
     for i in output_list:
         df = pd.read_csv(i, sep='\t')
@@ -117,12 +214,32 @@ def collect_outputs(output_list, output):
     # sort by number and type of interaction
     amino_acids.sort(key=lambda x: (int(x.split('.')[0][3:]), x.split('.')[1]))
     sorted_columns = ['Name', 'Frame'] + amino_acids
-    df_aggregated.loc[:, sorted_columns].to_csv(output, sep='\t', index=False)
+    df_aggregated = df_aggregated.loc[:, sorted_columns]
+    df_aggregated.to_csv(output, sep='\t', index=False)
+    return df_aggregated
+
+
+def collect_replicas(df_aggregated, output):
+    '''
+    Save mean and SD of interaction occupancies (%) between replicas of each complex
+    :param df_aggregated: pandas DataFrame returned by collect_outputs
+    :param output: csv file
+    :return: output or None if there are no replicas
+    '''
+    if not has_replicas(df_aggregated['Name'].unique()):
+        return None
+    occupancy = (df_aggregated.drop(columns='Frame').astype({i: float for i in df_aggregated.columns
+                                                             if i not in ('Name', 'Frame')})
+                 .groupby('Name').mean() * 100)
+    occupancy = occupancy.reset_index().melt(id_vars='Name', var_name='interaction', value_name='occupancy')
+    summarize_replicas(occupancy, name_col='Name', value_cols=['occupancy'],
+                       group_cols=['interaction']).to_csv(output, sep='\t', index=False)
+    return output
 
 
 def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection,
           protein_selection, ligand_resid, hostfile, ncpu, n_jobs,
-          occupancy, plot_width, plot_height, save_viz, unique_id, pdb, verbose):
+          occupancy, plot_width, plot_height, save_viz, unique_id, pdb, verbose, executor='dask'):
     output = 'plifs.csv'
     output_aggregated = os.path.join(wdir_output, f'prolif_output_{unique_id}.csv')
 
@@ -132,23 +249,27 @@ def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection,
     ligand_selection = f'resname {ligand_resid}'
 
     if wdir_to_run is not None:
-        dask_client, cluster = None, None
+        dask_client = None
         #n_jobs_per_task = n_jobs if n_jobs <= ncpu else ncpu
         if n_jobs is None:
-            # limit to 12 https://github.com/chemosim-lab/ProLIF/issues/110
-            n_jobs_per_task = min(12, ncpu // len(wdir_to_run))
+            # workers read frames from shared memory, so the ProLIF limit of 12 processes
+            # (https://github.com/chemosim-lab/ProLIF/issues/110) is not applied
+            n_jobs_per_task = max(1, ncpu // len(wdir_to_run))
         else:
             n_jobs_per_task = n_jobs
 
         logging.info(f'Allocating {n_jobs_per_task} n_jobs per each task.')
 
         try:
-            dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                     n_tasks_per_node=min(len(wdir_to_run), ncpu//n_jobs_per_task),
-                                                     use_multi_servers=True if len(wdir_to_run) > ncpu else False,
-                                                     ncpu=ncpu)
+            n_tasks_per_node = min(len(wdir_to_run), ncpu // n_jobs_per_task)
+            dask_client = init_executor(executor, hostfile=hostfile if len(wdir_to_run) > ncpu else None,
+                                        ncpu=ncpu, n_workers_per_node=n_tasks_per_node)
             var_prolif_out_files = []
+            # the longest trajectories first
+            wdir_to_run = sort_by_cost(wdir_to_run, lambda wdir: estimate_trajectory_cost(os.path.join(wdir, xtc)))
+            # each task occupies the whole worker
             for res in calc_dask(run_prolif_from_wdir, wdir_to_run, dask_client=dask_client,
+                                 resources={'CPU': ncpu // n_tasks_per_node},
                                  tpr=tpr, xtc=xtc, protein_selection=protein_selection,
                                  ligand_selection=ligand_selection, step=step, verbose=verbose, output=output,
                                  plot_width=plot_width, plot_height=plot_height, save_viz=save_viz, pdb=pdb,
@@ -157,18 +278,15 @@ def start(wdir_to_run, wdir_output, tpr, xtc, step, append_protein_selection,
                     var_prolif_out_files.append(res)
         finally:
             if dask_client:
-                dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                           close_workers=True, remove=True)
-                dask_client.shutdown()
-            if cluster:
-                cluster.close()
+                dask_client.close()
     else:
         output = os.path.join(os.path.dirname(xtc), output)
         run_prolif_task(tpr, xtc, protein_selection, ligand_selection, step, verbose, output, pdb=pdb, n_jobs=ncpu, occupancy=occupancy)
         var_prolif_out_files = [output]
 
     backup_output(output_aggregated)
-    collect_outputs(var_prolif_out_files, output=output_aggregated)
+    df_aggregated = collect_outputs(var_prolif_out_files, output=output_aggregated)
+    collect_replicas(df_aggregated, output=os.path.join(wdir_output, f'prolif_replicas_{unique_id}.csv'))
 
     convertprolif2png(output_aggregated, occupancy=occupancy, plot_width=plot_width, plot_height=plot_height)
     finished_complexes_file = os.path.join(wdir_output, f"finished_prolif_files_{unique_id}.txt")
@@ -214,6 +332,10 @@ def main():
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
                              'will be the address of the scheduler running on the standard port 8786. If omitted, '
                              'calculations will run on a single machine as usual.')
+    parser.add_argument('--executor', default='dask', choices=['auto', 'dask', 'local'],
+                        help='Backend to run tasks. dask - dask cluster (a single server or servers from hostfile), '
+                             'local - a pool of processes on the current server without start up costs of dask, '
+                             'auto - dask if hostfile is set, local otherwise.')
     parser.add_argument('-c', '--ncpu', metavar='INTEGER', required=False, default=len(os.sched_getaffinity(0)), type=int,
                         help='number of CPU per server. By default, StreaMD utilizes all available cpus.')
     parser.add_argument('--n_jobs', metavar='INTEGER', required=False,
@@ -221,8 +343,11 @@ def main():
                          help='Number of processes to run per each interaction analysis tasks. '
                               'By default, StreaMD distributes the specified number of cores (--ncpu) evenly '
                               'between the available CPUs and the number of tasks to execute (e.g., multiple directories provided via --wdir_to_run). '
-                              'However, by default, the --n_jobs value is limited to 12 to avoid the bottleneck issue (https://github.com/chemosim-lab/ProLIF/issues/110) described by the ProLIF authors .'
-                              'Users can override this limitation by explicitly specifying the --n_jobs argument value.')
+                              'Frames of each trajectory are decoded once into node-local shared memory and processes '
+                              'calculate fingerprints of chunks of frames reading them from there, so the number of '
+                              'processes is not limited to 12 as in the ProLIF parallelization '
+                              '(https://github.com/chemosim-lab/ProLIF/issues/110). If shared memory workers cannot '
+                              'be used, ProLIF parallelization is used with at most 12 processes.')
     parser.add_argument('--width', metavar='FILENAME', default=15, type=int,
                         help='width of the output pictures')
     parser.add_argument('--height', metavar='FILENAME', default=10, type=int,
@@ -287,7 +412,7 @@ def main():
           protein_selection=args.protein_selection, ligand_resid=args.ligand, hostfile=args.hostfile, ncpu=args.ncpu,
           n_jobs=args.n_jobs, occupancy=args.occupancy, plot_width=args.width, plot_height=args.height,
           save_viz=not args.not_save_pics, unique_id=unique_id, pdb=pdb,
-          verbose=args.verbose)
+          verbose=args.verbose, executor=args.executor)
     finally:
         logging.shutdown()
 
@@ -19,9 +19,11 @@ from datetime import datetime
 from functools import partial
 from multiprocessing import Pool
 
-import pandas as pd
-
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
+from streamd.utils.cost_model import sort_by_cost
+from streamd.utils.dask_init import calc_dask
+from streamd.utils.executors import init_executor
+from streamd.utils.metrics import init_metrics_file, log_metrics_summary
+from streamd.utils.replicas import has_replicas, summarize_replicas
 from streamd.utils.utils import (get_index, make_group_ndx, filepath_type, run_check_subprocess,
                                  get_number_of_frames)
 
@@ -192,6 +194,25 @@ def parse_gmxMMPBSA_output(fname):
 
     return out_res
 
+def summarize_gbsa_replicas(df, out_file):
+    '''
+    Save mean and SD of binding energies between replicas of each complex
+    :param df: pandas DataFrame of GBSA or PBSA output, Name is the path to the gmx_MMPBSA output file
+    :param out_file: csv file
+    :return: out_file or None if there are no replicas
+    '''
+    import pandas as pd
+
+    complex_dirs = [os.path.basename(os.path.dirname(i)) for i in df['Name']]
+    value_cols = [i for i in ['ΔGbinding', 'ΔTOTAL_Average', 'IE_Average'] if i in df.columns]
+    if not value_cols or not has_replicas(complex_dirs):
+        return None
+    df = df.assign(complex_dir=complex_dirs)
+    df[value_cols] = df[value_cols].apply(pd.to_numeric, errors='coerce')
+    summarize_replicas(df, name_col='complex_dir', value_cols=value_cols).to_csv(out_file, sep='\t', index=False)
+    return out_file
+
+
 def run_get_frames_from_wdir(wdir, xtc, env):
     return get_number_of_frames(os.path.join(wdir, xtc), env=env)
 
@@ -222,8 +243,10 @@ def get_mmpbsa_start_end_interval(mmpbsa):
 
 def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_resid,
           append_protein_selection, hostfile, unique_id, bash_log,
-          gmxmmpbsa_out_files=None, clean_previous=False):
-    dask_client, cluster, pool = None, None, None
+          gmxmmpbsa_out_files=None, clean_previous=False, executor='dask'):
+    import pandas as pd
+
+    dask_client, pool = None, None
     var_gbsa_out_files = []
     if gmxmmpbsa_out_files is None:
         # gmx_mmpbsa requires that the run must have at least as many frames as processors. Thus we get and use the min number of used frames as NP
@@ -237,11 +260,15 @@ def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_re
 
         if wdir_to_run is not None:
             var_number_of_frames = []
+            wdir_frames = {}
             with Pool(ncpu) as pool:
-                for res in pool.imap_unordered(partial(run_get_frames_from_wdir,
-                                    xtc=xtc, env=os.environ.copy()), wdir_to_run):
+                for wdir, res in zip(wdir_to_run, pool.imap(partial(run_get_frames_from_wdir,
+                                    xtc=xtc, env=os.environ.copy()), wdir_to_run)):
                     if res:
                         var_number_of_frames.append(res[0])
+                        wdir_frames[wdir] = res[0]
+            # the longest trajectories first
+            wdir_to_run = sort_by_cost(wdir_to_run, lambda wdir: wdir_frames.get(wdir, 0))
 
             used_number_of_frames = math.ceil((min(min(var_number_of_frames), endframe) - (startframe - 1)) / interval)
             n_tasks_per_node = ncpu // min(ncpu, used_number_of_frames)
@@ -249,10 +276,12 @@ def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_re
             logging.info(f'{min(ncpu, used_number_of_frames)} NP will be used')
             # run energy calculation
             try:
-                dask_client, cluster = init_dask_cluster(hostfile=hostfile, n_tasks_per_node=n_tasks_per_node,
-                                                         ncpu=ncpu)
+                dask_client = init_executor(executor, hostfile=hostfile, ncpu=ncpu,
+                                            n_workers_per_node=n_tasks_per_node)
                 var_gbsa_out_files = []
+                # each task occupies the whole worker
                 for res in calc_dask(run_gbsa_from_wdir, wdir_to_run, dask_client=dask_client,
+                                     resources={'CPU': ncpu // n_tasks_per_node},
                                      tpr=tpr, xtc=xtc, topol=topol, index=index,
                                      mmpbsa=mmpbsa, np=min(ncpu, used_number_of_frames),
                                      ligand_resid=ligand_resid,
@@ -263,11 +292,7 @@ def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_re
                         var_gbsa_out_files.append(res)
             finally:
                 if dask_client:
-                    dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                               close_workers=True, remove=True)
-                    dask_client.shutdown()
-                if cluster:
-                    cluster.close()
+                    dask_client.close()
 
         elif tpr is not None and xtc is not None and topol is not None and index is not None:
             number_of_frames, _ = get_number_of_frames(xtc, env=os.environ.copy())
@@ -301,6 +326,10 @@ def start(wdir_to_run, tpr, xtc, topol, index, out_wdir, mmpbsa, ncpu, ligand_re
         if list(pd_pbsa.columns) != ['Name']:
             pd_pbsa.to_csv(os.path.join(out_wdir, f'PBSA_output_{unique_id}.csv'), sep='\t', index=False)
 
+        for df, name in ((pd_gbsa, 'GBSA'), (pd_pbsa, 'PBSA')):
+            if list(df.columns) != ['Name']:
+                summarize_gbsa_replicas(df, os.path.join(out_wdir, f'{name}_replicas_{unique_id}.csv'))
+
         finished_complexes_file = os.path.join(out_wdir, f"finished_gbsa_files_{unique_id}.txt")
         with open(finished_complexes_file, 'w') as output:
             output.write("\n".join(var_gbsa_out_files))
@@ -337,6 +366,15 @@ def main():
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
                              'will be the address of the scheduler running on the standard port 8786. If omitted, '
                              'calculations will run on a single machine as usual.')
+    parser.add_argument('--executor', default='dask', choices=['auto', 'dask', 'local'],
+                        help='Backend to run tasks. dask - dask cluster (a single server or servers from hostfile), '
+                             'local - a pool of processes on the current server without start up costs of dask, '
+                             'auto - dask if hostfile is set, local otherwise.')
+    parser.add_argument('--metrics_file', metavar='FILENAME', required=False, default=None, type=str,
+                         help='File to save wall time, cpu time, peak memory and block I/O of each call of external '
+                              'programs (gmx, gmx_MMPBSA) as JSON lines tagged by the stage '
+                              'and the directory of the complex. By default, streamd_metrics.jsonl in the working '
+                              'directory.')
     parser.add_argument('-c', '--ncpu', metavar='INTEGER', required=False, default=len(os.sched_getaffinity(0)), type=int,
                         help='number of CPU per server. Use all available cpus by default.')
     parser.add_argument('--ligand_id', metavar='UNL', default='UNL', help='Ligand residue ID')
@@ -392,12 +430,16 @@ def main():
     logging.getLogger('bockeh').setLevel('CRITICAL')
 
     logging.info(args)
+    metrics_file = init_metrics_file(args.metrics_file if args.metrics_file
+                                     else os.path.join(wdir, 'streamd_metrics.jsonl'))
     try:
         start(tpr=tpr, xtc=xtc, topol=topol,
               index=index, out_wdir=wdir, wdir_to_run=args.wdir_to_run,
               mmpbsa=args.mmpbsa, ncpu=args.ncpu, unique_id=unique_id,
               gmxmmpbsa_out_files=args.out_files, ligand_resid=args.ligand_id,
               append_protein_selection=args.append_protein_selection,
-              hostfile=args.hostfile, bash_log=bash_log, clean_previous=args.clean_previous)
+              hostfile=args.hostfile, bash_log=bash_log, clean_previous=args.clean_previous,
+              executor=args.executor)
+        log_metrics_summary(metrics_file)
     finally:
         logging.shutdown()
@@ -16,12 +16,31 @@ from functools import partial
 from glob import glob
 import json
 import re
+import threading
 
+from streamd.analysis.insitu_analysis import run_insitu_analysis
 from streamd.analysis.md_system_analysis import run_md_analysis
 from streamd.analysis.run_analysis import run_rmsd_analysis
 from streamd.preparation.complex_preparation import run_complex_preparation
-from streamd.preparation.ligand_preparation import prepare_input_ligands, check_mols
-from streamd.utils.dask_init import init_dask_cluster, calc_dask
+from streamd.preparation.md_files_preparation import make_replicas
+from streamd.preparation.ligand_preparation import (prepare_input_ligands, check_mols, prep_ligand,
+                                                    split_mols_by_preparation_type, prepare_boron_containing_mols,
+                                                    get_gaussian_resources, set_mol_pickle_properties,
+                                                    get_ligand_signature)
+from streamd.utils.early_stop import (monitor_ligand_rmsd, is_early_stopped, get_mdrun_pid_file,
+                                     backup_stale_trajectory)
+from streamd.utils.dask_init import calc_dask, calc_dask_groups, calc_dask_pipeline, get_worker_resources
+from streamd.utils.executors import init_executor
+from streamd.utils.cost_model import (sort_by_cost, estimate_ligand_cost, estimate_equilibration_cost,
+                                      estimate_simulation_cost, estimate_analysis_cost)
+from streamd.utils.mdrun_slots import mdrun_slot, get_lock_dir, get_multidir_mdrun_args
+from streamd.utils.mdrun_tuning import tune_mdrun, get_default_cache_file
+from streamd.utils.mdrun_performance import (init_performance_table, harvest_mdrun_logs, get_harvest_callback,
+                                             write_performance_summary)
+from streamd.utils.metrics import init_metrics_file, log_metrics_summary
+from streamd.utils.replicas import split_replica_name
+from streamd.utils.state_db import (init_state_db, split_finished_tasks, get_finished_tasks, get_resume_point,
+                                    get_task_callback, save_task_state, reset_state_db, get_input_signature)
 from streamd.utils.utils import (filepath_type, run_check_subprocess,
                                  get_protein_resid_set,
                                  backup_prev_files,
@@ -35,7 +54,11 @@ class RawTextArgumentDefaultsHelpFormatter(argparse.RawTextHelpFormatter, argpar
 
 
 def run_equilibration(wdir, project_dir, bash_log, ncpu, compute_device,
-                      device_param, gpu_args, analysis_dirname='md_analysis', env=None):
+                      mdrun_settings, analysis_dirname='md_analysis', cpt_interval=15, env=None):
+    '''
+    :param mdrun_settings: dict of ntmpi_per_gpu, gpu_ids, nslots, lock_dir arguments of mdrun_slot
+    :param cpt_interval: checkpoint interval in minutes. Interrupted NVT and NPT runs are continued from checkpoints
+    '''
     if os.path.isfile(os.path.join(wdir, 'npt.gro')) and os.path.isfile(os.path.join(wdir, 'npt.cpt')):
         logging.warning(f'{wdir}. Checkpoint files after Equilibration step exist. '
                         f'Equilibration step will be skipped ')
@@ -45,48 +68,207 @@ def run_equilibration(wdir, project_dir, bash_log, ncpu, compute_device,
     os.makedirs(wdir_out_analysis, exist_ok=True)
     system_name = os.path.split(wdir)[-1]
 
-    cmd = (f'wdir={wdir} ncpu={ncpu} compute_device={compute_device} device_param={device_param} '
-           f'gpu_args={gpu_args} wdir_out_analysis={wdir_out_analysis} system_name={system_name} '
-           f'bash {os.path.join(project_dir, "scripts/script_sh/equlibration.sh")} '
-           f'>> {os.path.join(wdir, bash_log)} 2>&1'),
-    if not run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log), env=env):
-        return None
+    with mdrun_slot(ncpu=ncpu, compute_device=compute_device, **mdrun_settings) as (device_param, gpu_args, pin_args):
+        cmd = (f'wdir={wdir} ncpu={ncpu} compute_device={compute_device} device_param={device_param} '
+               f'gpu_args={gpu_args} pin_args={pin_args} cpt_interval={cpt_interval} '
+               f'wdir_out_analysis={wdir_out_analysis} system_name={system_name} '
+               f'bash {os.path.join(project_dir, "scripts/script_sh/equlibration.sh")} '
+               f'>> {os.path.join(wdir, bash_log)} 2>&1'),
+        if not run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log), env=env, stage='equilibration'):
+            return None
     return wdir
 
 
+def run_with_monitors(cmd, wdir, log, env=None, monitors=(), stage=None):
+    '''
+    Run a command of mdrun. Monitors are run in threads while the command is running
+    :param monitors: functions with is_running argument (function returning False when the command is finished)
+    :param stage: name of the stage in metrics (see run_check_subprocess)
+    :return: True if the command was successfully finished
+    '''
+    finished = threading.Event()
+    threads = [threading.Thread(target=partial(monitor, is_running=lambda: not finished.is_set()), daemon=True)
+               for monitor in monitors]
+    for thread in threads:
+        thread.start()
+    try:
+        return run_check_subprocess(cmd, wdir, log=log, env=env, stage=stage)
+    finally:
+        finished.set()
+        for thread in threads:
+            thread.join()
+
+
+def is_simulation_started(wdir, tpr, cpt, xtc, deffnm):
+    return (tpr is not None and os.path.isfile(tpr) and cpt is not None and os.path.isfile(cpt) and xtc is not None and os.path.isfile(str(xtc))) or \
+        (os.path.isfile(os.path.join(wdir, f'{deffnm}.tpr')) and os.path.isfile(os.path.join(wdir, f'{deffnm}.cpt'))
+         and os.path.isfile(os.path.join(wdir, f'{deffnm}.xtc')))
+
+
 def run_simulation(wdir, project_dir, bash_log, mdtime_ns,
                    tpr, cpt, xtc, deffnm, deffnm_next, ncpu,
-                   compute_device, device_param, gpu_args, env=None):
+                   compute_device, mdrun_settings, cpt_interval=15, mdrun_tuning=None, early_stop=None,
+                   insitu_analysis=None, env=None):
+    '''
+    :param mdrun_tuning: None or dict of cache_file and nsteps arguments of tune_mdrun. Launch parameters of mdrun
+                         are tuned for the system size and hardware before the production run
+    :param early_stop: None or dict of threshold, window_ns, ligand_resid and interval arguments of
+                       monitor_ligand_rmsd. The production run is stopped if the ligand leaves the binding site
+    :param insitu_analysis: None or dict of ligand_resid, active_site_dist, ligand_list_file and analysis_dirname
+                            arguments of run_insitu_analysis. RMSD, radius of gyration and RMSF are calculated
+                            from the trajectory while mdrun is writing it
+    '''
+    if is_early_stopped(wdir, deffnm):
+        logging.warning(f'{wdir}. The simulation was stopped early because of unstable ligand and will not be continued')
+        return (wdir, deffnm)
     # continue/extend simulation if checkpoint files exist
-    if (tpr is not None and os.path.isfile(tpr) and cpt is not None and os.path.isfile(cpt) and xtc is not None and os.path.isfile(str(xtc))) or \
-        (os.path.isfile(os.path.join(wdir, f'{deffnm}.tpr')) and os.path.isfile(os.path.join(wdir, f'{deffnm}.cpt'))
-         and os.path.isfile(os.path.join(wdir, f'{deffnm}.xtc'))) :
+    if is_simulation_started(wdir, tpr, cpt, xtc, deffnm):
         logging.warning(f'{wdir}. {deffnm}.xtc and {deffnm}.tpr and  {deffnm}.cpt exist. '
                         f'MD simulation will be continued until the setup simulation steps are reached.')
         if continue_md_from_dir(wdir_to_continue=wdir, tpr=tpr, cpt=cpt, xtc=xtc,
                                 deffnm=deffnm, deffnm_next=deffnm_next,
                                 mdtime_ns=mdtime_ns, project_dir=project_dir, bash_log=bash_log,
-                                ncpu=ncpu, compute_device=compute_device, device_param=device_param,
-                                gpu_args=gpu_args, env=env) is None:
+                                ncpu=ncpu, compute_device=compute_device,
+                                mdrun_settings=mdrun_settings, cpt_interval=cpt_interval,
+                                mdrun_tuning=mdrun_tuning, insitu_analysis=insitu_analysis, env=env) is None:
             return None
 
         return (wdir, deffnm)
-    cmd = (f'wdir={wdir} ncpu={ncpu} compute_device={compute_device} gpu_args={gpu_args} device_param={device_param} deffnm={deffnm} '
-           f'bash {os.path.join(project_dir, "scripts/script_sh/md.sh")} >> {os.path.join(wdir, bash_log)} 2>&1')
-    if not run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log), env=env):
-        return None
+    tuning = partial(tune_mdrun, wdir=wdir, bash_log=bash_log, env=env, **mdrun_tuning) if mdrun_tuning else None
+    with mdrun_slot(ncpu=ncpu, compute_device=compute_device, get_args=tuning,
+                    **mdrun_settings) as (device_param, gpu_args, pin_args):
+        cmd = (f'wdir={wdir} ncpu={ncpu} compute_device={compute_device} gpu_args={gpu_args} pin_args={pin_args} device_param={device_param} deffnm={deffnm} '
+               f'cpt_interval={cpt_interval} '
+               f'bash {os.path.join(project_dir, "scripts/script_sh/md.sh")} >> {os.path.join(wdir, bash_log)} 2>&1')
+        monitors = []
+        if early_stop:
+            pid_file = get_mdrun_pid_file(wdir, deffnm)
+            if os.path.isfile(pid_file):
+                os.remove(pid_file)
+            monitors.append(partial(monitor_ligand_rmsd, wdir=wdir, deffnm=deffnm, **early_stop))
+        if insitu_analysis:
+            monitors.append(partial(run_insitu_analysis, wdir=wdir, deffnm=deffnm, **insitu_analysis))
+        if monitors:
+            # monitors start to read the trajectory before mdrun creates it
+            backup_stale_trajectory(wdir, deffnm)
+        if not run_with_monitors(cmd, wdir, log=os.path.join(wdir, bash_log), env=env, monitors=monitors,
+                                 stage='simulation'):
+            return None
     return (wdir, deffnm)
 
 
+def run_equilibration_multidir(wdirs, project_dir, bash_log, ncpu, compute_device,
+                               mdrun_settings, analysis_dirname='md_analysis', cpt_interval=15, mpirun='mpirun',
+                               env=None):
+    '''
+    Equilibration of several systems by a single gmx_mpi mdrun -multidir launch (one rank per system),
+    ranks share cores and GPUs of the slot. If the launch fails, unfinished systems are run one by one
+    by run_equilibration
+    :param wdirs: tuple of directories of complexes
+    :param mpirun: MPI launcher of gmx_mpi
+    :return: list of wdir (None if equilibration of the complex failed) for each directory
+             or None if all of them failed
+    '''
+    wdirs_to_run = [wdir for wdir in wdirs if not (os.path.isfile(os.path.join(wdir, 'npt.gro')) and
+                                                   os.path.isfile(os.path.join(wdir, 'npt.cpt')))]
+    if wdirs_to_run:
+        for wdir in wdirs_to_run:
+            os.makedirs(os.path.join(wdir, analysis_dirname), exist_ok=True)
+        logs = ' '.join(os.path.join(wdir, bash_log) for wdir in wdirs_to_run)
+        with mdrun_slot(ncpu=ncpu, compute_device=compute_device,
+                        get_args=partial(get_multidir_mdrun_args, nsim=len(wdirs_to_run)),
+                        **mdrun_settings) as (device_param, gpu_args, pin_args):
+            cmd = (f"wdirs='{' '.join(wdirs_to_run)}' logs='{logs}' ncpu={ncpu} compute_device={compute_device} "
+                   f"device_param={device_param} gpu_args={gpu_args} pin_args={pin_args} "
+                   f"cpt_interval={cpt_interval} analysis_dirname={analysis_dirname} mpirun='{mpirun}' "
+                   f"bash {os.path.join(project_dir, 'scripts/script_sh/equlibration_multidir.sh')}")
+            finished = run_check_subprocess(cmd, ' '.join(wdirs_to_run), log=os.path.join(wdirs_to_run[0], bash_log),
+                                            env=env, stage='equilibration')
+        if not finished:
+            # a single failed system stops all ranks, so the others are not lost with it
+            for wdir in wdirs_to_run:
+                if not os.path.isfile(os.path.join(wdir, 'npt.gro')):
+                    logging.warning(f'{wdir}. Equilibration by mdrun -multidir failed and will be run separately')
+                    run_equilibration(wdir, project_dir=project_dir, bash_log=bash_log, ncpu=ncpu,
+                                      compute_device=compute_device, mdrun_settings=mdrun_settings,
+                                      analysis_dirname=analysis_dirname, cpt_interval=cpt_interval, env=env)
+
+    res = [wdir if os.path.isfile(os.path.join(wdir, 'npt.gro')) and os.path.isfile(os.path.join(wdir, 'npt.cpt'))
+           else None for wdir in wdirs]
+    return res if any(res) else None
+
+
+def run_simulation_multidir(wdirs, project_dir, bash_log, mdtime_ns,
+                            tpr, cpt, xtc, deffnm, deffnm_next, ncpu,
+                            compute_device, mdrun_settings, cpt_interval=15, mdrun_tuning=None, early_stop=None,
+                            insitu_analysis=None, mpirun='mpirun', env=None):
+    '''
+    MD simulation of several systems by a single gmx_mpi mdrun -multidir launch (one rank per system),
+    ranks share cores and GPUs of the slot. Already started simulations are continued one by one by run_simulation,
+    the same is done for unfinished simulations if the launch fails
+    :param wdirs: tuple of directories of complexes
+    :param early_stop: applied only to simulations continued by run_simulation, ranks of -multidir run are not stopped
+    :param insitu_analysis: applied only to simulations continued by run_simulation
+    :param mpirun: MPI launcher of gmx_mpi
+    :return: list of (wdir, deffnm) (None if simulation of the complex failed) for each directory
+             or None if all of them failed
+    '''
+    res = {}
+    wdirs_to_run = []
+    for wdir in wdirs:
+        if is_simulation_started(wdir, tpr, cpt, xtc, deffnm):
+            res[wdir] = run_simulation(wdir, project_dir=project_dir, bash_log=bash_log, mdtime_ns=mdtime_ns,
+                                       tpr=tpr, cpt=cpt, xtc=xtc, deffnm=deffnm, deffnm_next=deffnm_next, ncpu=ncpu,
+                                       compute_device=compute_device, mdrun_settings=mdrun_settings,
+                                       cpt_interval=cpt_interval, mdrun_tuning=mdrun_tuning,
+                                       early_stop=early_stop, insitu_analysis=insitu_analysis, env=env)
+        else:
+            wdirs_to_run.append(wdir)
+
+    if wdirs_to_run:
+        logs = ' '.join(os.path.join(wdir, bash_log) for wdir in wdirs_to_run)
+        with mdrun_slot(ncpu=ncpu, compute_device=compute_device,
+                        get_args=partial(get_multidir_mdrun_args, nsim=len(wdirs_to_run)),
+                        **mdrun_settings) as (device_param, gpu_args, pin_args):
+            cmd = (f"wdirs='{' '.join(wdirs_to_run)}' logs='{logs}' ncpu={ncpu} deffnm={deffnm} "
+                   f"compute_device={compute_device} device_param={device_param} gpu_args={gpu_args} "
+                   f"pin_args={pin_args} cpt_interval={cpt_interval} mpirun='{mpirun}' "
+                   f"bash {os.path.join(project_dir, 'scripts/script_sh/md_multidir.sh')}")
+            finished = run_check_subprocess(cmd, ' '.join(wdirs_to_run), log=os.path.join(wdirs_to_run[0], bash_log),
+                                            env=env, stage='simulation')
+        # confout of mdrun is written only at the end of the run
+        for wdir in wdirs_to_run:
+            res[wdir] = (wdir, deffnm) if os.path.isfile(os.path.join(wdir, f'{deffnm}.gro')) else None
+            if res[wdir] is None and not finished:
+                # a single failed system stops all ranks, the others are continued from their checkpoints
+                logging.warning(f'{wdir}. Simulation by mdrun -multidir failed and will be run separately')
+                res[wdir] = run_simulation(wdir, project_dir=project_dir, bash_log=bash_log, mdtime_ns=mdtime_ns,
+                                           tpr=tpr, cpt=cpt, xtc=xtc, deffnm=deffnm, deffnm_next=deffnm_next,
+                                           ncpu=ncpu, compute_device=compute_device, mdrun_settings=mdrun_settings,
+                                           cpt_interval=cpt_interval, mdrun_tuning=mdrun_tuning,
+                                           early_stop=early_stop, insitu_analysis=insitu_analysis, env=env)
+
+    res = [res[wdir] for wdir in wdirs]
+    return res if any(res) else None
+
+
 def continue_md_from_dir(wdir_to_continue, tpr, cpt, xtc, deffnm, deffnm_next,
                          mdtime_ns, project_dir, bash_log, ncpu, compute_device,
-                         device_param, gpu_args, env=None):
+                         mdrun_settings, cpt_interval=15, mdrun_tuning=None, insitu_analysis=None, env=None):
     def continue_md(tpr, cpt, xtc, wdir, new_mdtime_ps, deffnm_next, project_dir, bash_log, compute_device, env):
-        cmd = f'wdir={wdir} tpr={tpr} cpt={cpt} xtc={xtc} new_mdtime_ps={new_mdtime_ps} ' \
-              f'deffnm_next={deffnm_next} ncpu={ncpu} compute_device={compute_device} device_param={device_param} gpu_args={gpu_args} bash {os.path.join(project_dir, "scripts/script_sh/continue_md.sh")}' \
-              f'>> {os.path.join(wdir, bash_log)} 2>&1'
-        if run_check_subprocess(cmd, wdir, log=os.path.join(wdir, bash_log), env=env):
-            return wdir
+        tuning = partial(tune_mdrun, wdir=wdir, tpr=tpr, bash_log=bash_log, env=env,
+                         **mdrun_tuning) if mdrun_tuning else None
+        with mdrun_slot(ncpu=ncpu, compute_device=compute_device, get_args=tuning,
+                        **mdrun_settings) as (device_param, gpu_args, pin_args):
+            cmd = f'wdir={wdir} tpr={tpr} cpt={cpt} xtc={xtc} new_mdtime_ps={new_mdtime_ps} ' \
+                  f'deffnm_next={deffnm_next} ncpu={ncpu} compute_device={compute_device} device_param={device_param} gpu_args={gpu_args} pin_args={pin_args} ' \
+                  f'cpt_interval={cpt_interval} bash {os.path.join(project_dir, "scripts/script_sh/continue_md.sh")}' \
+                  f'>> {os.path.join(wdir, bash_log)} 2>&1'
+            monitors = [partial(run_insitu_analysis, wdir=wdir, deffnm=deffnm, deffnm_next=deffnm_next, tpr=tpr, xtc=xtc,
+                                **insitu_analysis)] if insitu_analysis else []
+            if run_with_monitors(cmd, wdir, log=os.path.join(wdir, bash_log), env=env, monitors=monitors,
+                                 stage='simulation'):
+                return wdir
         return None
 
     if tpr is None:
@@ -188,10 +370,12 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
           tpr_prev, cpt_prev, xtc_prev, ligand_list_file_prev, ligand_resid,
           activate_gaussian, gaussian_exe, gaussian_basis, gaussian_memory,
           metal_resnames, metal_charges, mcpbpy_cut_off,
-          seed, steps, hostfile, ncpu, mdrun_per_node, compute_device, gpu_ids, ntmpi_per_gpu, clean_previous,
+          seed, steps, dask_client, ncpu, mdrun_per_node, compute_device, gpu_ids, ntmpi_per_gpu, clean_previous,
           not_clean_backup_files, unique_id,
-          active_site_dist=5.0, save_traj_without_water=False,
-          mdp_dir=None, bash_log=None):
+          active_site_dist=5.0, save_traj_without_water=False, coordinate_cache=False,
+          mdp_dir=None, bash_log=None, pipeline=False, max_retries=2, cpt_interval=15, state_db=None,
+          mdrun_tuning=None, multidir=1, mpirun='mpirun', replicas=1, early_stop=None, insitu_analysis=False,
+          analysis_ncpu=1):
     '''
     :param protein: protein file - pdb or gro format
     :param wdir: None or path
@@ -213,7 +397,8 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
     :param xtc_prev: None or file
     :param ligand_resid: UNL. Used for md analysis only if continue simulation
     :param ligand_list_file_prev: None or file
-    :param hostfile: None or file
+    :param dask_client: executor (or dask client) shared by all steps of the run. Workers should be tagged by CPU
+                        (and GPU) resources, see init_executor
     :param ncpu:
     :param compute_device:
     :param gpu_ids:
@@ -222,6 +407,26 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
     :param bash_log:
     :param mdp_dir:
     :param not_clean_backup_files:
+    :param pipeline: boolean. Move each complex to the next step (ligand preparation, complex preparation,
+                     equilibration, simulation, analysis) as soon as its own previous step is finished
+                     instead of waiting for all complexes at each step
+    :param max_retries: the number of times a failed or lost equilibration or simulation task is resubmitted.
+                        The resubmitted task continues from the last checkpoint
+    :param cpt_interval: checkpoint interval of gmx mdrun in minutes
+    :param state_db: None or file. SQLite database to save the state of each task as soon as it is finished.
+                     Already finished tasks are skipped on restart
+    :param mdrun_tuning: None or dict of cache_file and nsteps. Run short benchmarks to select the fastest
+                         launch parameters of mdrun for each system size class and hardware before production runs
+    :param multidir: the number of complexes simulated by a single gmx_mpi mdrun -multidir launch
+                     (1 - each complex is simulated by its own mdrun)
+    :param mpirun: MPI launcher of gmx_mpi used if multidir > 1
+    :param replicas: the number of independent replicas of each complex. Prepared complexes are cloned before
+                     equilibration and each replica gets its own gen_seed
+    :param early_stop: None or dict of threshold (A) and window_ns. The trajectory of each production run is
+                       monitored and mdrun is stopped if the ligand RMSD exceeds the threshold for the window
+    :param insitu_analysis: boolean. Calculate RMSD, radius of gyration and RMSF while mdrun is writing
+                            the trajectory, the analysis step only writes the trajectories and plots
+    :param analysis_ncpu: number of processes used to post-process each trajectory by time blocks
     :return:
     '''
 
@@ -232,25 +437,39 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
     wdir_md = os.path.join(wdir, 'md_files', 'md_run')
     analysis_dirname = 'md_analysis'
 
-    dask_client, cluster = None, None
-
-    # GPU calculations settings
-    gpu_args = ''
-    # To set where to execute (cpu or gpu) the interactions and update steps during gmx mdrun
-    device_param = f"-update {compute_device} -pme {compute_device} -bonded {compute_device} -pmefft {compute_device}"
-
-    if compute_device == 'gpu' or gpu_ids:
-        ngpus = len(gpu_ids) if gpu_ids else 1
-        # https://gromacs.bioexcel.eu/t/using-multiple-gpus-on-one-machine/5974
-        k = ngpus * ntmpi_per_gpu
-        if k > 1:
-            device_param = f"{device_param} -npme 1"
-        gpu_args = f"-ntmpi {k} -ntomp {(ncpu // k) // mdrun_per_node}"
-        if gpu_ids:
-            gpu_args = gpu_args + f" -gpu_id {','.join(gpu_ids)}"
-        gpu_args = f"'{gpu_args}'"
-
-    device_param = f"'{device_param}'"
+    var_md_analysis_res = []
+
+    if replicas > 1 and pipeline:
+        logging.warning('--pipeline is not supported with --replicas. Steps will be run one after another')
+        pipeline = False
+
+    if state_db is not None:
+        init_state_db(state_db)
+        init_performance_table(state_db)
+        if clean_previous and (steps is None or 1 in steps) and wdir_to_continue_list is None:
+            # directories of complexes are prepared again, so all their steps should be run again
+            reset_state_db(state_db, ['complex', 'equilibration', 'simulation', 'analysis'])
+    # a finished task is reused on restart only if these parameters (or inputs) of its step were not changed
+    state_signatures = {'ligand': partial(get_ligand_signature, no_dr=no_dr),
+                        'equilibration': f'nvt_time={nvt_time_ps};npt_time={npt_time_ps}',
+                        'simulation': f'md_time={mdtime_ns};deffnm={deffnm}',
+                        'analysis': f'md_time={mdtime_ns}'}
+
+    # resources of dask workers required by a single task of each step
+    worker_resources = get_worker_resources(dask_client)
+    ncpu_per_worker = worker_resources.get('CPU', ncpu // mdrun_per_node)
+    light_task_resources = {'CPU': 1}
+    analysis_ncpu = max(1, min(analysis_ncpu, ncpu_per_worker))
+    analysis_resources = {'CPU': analysis_ncpu}
+    # mdrun uses all cores of the worker also on GPU, so other tasks should not be placed on the same worker
+    mdrun_resources = {'CPU': ncpu_per_worker}
+    if 'GPU' in worker_resources:
+        mdrun_resources['GPU'] = 1
+
+    # GPU calculations settings. Each simultaneous mdrun on a server locks its own slot
+    # and uses its own subset of GPUs (all GPUs are shared if there are less GPUs than mdrun_per_node)
+    mdrun_settings = dict(ntmpi_per_gpu=ntmpi_per_gpu, gpu_ids=gpu_ids, nslots=mdrun_per_node,
+                          lock_dir=get_lock_dir(unique_id))
 
     # Start
     if tpr_prev is None or cpt_prev is None or xtc_prev is None:
@@ -280,7 +499,8 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
                         cmd = f'gmx pdb2gmx -f {protein} -o {os.path.join(wdir_protein, pname)}.gro -water tip3p {"-ignh" if not noignh else "-noignh"} ' \
                               f'-i {os.path.join(wdir_protein, "posre.itp")} ' \
                               f'-p {os.path.join(wdir_protein, "topol.top")} -ff {forcefield_name} >> {os.path.join(wdir_protein, bash_log)} 2>&1'
-                        if not run_check_subprocess(cmd, protein, log=os.path.join(wdir_protein, bash_log), env=os.environ.copy()):
+                        if not run_check_subprocess(cmd, protein, log=os.path.join(wdir_protein, bash_log), env=os.environ.copy(),
+                                                    stage='protein'):
                             return None
                         logging.info(f'Successfully finished protein preparation\n')
                     else:
@@ -323,7 +543,8 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
                                                          project_dir=project_dir, wdir_ligand=wdir_system_ligand, no_dr=no_dr,
                                                          gaussian_exe=gaussian_exe, activate_gaussian=activate_gaussian,
                                                          gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
-                                                         hostfile=hostfile, ncpu=ncpu, bash_log=bash_log)
+                                                         dask_client=dask_client, ncpu=ncpu_per_worker, bash_log=bash_log,
+                                                         state_db=state_db, state_stage='cofactor')
                 if number_of_mols != len(system_lig_wdirs):
                     logging.exception(f'Error with the cofactor preparation. Only {len(system_lig_wdirs)} from {number_of_mols} preparation were finished.'
                                       f' The calculation will be interrupted')
@@ -333,6 +554,7 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
             else:
                 system_lig_wdirs = []
 
+            pipeline_items = []
             if lfile is not None:
                 logging.info('Start ligand preparation')
                 number_of_mols, problem_mols = check_mols(lfile)
@@ -340,151 +562,292 @@ def start(protein, wdir, lfile, system_lfile, noignh, no_dr,
                     logging.warning(f'Ligand molecules: {problem_mols} from {lfile} cannot be processed.'
                                     f' Such molecules will be skipped.')
 
-                var_lig_wdirs = prepare_input_ligands(lfile, preset_resid=ligand_resid, protein_resid_set=protein_resid_set, script_path=script_path,
-                                                      project_dir=project_dir, wdir_ligand=wdir_ligand, no_dr=no_dr,
-                                                      gaussian_exe=gaussian_exe, activate_gaussian=activate_gaussian,
-                                                      gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
-                                                      hostfile=hostfile, ncpu=ncpu, bash_log=bash_log)
-                if number_of_mols != len(var_lig_wdirs):
-                    logging.warning(f'Problem with the ligand preparation. Only {len(var_lig_wdirs)} from {number_of_mols} preparation were finished.'
-                                    f' Such molecules will be skipped.')
-
-                logging.info(f'Successfully finished {len(var_lig_wdirs)} ligand preparation\n')
+                if pipeline and not lfile.endswith('.mol2'):
+                    # standard molecules will be prepared as the first stage of the pipeline,
+                    # boron-containing ones require the whole server for Gaussian and are prepared in advance
+                    standard_mols, boron_containing_mols = split_mols_by_preparation_type(lfile, preset_resid=ligand_resid,
+                                                                                          protein_resid_set=protein_resid_set)
+                    var_lig_wdirs = prepare_boron_containing_mols(boron_containing_mols, ligand_fname=lfile,
+                                                                  script_path=script_path, project_dir=project_dir,
+                                                                  wdir_ligand=wdir_ligand, gaussian_exe=gaussian_exe,
+                                                                  activate_gaussian=activate_gaussian,
+                                                                  gaussian_basis=gaussian_basis,
+                                                                  gaussian_memory=gaussian_memory,
+                                                                  dask_client=dask_client, ncpu=ncpu_per_worker, bash_log=bash_log,
+                                                                  state_db=state_db)
+                    pipeline_items.extend(('ligand', mol_tuple) for mol_tuple in standard_mols)
+                    logging.info(f'{len(standard_mols)} ligands will be prepared in the pipeline mode\n')
+                else:
+                    var_lig_wdirs = prepare_input_ligands(lfile, preset_resid=ligand_resid, protein_resid_set=protein_resid_set, script_path=script_path,
+                                                          project_dir=project_dir, wdir_ligand=wdir_ligand, no_dr=no_dr,
+                                                          gaussian_exe=gaussian_exe, activate_gaussian=activate_gaussian,
+                                                          gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
+                                                          dask_client=dask_client, ncpu=ncpu_per_worker, bash_log=bash_log,
+                                                          state_db=state_db)
+                    if number_of_mols != len(var_lig_wdirs):
+                        logging.warning(f'Problem with the ligand preparation. Only {len(var_lig_wdirs)} from {number_of_mols} preparation were finished.'
+                                        f' Such molecules will be skipped.')
+
+                    logging.info(f'Successfully finished {len(var_lig_wdirs)} ligand preparation\n')
             else:
                 var_lig_wdirs = [[]]  # run protein in water only simulation
 
-            if not var_lig_wdirs:
+            if not var_lig_wdirs and not pipeline_items:
                 return None
+
             # Part 2 Complex preparation
-            try:
+            # Part 2.1 MCPBPY Metal-Complex preparation
+            if metal_resnames and gaussian_exe and activate_gaussian:
+                complex_prep_func = mcbpy_md.main
+                complex_prep_kwargs = dict(protein_name=pname, protein_file=protein,
+                                           metal_resnames=metal_resnames, metal_charges=metal_charges,
+                                           wdir_metal=wdir_metal, system_lig_wdirs=system_lig_wdirs,
+                                           wdir_md=wdir_md, script_path=script_path, ncpu=ncpu_per_worker,
+                                           activate_gaussian=activate_gaussian, gaussian_version=gaussian_exe,
+                                           gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
+                                           bash_log=bash_log, seed=seed, nvt_time_ps=nvt_time_ps, npt_time_ps=npt_time_ps,
+                                           mdtime_ns=mdtime_ns, cut_off=mcpbpy_cut_off, env=os.environ.copy())
+                complex_prep_resources = get_gaussian_resources(dask_client, ncpu=ncpu_per_worker,
+                                                                gaussian_memory=gaussian_memory)
+            else:
+                complex_prep_func = run_complex_preparation
+                complex_prep_kwargs = dict(wdir_system_ligand_list=system_lig_wdirs,
+                                           protein_name=pname, wdir_protein=wdir_protein,
+                                           clean_previous=clean_previous, wdir_md=wdir_md,
+                                           script_path=script_mdp_path, project_dir=project_dir, mdtime_ns=mdtime_ns,
+                                           npt_time_ps=npt_time_ps, nvt_time_ps=nvt_time_ps,
+                                           mdp_dir=mdp_dir, bash_log=bash_log, seed=seed, env=os.environ.copy())
+                complex_prep_resources = light_task_resources
+            # a prepared complex is reused if files of the protein, cofactors and its ligand
+            # and parameters of the preparation were not changed
+            complex_signature = get_input_signature(files=[protein], dirs=[wdir_protein, *system_lig_wdirs],
+                                                    **{k: v for k, v in complex_prep_kwargs.items() if k != 'env'})
+            state_signatures['complex'] = lambda wdir_var_ligand: get_input_signature(
+                dirs=[wdir_var_ligand] if isinstance(wdir_var_ligand, str) else [], complex=complex_signature)
+
+            if pipeline:
+                pipeline_items.extend(('complex', i) for i in var_lig_wdirs)
+                var_complex_prepared_dirs = []
+            else:
                 # make all.itp and create complex
                 logging.info('Start complex preparation')
-                var_complex_prepared_dirs = []
-    # check conflict
-                # Part 2.1 MCPBPY Metal-Complex preparation
-                if metal_resnames and gaussian_exe and activate_gaussian:
+                var_complex_prepared_dirs, var_lig_wdirs_to_run = split_finished_tasks(state_db, 'complex', var_lig_wdirs,
+                                                                                       state_signatures['complex'])
+                if complex_prep_func is mcbpy_md.main:
                     logging.info('Start MCPBPY procedure')
-                    dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                             n_tasks_per_node=1,
-                                                             use_multi_servers=True if len(var_lig_wdirs) > ncpu else False,
-                                                             ncpu=ncpu)
-                    for res in calc_dask(mcbpy_md.main, var_lig_wdirs, dask_client,
-                                  protein_name=pname, protein_file=protein,
-                                  metal_resnames=metal_resnames, metal_charges=metal_charges,
-                                  wdir_metal=wdir_metal, system_lig_wdirs=system_lig_wdirs,
-                                  wdir_md=wdir_md, script_path=script_path, ncpu=ncpu,
-                                  activate_gaussian=activate_gaussian, gaussian_version=gaussian_exe,
-                                  gaussian_basis=gaussian_basis, gaussian_memory=gaussian_memory,
-                                  bash_log=bash_log, seed=seed, nvt_time_ps=nvt_time_ps, npt_time_ps=npt_time_ps,
-                                  mdtime_ns=mdtime_ns, cut_off=mcpbpy_cut_off, env=os.environ.copy()):
-                        if res:
-                            var_complex_prepared_dirs.append(res)
-
+                for res in calc_dask(complex_prep_func, var_lig_wdirs_to_run, dask_client,
+                                     resources=complex_prep_resources,
+                                     task_callback=get_task_callback(state_db, 'complex',
+                                                                     state_signatures['complex']),
+                                     **complex_prep_kwargs):
+                    if res:
+                        var_complex_prepared_dirs.append(res)
+
+                if complex_prep_func is mcbpy_md.main:
                     logging.info('MCPBPY procedure: Finish MCPBPY preparation')
-                else:
-                    dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                             n_tasks_per_node=min(ncpu, len(var_lig_wdirs)),
-                                                             use_multi_servers=True if len(var_lig_wdirs) > ncpu else False,
-                                                             ncpu=ncpu)
-                    for res in calc_dask(run_complex_preparation, var_lig_wdirs, dask_client,
-                                         wdir_system_ligand_list=system_lig_wdirs,
-                                         protein_name=pname, wdir_protein=wdir_protein,
-                                         clean_previous=clean_previous, wdir_md=wdir_md,
-                                         script_path=script_mdp_path, project_dir=project_dir, mdtime_ns=mdtime_ns,
-                                         npt_time_ps=npt_time_ps, nvt_time_ps=nvt_time_ps,
-                                         mdp_dir=mdp_dir, bash_log=bash_log, seed=seed, env=os.environ.copy()):
-                        if res:
-                            var_complex_prepared_dirs.append(res)
-
                 logging.info(f'Successfully finished {len(var_complex_prepared_dirs)} complexes preparation\n')
-            finally:
-                if dask_client:
-                    dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                               close_workers=True, remove=True)
-                    dask_client.shutdown()
-                if cluster:
-                    cluster.close()
 
         else:
             var_complex_prepared_dirs = wdir_to_continue_list
 
+        equilibration_kwargs = dict(project_dir=project_dir, bash_log=bash_log,
+                                    ncpu=ncpu//mdrun_per_node, compute_device=compute_device,
+                                    mdrun_settings=mdrun_settings, cpt_interval=cpt_interval,
+                                    analysis_dirname=analysis_dirname,
+                                    env=os.environ.copy())
+        simulation_kwargs = dict(project_dir=project_dir, bash_log=bash_log,
+                                 mdtime_ns=mdtime_ns,
+                                 tpr=tpr_prev, cpt=cpt_prev, xtc=xtc_prev,
+                                 deffnm=deffnm, deffnm_next=f'{deffnm}_cont_{unique_id}',
+                                 ncpu=ncpu//mdrun_per_node, compute_device=compute_device,
+                                 mdrun_settings=mdrun_settings, cpt_interval=cpt_interval,
+                                 mdrun_tuning=mdrun_tuning,
+                                 early_stop=dict(early_stop, ligand_resid=ligand_resid) if early_stop else None,
+                                 insitu_analysis=dict(ligand_resid=ligand_resid, active_site_dist=active_site_dist,
+                                                      ligand_list_file=ligand_list_file_prev,
+                                                      analysis_dirname=analysis_dirname) if insitu_analysis else None,
+                                 env=os.environ.copy())
+
+        if replicas > 1 and (steps is None or 2 in steps):
+            # directories of already created replicas can be passed to continue the run
+            var_complex_prepared_dirs = list(dict.fromkeys(
+                replica_dir for wdir_md_cur in var_complex_prepared_dirs
+                for replica_dir in (make_replicas(wdir_md_cur, replicas=replicas, seed=seed, deffnm=deffnm)
+                                    if split_replica_name(os.path.basename(wdir_md_cur))[1] == 1 else [wdir_md_cur])))
+            logging.info(f'{replicas} replicas of each complex will be simulated\n')
+
+        # several complexes of similar size are simulated by a single mdrun -multidir launch,
+        # results of each complex are returned separately
+        if multidir > 1 and pipeline:
+            logging.warning('--multidir is not supported in pipeline mode and will be ignored')
+            multidir = 1
+        if multidir > 1 and early_stop:
+            logging.warning('Early stop is not applied to simulations run by mdrun -multidir')
+        if multidir > 1 and insitu_analysis:
+            logging.warning('In-situ analysis is not applied to simulations run by mdrun -multidir')
+        run_mdrun_tasks = partial(calc_dask_groups, group_size=multidir) if multidir > 1 else calc_dask
+        multidir_kwargs = dict(mpirun=mpirun) if multidir > 1 else {}
+
         # Part 3. Equilibration and MD simulation. Run on all cpu
         var_eq_dirs = []
         var_md_dirs_deffnm = []
-        if (steps is None or 2 in steps or 3 in steps) and var_complex_prepared_dirs:
-            try:
-                dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                         n_tasks_per_node=mdrun_per_node,
-                                                         use_multi_servers=True if len(var_complex_prepared_dirs) > 1 else False,
-                                                         ncpu=ncpu)
-                if steps is None or 2 in steps:
-                    logging.info('Start Equilibration steps')
-                    for res in calc_dask(run_equilibration, var_complex_prepared_dirs, dask_client,
-                                         project_dir=project_dir, bash_log=bash_log,
-                                         ncpu=ncpu//mdrun_per_node, compute_device=compute_device,
-                                         device_param=device_param, gpu_args=gpu_args,
-                                         analysis_dirname=analysis_dirname,
-                                         env=os.environ.copy()):
-                        if res:
-                            var_eq_dirs.append(res)
-                    logging.info(f'Successfully finished {len(var_eq_dirs)} Equilibration step\n')
-                else:
-                    var_eq_dirs = wdir_to_continue_list
-
-                if steps is None or 3 in steps:
-                    logging.info('Start Simulation step')
-                    for res in calc_dask(run_simulation, var_eq_dirs, dask_client,
-                                         project_dir=project_dir, bash_log=bash_log,
-                                         mdtime_ns=mdtime_ns,
-                                         tpr=tpr_prev, cpt=cpt_prev, xtc=xtc_prev,
-                                         deffnm=deffnm, deffnm_next=f'{deffnm}_cont_{unique_id}',
-                                         ncpu=ncpu//mdrun_per_node, compute_device=compute_device,
-                                         device_param=device_param, gpu_args=gpu_args,
-                                         env=os.environ.copy()):
-                        if res:
-                            var_md_dirs_deffnm.append(res)
-                    logging.info(
-                        f'Simulation of {len(var_md_dirs_deffnm)} complexes were successfully finished\nFinished: {var_md_dirs_deffnm}\n')
-
-            finally:
-                if dask_client:
-                    dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                               close_workers=True, remove=True)
-                    dask_client.shutdown()
-                if cluster:
-                    cluster.close()
-
+        if pipeline:
+            stages = []
+            if (steps is None or 1 in steps) and wdir_to_continue_list is None:
+                set_mol_pickle_properties()
+                stages.append(('ligand', prep_ligand,
+                               dict(script_path=script_path, project_dir=project_dir,
+                                    wdir_ligand=wdir_ligand, no_dr=no_dr,
+                                    conda_env_path=os.environ["CONDA_PREFIX"],
+                                    ncpu=ncpu_per_worker, bash_log=bash_log, env=os.environ.copy()),
+                               light_task_resources, estimate_ligand_cost, 0))
+                stages.append(('complex', complex_prep_func, complex_prep_kwargs, complex_prep_resources, None, 0))
+            else:
+                entry_stage = 'equilibration' if steps is None or 2 in steps else \
+                    'simulation' if 3 in steps else 'analysis'
+                entry_args = wdir_to_continue_list if entry_stage != 'analysis' else \
+                    [(i, deffnm) for i in wdir_to_continue_list]
+                pipeline_items = [(entry_stage, i) for i in entry_args]
+            if steps is None or 2 in steps:
+                stages.append(('equilibration', run_equilibration, equilibration_kwargs, mdrun_resources,
+                               estimate_equilibration_cost, max_retries))
+            if steps is None or 3 in steps:
+                stages.append(('simulation', run_simulation, simulation_kwargs, mdrun_resources,
+                               estimate_simulation_cost, max_retries))
+            if steps is None or 4 in steps:
+                stages.append(('analysis', run_md_analysis,
+                               dict(mdtime_ns=mdtime_ns, project_dir=project_dir,
+                                    bash_log=bash_log, ligand_resid=ligand_resid,
+                                    ligand_list_file_prev=ligand_list_file_prev,
+                                    save_traj_without_water=save_traj_without_water,
+                                    coordinate_cache=coordinate_cache,
+                                    analysis_dirname=analysis_dirname, ncpu=analysis_ncpu,
+                                    env=os.environ.copy()),
+                               analysis_resources, estimate_analysis_cost, 0))
+            stage_names = [i[0] for i in stages]
+            var_md_analysis_res = []
+            if pipeline_items:
+                logging.info(f'Start pipeline: {", ".join(stage_names)}')
+                # the later stages first, the longest tasks of each stage first
+                main_arg = []
+                for stage_index in reversed(range(len(stages))):
+                    stage_args = [arg for name, arg in pipeline_items if name == stage_names[stage_index]]
+                    if stages[stage_index][4]:
+                        stage_args = sort_by_cost(stage_args, stages[stage_index][4])
+                    main_arg.extend((stage_index, arg) for arg in stage_args)
+
+                stage_results = {'complex': var_complex_prepared_dirs, 'equilibration': var_eq_dirs,
+                                 'simulation': var_md_dirs_deffnm, 'analysis': var_md_analysis_res}
+                # skip already finished stages of each chain
+                signatures = [state_signatures.get(name) for name in stage_names]
+                finished_tasks = [get_finished_tasks(state_db, name, signature)
+                                  for name, signature in zip(stage_names, signatures)]
+                main_arg_to_run = []
+                for stage_index, arg in main_arg:
+                    finished, stage_index, arg = get_resume_point(finished_tasks, stage_index, arg, signatures)
+                    for finished_stage_index, _, res in finished:
+                        stage_results.get(stage_names[finished_stage_index], []).append(res)
+                    if stage_index is not None:
+                        main_arg_to_run.append((stage_index, arg))
+                if len(main_arg_to_run) != len(main_arg) or any(finished_tasks):
+                    logging.info(f'Already finished tasks were found in {state_db}. '
+                                 f'{len(main_arg_to_run)} from {len(main_arg)} complexes will be continued')
+
+                def save_state(stage_index, arg, res, task_info):
+                    stage_name = stage_names[stage_index]
+                    save_task_state(state_db, stage_name, arg, 'done' if res else 'failed', output=res,
+                                    signature=state_signatures.get(stage_name), task_info=task_info)
+                    if res and stage_name in ('equilibration', 'simulation'):
+                        harvest_mdrun_logs(state_db, res if isinstance(res, str) else res[0],
+                                           host=task_info.get('host'))
+
+                for stage_index, arg, res in calc_dask_pipeline(
+                        stages=[i[1:] for i in stages],
+                        main_arg=main_arg_to_run,
+                        dask_client=dask_client,
+                        task_callback=save_state if state_db is not None else None):
+                    if not res:
+                        continue
+                    stage_results.get(stage_names[stage_index], []).append(res)
+
+            logging.info(f'Pipeline finished. Successfully prepared complexes: {len(var_complex_prepared_dirs)}, '
+                         f'equilibrated: {len(var_eq_dirs)}, simulated: {len(var_md_dirs_deffnm)}, '
+                         f'analysed: {len(var_md_analysis_res)}\n')
+
+        elif (steps is None or 2 in steps or 3 in steps) and var_complex_prepared_dirs:
+            if steps is None or 2 in steps:
+                logging.info('Start Equilibration steps')
+                var_eq_dirs, var_complex_dirs_to_run = split_finished_tasks(state_db, 'equilibration',
+                                                                            var_complex_prepared_dirs,
+                                                                            state_signatures['equilibration'])
+                for res in run_mdrun_tasks(run_equilibration_multidir if multidir > 1 else run_equilibration,
+                                           sort_by_cost(var_complex_dirs_to_run, estimate_equilibration_cost),
+                                           dask_client,
+                                           resources=mdrun_resources, max_retries=max_retries,
+                                           task_callback=get_harvest_callback(
+                                               state_db, get_task_callback(state_db, 'equilibration',
+                                                                           state_signatures['equilibration'])),
+                                           **equilibration_kwargs, **multidir_kwargs):
+                    if res:
+                        var_eq_dirs.append(res)
+                logging.info(f'Successfully finished {len(var_eq_dirs)} Equilibration step\n')
+            else:
+                var_eq_dirs = wdir_to_continue_list
+
+            if steps is None or 3 in steps:
+                logging.info('Start Simulation step')
+                var_md_dirs_deffnm, var_eq_dirs_to_run = split_finished_tasks(state_db, 'simulation', var_eq_dirs,
+                                                                              state_signatures['simulation'])
+                for res in run_mdrun_tasks(run_simulation_multidir if multidir > 1 else run_simulation,
+                                           sort_by_cost(var_eq_dirs_to_run, estimate_simulation_cost),
+                                           dask_client,
+                                           resources=mdrun_resources, max_retries=max_retries,
+                                           task_callback=get_harvest_callback(
+                                               state_db, get_task_callback(state_db, 'simulation',
+                                                                           state_signatures['simulation'])),
+                                           **simulation_kwargs, **multidir_kwargs):
+                    if res:
+                        var_md_dirs_deffnm.append(res)
+                logging.info(
+                    f'Simulation of {len(var_md_dirs_deffnm)} complexes were successfully finished\nFinished: {var_md_dirs_deffnm}\n')
 
         elif 4 in steps:
             var_md_dirs_deffnm = [(i, deffnm) for i in wdir_to_continue_list]
 
+        early_stopped = [i[0] for i in var_md_dirs_deffnm if is_early_stopped(*i)]
+        if early_stopped:
+            early_stopped_file = os.path.join(wdir, f'early_stopped_complexes_{unique_id}.txt')
+            with open(early_stopped_file, 'w') as output:
+                output.write('\n'.join(early_stopped))
+            logging.warning(f'Simulations of {len(early_stopped)} complexes were stopped early because of unstable '
+                            f'ligands. They have been saved in {early_stopped_file} file')
+
+        performance_file = write_performance_summary(state_db, os.path.join(wdir, f'mdrun_performance_{unique_id}.csv'))
+        if performance_file:
+            logging.info(f'Throughput of MD simulations by system size and hardware was saved to {performance_file}')
+
     # Part 3. MD Analysis. Run on each cpu
     if (steps is None or 4 in steps) and var_md_dirs_deffnm:
-        logging.info('Start Analysis of the simulations')
-        var_md_analysis_res = []
-        try:
-            dask_client, cluster = init_dask_cluster(hostfile=hostfile,
-                                                     n_tasks_per_node=min(ncpu, len(var_md_dirs_deffnm)),
-                                                     use_multi_servers=True if len(var_md_dirs_deffnm) > ncpu else False,
-                                                     ncpu=ncpu)
-            for res in calc_dask(run_md_analysis, var_md_dirs_deffnm,
-                                 dask_client, mdtime_ns=mdtime_ns, project_dir=project_dir,
+        if not pipeline:
+            logging.info('Start Analysis of the simulations')
+            var_md_analysis_res, var_md_dirs_deffnm_to_run = split_finished_tasks(state_db, 'analysis',
+                                                                                  var_md_dirs_deffnm,
+                                                                                  state_signatures['analysis'])
+            for res in calc_dask(run_md_analysis, sort_by_cost(var_md_dirs_deffnm_to_run, estimate_analysis_cost),
+                                 dask_client, resources=analysis_resources,
+                                 task_callback=get_task_callback(state_db, 'analysis', state_signatures['analysis']),
+                                 mdtime_ns=mdtime_ns, project_dir=project_dir,
                                  bash_log=bash_log, ligand_resid=ligand_resid,
                                  ligand_list_file_prev=ligand_list_file_prev,
                                  save_traj_without_water=save_traj_without_water,
-                                 analysis_dirname=analysis_dirname,
+                                 coordinate_cache=coordinate_cache,
+                                 analysis_dirname=analysis_dirname, ncpu=analysis_ncpu,
                                  env=os.environ.copy()):
                 if res:
                     # (rmsd_out_file, md_analysis_dir, md_cur_wdir)
                     var_md_analysis_res.append(res)
-        finally:
-            if dask_client:
-                dask_client.retire_workers(dask_client.scheduler_info()['workers'],
-                                           close_workers=True, remove=True)
-                dask_client.shutdown()
-            if cluster:
-                cluster.close()
 
+    if (steps is None or 4 in steps) and var_md_analysis_res:
         rmsd_files = [i[0] for i in var_md_analysis_res]
         md_dirs_analyzed = [i[2] for i in var_md_analysis_res]
 
@@ -541,6 +904,23 @@ def main():
                              'passed as $PBS_NODEFILE variable from inside a PBS script. The first line in this file '
                              'will be the address of the scheduler running on the standard port 8786. If omitted, '
                              'calculations will run on a single machine as usual.')
+    parser1.add_argument('--executor', default='dask', choices=['auto', 'dask', 'local', 'batch'],
+                        help='Backend to run tasks. dask - dask cluster (a single server or servers from hostfile), '
+                             'local - a pool of processes on the current server without start up costs of dask, '
+                             'batch - each task (or a group of tasks, see --batch_pack) is submitted as a separate '
+                             'job of SLURM or PBS, so no allocation is held for the whole run, '
+                             'auto - dask if hostfile is set, local otherwise.')
+    parser1.add_argument('--batch_system', default='slurm', choices=['slurm', 'pbs'],
+                        help='Batch system used by the batch executor. sbatch/squeue/scancel or qsub/qstat/qdel '
+                             'commands are taken from PATH.')
+    parser1.add_argument('--batch_options', metavar='STRING', default='', type=str,
+                        help='Additional options of the job submission command of the batch executor, '
+                             'e.g. "-p short -t 04:00:00". Cores (ncpu / mdrun_per_node per task) and GPUs are '
+                             'requested automatically.')
+    parser1.add_argument('--batch_max_jobs', metavar='INTEGER', default=100, type=int,
+                        help='Maximal number of simultaneously submitted jobs of the batch executor.')
+    parser1.add_argument('--batch_pack', metavar='INTEGER', default=1, type=int,
+                        help='Maximal number of tasks run simultaneously within a single job of the batch executor.')
     parser1.add_argument('-c', '--ncpu', metavar='INTEGER', required=False,
                          default=len(os.sched_getaffinity(0)), #returns set of CPUs available
                          type=int, help='Number of CPU per server. Use all available cpus by default.')
@@ -612,6 +992,11 @@ def main():
     parser1.add_argument('--save_traj_without_water', action='store_true', default=False,
                          help='Save additional md_out_nowater.tpr and md_fit_nowater.xtc files '
                               'for more memory efficient analysis.')
+    parser1.add_argument('--coordinate_cache', action='store_true', default=False,
+                         help='Save coordinates of non-water atoms of md_fit.xtc to memory-mapped binary files '
+                              '(md_fit_coords.npy, md_fit_box.npy, md_fit_time.npy, md_fit_atoms.npy) after '
+                              'post-processing of the trajectory. RMSD and ProLIF analyses read frames from '
+                              'the cache instead of decoding xtc. The cache is ignored if md_fit.xtc was changed.')
     parser1.add_argument('--wdir_to_continue', metavar='DIRNAME', required=False, default=None, nargs='+',
                          type=partial(filepath_type, exist_type='dir'),
                          help='''Single or multiple directories contain simulations created by the tool.
@@ -620,6 +1005,71 @@ def main():
                                     File all_ligand_resid.txt is optional and used to run md analysis for the ligands.\n
                                     If you want to continue your own simulation not created by the tool use --tpr, --cpt, --xtc and --wdir or arguments 
                                     (--ligand_list_file is optional and required to run md analysis after simulation )''')
+    parser1.add_argument('--pipeline', action='store_true', default=False,
+                         help='Run the steps as a pipeline: each complex is moved to the next step '
+                              '(ligand preparation, complex preparation, equilibration, MD simulation, analysis) '
+                              'as soon as its own previous step is finished, so different complexes can be '
+                              'at different steps at the same time. By default, all complexes finish a step '
+                              'before the next step is started. The number of simultaneous equilibration and '
+                              'MD simulation runs is still limited by --mdrun_per_node per server.')
+    parser1.add_argument('--max_retries', metavar='INTEGER', required=False, default=2, type=int,
+                         help='The number of times a failed equilibration or MD simulation task (including tasks lost '
+                              'because of a died dask worker or server) is automatically resubmitted to another worker. '
+                              'The resubmitted task continues from the last checkpoint.')
+    parser1.add_argument('--state_db', metavar='FILENAME', required=False, default=None, type=str,
+                         help='SQLite database to save the state (status, timings, host, output files) of each task '
+                              'as soon as it is finished. Already finished tasks are skipped on restart without '
+                              'checking files of each complex. By default, streamd_state.db in the working directory.')
+    parser1.add_argument('--metrics_file', metavar='FILENAME', required=False, default=None, type=str,
+                         help='File to save wall time, cpu time, peak memory and block I/O of each call of external '
+                              'programs (gmx, antechamber, tleap, Gaussian, etc.) as JSON lines tagged by the stage '
+                              'and the directory of the complex. By default, streamd_metrics.jsonl in the working '
+                              'directory.')
+    parser1.add_argument('--cpt_interval', metavar='minutes', required=False, default=15, type=float,
+                         help='Checkpoint interval of gmx mdrun in minutes (gmx mdrun -cpt). '
+                              'Decrease it to lose less work if a job is preempted.')
+    parser1.add_argument('--tune_mdrun', action='store_true', default=False,
+                         help='Before production runs select the fastest launch parameters of gmx mdrun '
+                              '(thread-MPI ranks/OpenMP threads, separate PME ranks, nstlist and GPU offload of PME, '
+                              'update and bonded interactions) by short benchmark runs. The search is run once for '
+                              'each system size class and hardware, the results are cached and reused by later runs.')
+    parser1.add_argument('--tune_mdrun_nsteps', metavar='INTEGER', required=False, default=5000, type=int,
+                         help='Number of steps of each benchmark run of --tune_mdrun. The performance is measured '
+                              'on the second half of the steps.')
+    parser1.add_argument('--mdrun_tuning_cache', metavar='FILENAME', required=False, default=None, type=str,
+                         help='SQLite database to cache the fastest mdrun parameters found by --tune_mdrun. '
+                              'It should be shared by runs on the same cluster. '
+                              'By default, ~/.cache/streamd/mdrun_tuning.db')
+    parser1.add_argument('--multidir', metavar='INTEGER', required=False, default=1, type=int,
+                         help='Throughput mode for small systems. Equilibration and simulation of groups of up to '
+                              'this number of complexes of similar size are run by a single gmx_mpi mdrun -multidir '
+                              'launch with one rank per complex sharing cores and GPU(s) of a simulation slot. '
+                              'Requires MPI build of GROMACS (gmx_mpi). Not used in pipeline mode.')
+    parser1.add_argument('--mpirun', metavar='COMMAND', required=False, default='mpirun', type=str,
+                         help='MPI launcher of gmx_mpi used by --multidir, "-np <number of complexes>" is appended.')
+    parser1.add_argument('--replicas', metavar='INTEGER', required=False, default=1, type=int,
+                         help='Number of independent replicas of each complex. Each prepared complex is cloned '
+                              '(<complex>_replica2, ...) and replicas get distinct gen_seed of NVT '
+                              '(--seed + replica - 1 or random seeds if --seed is -1). Replicas are simulated as '
+                              'independent tasks and RMSD is aggregated across replicas (mean and SD between '
+                              'replicas). Pipeline mode is not used with replicas.')
+    parser1.add_argument('--early_stop_rmsd', metavar='FLOAT', required=False, default=None, type=float,
+                         help='Stop the production run of a complex if the ligand heavy-atom RMSD (after fitting on '
+                              'the backbone) exceeds this threshold in A for --early_stop_window ns. The trajectory '
+                              'is monitored while mdrun is running, mdrun is stopped with a checkpoint and '
+                              'stopped complexes are listed in early_stopped_complexes_*.txt. '
+                              'Not applied to --multidir runs.')
+    parser1.add_argument('--early_stop_window', metavar='FLOAT', required=False, default=1.0, type=float,
+                         help='Time in ns the ligand RMSD should be above --early_stop_rmsd to stop the simulation.')
+    parser1.add_argument('--insitu_analysis', action='store_true', default=False,
+                         help='Calculate RMSD, radius of gyration and RMSF of each complex from the trajectory while '
+                              'mdrun is writing it (including continued simulations). The analysis step then only '
+                              'post-processes the trajectory and makes plots. Not applied to --multidir runs.')
+    parser1.add_argument('--analysis_ncpu', metavar='INTEGER', required=False, default=1, type=int,
+                         help='Number of processes used to post-process each trajectory (PBC treatment and fitting) '
+                              'and to calculate RMSD at the analysis step. The trajectory is split into time blocks '
+                              'processed in parallel and the results are concatenated in order. Limited by the number '
+                              'of CPUs per task.')
     parser.add_argument('-o','--out_suffix', default=None,
                         help='User unique suffix for output files')
     # continue md
@@ -711,7 +1161,19 @@ def main():
         logging.warning('The number of available CPUs are less than specified value. '
                         f'The tool will use only {ncpu} CPUs.')
 
+    metrics_file = init_metrics_file(args.metrics_file if args.metrics_file
+                                     else os.path.join(wdir, 'streamd_metrics.jsonl'))
+
+    executor = None
     try:
+        # a single executor is used by all steps, each worker runs one simulation at a time
+        executor = init_executor(args.executor, hostfile=args.hostfile, ncpu=ncpu,
+                                 n_workers_per_node=args.mdrun_per_node,
+                                 use_gpu=args.device == 'gpu' or bool(args.gpu_ids),
+                                 batch_options=dict(batch_dir=os.path.join(wdir, f'batch_jobs_{unique_id}'),
+                                                    batch_system=args.batch_system,
+                                                    batch_options=args.batch_options,
+                                                    max_jobs=args.batch_max_jobs, pack=args.batch_pack))
         start(protein=args.protein,
               lfile=args.ligand, system_lfile=args.cofactor, noignh=args.noignh, no_dr=args.no_dr,
               topol=args.topol, topol_itp_list=args.topol_itp, posre_list_protein=args.posre,
@@ -722,12 +1184,23 @@ def main():
               ligand_list_file_prev=args.ligand_list_file, ligand_resid=args.ligand_id,
               activate_gaussian=args.activate_gaussian, gaussian_exe=args.gaussian_exe,
               gaussian_basis=args.gaussian_basis, gaussian_memory=args.gaussian_memory,
-              hostfile=args.hostfile, ncpu=ncpu, mdrun_per_node=args.mdrun_per_node, compute_device=args.device,
+              dask_client=executor, ncpu=ncpu, mdrun_per_node=args.mdrun_per_node, compute_device=args.device,
               gpu_ids=args.gpu_ids, ntmpi_per_gpu=args.ntmpi_per_gpu, wdir=wdir, seed=args.seed, steps=args.steps,
               clean_previous=args.clean_previous_md, not_clean_backup_files=args.not_clean_backup_files,
               metal_resnames=args.metal_resnames, metal_charges=args.metal_charges,
               mcpbpy_cut_off=args.metal_cutoff, unique_id=unique_id,
-              save_traj_without_water=args.save_traj_without_water,
-              mdp_dir=args.mdp_dir, bash_log=bash_log)
+              save_traj_without_water=args.save_traj_without_water, coordinate_cache=args.coordinate_cache,
+              mdp_dir=args.mdp_dir, bash_log=bash_log, pipeline=args.pipeline,
+              max_retries=args.max_retries, cpt_interval=args.cpt_interval,
+              state_db=args.state_db if args.state_db else os.path.join(wdir, 'streamd_state.db'),
+              mdrun_tuning=dict(cache_file=os.path.abspath(args.mdrun_tuning_cache or get_default_cache_file()),
+                                nsteps=args.tune_mdrun_nsteps) if args.tune_mdrun else None,
+              multidir=args.multidir, mpirun=args.mpirun, replicas=args.replicas,
+              early_stop=dict(threshold=args.early_stop_rmsd,
+                              window_ns=args.early_stop_window) if args.early_stop_rmsd else None,
+              insitu_analysis=args.insitu_analysis, analysis_ncpu=args.analysis_ncpu)
+        log_metrics_summary(metrics_file)
     finally:
-        logging.shutdown()
\ No newline at end of file
+        if executor is not None:
+            executor.close()
+        logging.shutdown()
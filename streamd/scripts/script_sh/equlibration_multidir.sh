@@ -0,0 +1,61 @@
+#!/bin/bash
+#  args: wdirs, logs, analysis_dirname, ncpu, compute_device, device_param, gpu_args, pin_args, cpt_interval, mpirun
+#  Equilibration of several systems by a single gmx_mpi mdrun -multidir launch (one rank per system)
+exec > >(tee -a $logs > /dev/null) 2>&1
+unset OMP_NUM_THREADS
+
+# run mdrun -multidir for directories without the output of the step
+# args: step name, output file, mdrun arguments
+run_multidir () {
+  todo=""
+  for wdir in $wdirs; do
+    if [ ! -f $wdir/$2 ] && [ -f $wdir/$1.tpr ]; then todo="$todo $wdir"; fi
+  done
+  if [ -n "$todo" ]; then
+    nsim=$(echo $todo | wc -w)
+    ${mpirun:-mpirun} -np $nsim gmx_mpi mdrun -multidir $todo -deffnm $1 -s $1.tpr $3 -nb $compute_device $gpu_args $pin_args || { >&2 echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+  fi
+}
+
+#Energy minimization
+>&2 echo 'Script running:***************************** Energy minimization *********************************'
+for wdir in $wdirs; do
+  if [ ! -f $wdir/em.gro ]; then
+    (cd $wdir && gmx grompp -f minim.mdp -c solv_ions.gro -p topol.top -n index.ndx -o em.tpr -maxwarn 2)
+  fi
+done
+run_multidir em em.gro "-v"
+for wdir in $wdirs; do
+  if [ -f $wdir/em.gro ] && [ ! -f $wdir/$analysis_dirname/potential_$(basename $wdir).xvg ]; then
+    (cd $wdir && gmx energy -f em.edr -o $analysis_dirname/potential_$(basename $wdir).xvg <<< "Potential")
+  fi
+done
+
+# NVT
+>&2 echo 'Script running:***************************** NVT *********************************'
+for wdir in $wdirs; do
+  if [ ! -f $wdir/nvt.gro ] && [ -f $wdir/em.gro ]; then
+    (cd $wdir && gmx grompp -f nvt.mdp -c em.gro -r em.gro -p topol.top -n index.ndx -o nvt.tpr -maxwarn 1)
+  fi
+done
+run_multidir nvt nvt.gro "-cpi nvt.cpt -cpt ${cpt_interval:-15} $device_param"
+for wdir in $wdirs; do
+  if [ -f $wdir/nvt.gro ] && [ ! -f $wdir/$analysis_dirname/temperature_$(basename $wdir).xvg ]; then
+    (cd $wdir && gmx energy -f nvt.edr -o $analysis_dirname/temperature_$(basename $wdir).xvg <<< "Temperature")
+  fi
+done
+
+# NPT
+>&2 echo 'Script running:***************************** NPT *********************************'
+for wdir in $wdirs; do
+  if [ ! -f $wdir/npt.gro ] && [ -f $wdir/nvt.gro ]; then
+    (cd $wdir && gmx grompp -f npt.mdp -c nvt.gro -r nvt.gro -t nvt.cpt -p topol.top -n index.ndx -o npt.tpr -maxwarn 1)
+  fi
+done
+run_multidir npt npt.gro "-cpi npt.cpt -cpt ${cpt_interval:-15} $device_param"
+for wdir in $wdirs; do
+  if [ -f $wdir/npt.gro ] && [ ! -f $wdir/$analysis_dirname/density_$(basename $wdir).xvg ]; then
+    (cd $wdir && gmx energy -f npt.edr -o $analysis_dirname/pressure_$(basename $wdir).xvg <<< "Pressure")
+    (cd $wdir && gmx energy -f npt.edr -o $analysis_dirname/density_$(basename $wdir).xvg <<< "Density")
+  fi
+done
@@ -1,9 +1,13 @@
 #!/bin/bash
-#  args: wdir, deffnm, device_param, gpu_args
+#  args: wdir, deffnm, ncpu, compute_device, device_param, gpu_args, pin_args, cpt_interval
 cd $wdir
 unset OMP_NUM_THREADS
 # MD
 echo 'Script running:***************************** MD simulation *********************************'
 echo 'Run simulation:'
 gmx grompp -f md.mdp -c npt.gro -t npt.cpt -p topol.top -n index.ndx -o $deffnm.tpr -maxwarn 1 || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
-gmx mdrun -deffnm $deffnm -s $deffnm.tpr -nt $ncpu $device_param $gpu_args || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
\ No newline at end of file
+# pid of mdrun is used to stop the simulation by SIGTERM (mdrun writes the checkpoint and stops)
+gmx mdrun -deffnm $deffnm -s $deffnm.tpr -cpt ${cpt_interval:-15} -nt $ncpu -nb $compute_device $device_param $gpu_args $pin_args &
+echo $! > ${deffnm}_mdrun.pid
+wait $! || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+rm -f ${deffnm}_mdrun.pid
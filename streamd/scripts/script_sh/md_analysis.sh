@@ -1,9 +1,12 @@
 #!/bin/bash
-#  args: wdir index_protein_ligand dtstep wdir_out_analysis
+#  args: wdir index_protein_ligand dtstep wdir_out_analysis single_pass
 cd $wdir
 
 echo 'Script running:***************************** Analysis of MD simulation *********************************'
 
+# md_fit.xtc, md_fit_nowater.xtc and md_short_forcheck.xtc are already written by a single pass over the trajectory
+# (streamd.analysis.trajectory_processing)
+if [ -z "$single_pass" ]; then
 gmx trjconv -s $tpr -f $xtc -pbc nojump -o $deffnm\_noj_noPBC.xtc <<< "System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
 #gmx trjconv -s $tpr -f $deffnm.xtc -o $deffnm\_noPBC.xtc -pbc mol -center <<< "Protein  System"
 gmx trjconv -s $tpr -f $deffnm\_noj_noPBC.xtc -o md_centermolsnoPBC.xtc -pbc mol -center -n index.ndx  <<< "$index_group  System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
@@ -11,14 +14,19 @@ gmx trjconv -s $tpr -f $deffnm\_noj_noPBC.xtc -o md_centermolsnoPBC.xtc -pbc mol
 gmx trjconv -s $tpr -f md_centermolsnoPBC.xtc -fit rot+trans -o md_fit.xtc -n index.ndx <<< "$index_group  System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
 
 gmx trjconv -s $tpr -f md_centermolsnoPBC.xtc -fit rot+trans -o md_fit_nowater.xtc -n index.ndx <<< "$index_group  non-Water" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+fi
 gmx convert-tpr -s $tpr -o  md_out_nowater.tpr  <<< "non-Water"
 
+if [ -z "$single_pass" ]; then
 gmx trjconv -s $tpr -f md_fit.xtc -dt $dtstep -o md_short_forcheck.xtc <<< "System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+fi
 
-gmx gyrate -s $tpr -f md_fit.xtc -n index.ndx -o $wdir_out_analysis/gyrate_$system_name.xvg <<< "Protein" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}"; }
-gmx rmsf -s $tpr -f md_fit.xtc -n index.ndx -o $wdir_out_analysis/rmsf_$system_name.xvg -oq $wdir_out_analysis/rmsf_$system_name.pdb -res <<< "Protein" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}"; }
+# radius of gyration and rmsf are calculated together with RMSD by a single read of the trajectory
+# (streamd.analysis.md_system_analysis.md_trajectory_analysis)
 
 gmx trjconv -s $tpr -f md_fit.xtc -o frame.pdb -b 10 -e 11  -n index.ndx <<< "System" || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}"; }
 
+if [ -z "$single_pass" ]; then
 rm md_centermolsnoPBC.xtc
-rm $deffnm\_noj_noPBC.xtc
\ No newline at end of file
+rm $deffnm\_noj_noPBC.xtc
+fi
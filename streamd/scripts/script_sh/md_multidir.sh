@@ -0,0 +1,18 @@
+#!/bin/bash
+#  args: wdirs, logs, deffnm, ncpu, compute_device, device_param, gpu_args, pin_args, cpt_interval, mpirun
+#  MD simulation of several systems by a single gmx_mpi mdrun -multidir launch (one rank per system)
+exec > >(tee -a $logs > /dev/null) 2>&1
+unset OMP_NUM_THREADS
+# MD
+echo 'Script running:***************************** MD simulation *********************************'
+echo 'Run simulation:'
+todo=""
+for wdir in $wdirs; do
+  if [ ! -f $wdir/$deffnm.tpr ]; then
+    (cd $wdir && gmx grompp -f md.mdp -c npt.gro -t npt.cpt -p topol.top -n index.ndx -o $deffnm.tpr -maxwarn 1)
+  fi
+  if [ -f $wdir/$deffnm.tpr ]; then todo="$todo $wdir"; fi
+done
+[ -n "$todo" ] || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
+nsim=$(echo $todo | wc -w)
+${mpirun:-mpirun} -np $nsim gmx_mpi mdrun -multidir $todo -deffnm $deffnm -s $deffnm.tpr -cpi $deffnm.cpt -cpt ${cpt_interval:-15} -nb $compute_device $device_param $gpu_args $pin_args || { echo "Failed to run command  at line ${LINENO} of ${BASH_SOURCE}" && exit 1; }
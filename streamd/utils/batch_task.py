@@ -0,0 +1,70 @@
+'''
+Run pickled tasks of BatchExecutor inside a batch job:
+
+python -m streamd.utils.batch_task task_0.pkl [task_1.pkl ...]
+
+Tasks of a packed job are run simultaneously. The result of each task is saved next to its task file.
+'''
+import logging
+import os
+import pickle
+import socket
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+
+def get_result_file(task_file):
+    return task_file + '.result'
+
+
+def save_task(task_file, func, arg, kwargs):
+    with open(task_file, 'wb') as out:
+        pickle.dump((func, arg, kwargs), out)
+
+
+def load_result(task_file):
+    '''
+    :param task_file:
+    :return: dict with result or error and host of the task or None if the task is not finished
+    '''
+    result_file = get_result_file(task_file)
+    if not os.path.isfile(result_file):
+        return None
+    with open(result_file, 'rb') as inp:
+        return pickle.load(inp)
+
+
+def run_task(task_file):
+    output = {'host': socket.gethostname()}
+    try:
+        with open(task_file, 'rb') as inp:
+            func, arg, kwargs = pickle.load(inp)
+        output['result'] = func(arg, **kwargs)
+    except Exception as e:
+        logging.exception(f'Task {task_file} failed')
+        try:
+            pickle.dumps(e)
+            output['error'] = e
+        except Exception:
+            output['error'] = RuntimeError(repr(e))
+    result_file = get_result_file(task_file)
+    # the result file appears atomically, so it is never read partially
+    with open(result_file + '.tmp', 'wb') as out:
+        pickle.dump(output, out)
+    os.replace(result_file + '.tmp', result_file)
+
+
+def main():
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s: %(message)s', datefmt='%Y-%m-%d %H:%M:%S',
+                        level=logging.INFO)
+    logging.getLogger('MDAnalysis').setLevel(logging.CRITICAL)
+    task_files = sys.argv[1:]
+    if len(task_files) == 1:
+        run_task(task_files[0])
+    else:
+        with ProcessPoolExecutor(max_workers=len(task_files)) as pool:
+            list(pool.map(run_task, task_files))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import logging
+import os
+
+from streamd.utils.trajectory_index import get_topology, get_trajectory_index
+
+
+def get_cache_files(xtc):
+    '''
+    :param xtc:
+    :return: dict of npy files of the coordinate cache of the trajectory: coordinates (frames x atoms x 3, float32, A),
+             box dimensions (frames x 6, A and degrees), time (ps) and indices of cached atoms in the system
+    '''
+    prefix = os.path.splitext(xtc)[0]
+    return dict(coordinates=f'{prefix}_coords.npy', box=f'{prefix}_box.npy', time=f'{prefix}_time.npy',
+                atoms=f'{prefix}_atoms.npy')
+
+
+def remove_coordinate_cache(xtc):
+    for fname in get_cache_files(xtc).values():
+        if os.path.isfile(fname):
+            os.remove(fname)
+
+
+def is_coordinate_cache_valid(xtc):
+    '''
+    The cache is valid if it was completely written (the file of atom indices is written last) after
+    the trajectory and has the same number of frames
+    :param xtc:
+    :return: boolean
+    '''
+    import numpy as np
+
+    files = get_cache_files(xtc)
+    if not os.path.isfile(xtc) or not all(os.path.isfile(i) for i in files.values()):
+        return False
+    if os.path.getmtime(files['atoms']) < os.path.getmtime(xtc):
+        return False
+    try:
+        return np.load(files['coordinates'], mmap_mode='r').shape[0] == get_trajectory_index(xtc)['n_frames']
+    except Exception as e:
+        logging.warning(f'{xtc}: cannot read the coordinate cache: {e}')
+        return False
+
+
+def write_coordinate_cache(xtc, atom_ids):
+    '''
+    Decode the trajectory once and save coordinates of the selected atoms (e.g. non-water atoms) to memory-mapped
+    npy files, so repeated analyses read frames without decoding of xtc
+    :param xtc: processed trajectory (e.g. md_fit.xtc)
+    :param atom_ids: 0-based indices of atoms to cache
+    :return: dict of cache files
+    '''
+    import numpy as np
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+    from MDAnalysis.lib.mdamath import triclinic_box
+
+    files = get_cache_files(xtc)
+    # the cache is invalid until all files are written
+    remove_coordinate_cache(xtc)
+    atom_ids = np.asarray(atom_ids, dtype=np.int64)
+    n_frames = get_trajectory_index(xtc)['n_frames']
+    coordinates = np.lib.format.open_memmap(files['coordinates'], mode='w+', dtype=np.float32,
+                                            shape=(n_frames, len(atom_ids), 3))
+    box = np.zeros((n_frames, 6), dtype=np.float32)
+    time = np.zeros(n_frames, dtype=np.float64)
+    with XTCFile(xtc) as inp:
+        for i, frame in enumerate(inp):
+            # the same conversion to A as MDAnalysis XTCReader
+            coordinates[i] = frame.x[atom_ids] * 10
+            box[i] = triclinic_box(*frame.box)
+            box[i][:3] *= 10
+            time[i] = frame.time
+    coordinates.flush()
+    del coordinates
+    np.save(files['box'], box)
+    np.save(files['time'], time)
+    np.save(files['atoms'], atom_ids)
+    logging.info(f'{xtc}: coordinates of {len(atom_ids)} atoms of {n_frames} frames were cached')
+    return files
+
+
+def load_cached_universe(tpr, xtc):
+    '''
+    MDAnalysis Universe of the cached atoms with coordinates memory-mapped from the cache (copy-on-write,
+    the cache files are not changed). Atom indices of the Universe are the indices within the cached atoms
+    :param tpr:
+    :param xtc:
+    :return: MDAnalysis Universe or None if there is no valid cache
+    '''
+    import numpy as np
+    import MDAnalysis as mda
+    from MDAnalysis.coordinates.memory import MemoryReader
+
+    if not is_coordinate_cache_valid(xtc):
+        return None
+    files = get_cache_files(xtc)
+    universe = mda.Merge(mda.Universe(get_topology(tpr, xtc)).atoms[np.load(files['atoms'])])
+    time = np.load(files['time'])
+    universe.load_new(np.load(files['coordinates'], mmap_mode='c'), format=MemoryReader,
+                      dimensions=np.load(files['box']), dt=time[1] - time[0] if len(time) > 1 else 1)
+    return universe
@@ -0,0 +1,101 @@
+import logging
+import os
+import re
+
+
+def get_mdp_value(mdp_file, key):
+    '''
+    :param mdp_file:
+    :param key: mdp parameter, e.g. nsteps
+    :return: value as string or None
+    '''
+    with open(mdp_file) as inp:
+        for line in inp:
+            parsed = re.match(rf'^\s*{re.escape(key)}\s*=\s*([^;\s]+)', line)
+            if parsed:
+                return parsed.group(1)
+    return None
+
+
+def get_number_of_atoms_gro(gro_file):
+    '''
+    :param gro_file:
+    :return: number of atoms from the second line of gro file
+    '''
+    with open(gro_file) as inp:
+        inp.readline()
+        return int(inp.readline().strip())
+
+
+def estimate_md_cost(wdir, mdp_files):
+    '''
+    Cost of equilibration or simulation is estimated as the number of atoms of the solvated system
+    multiplied by the total number of steps
+    :param wdir: directory of the prepared complex
+    :param mdp_files: list of mdp file names
+    :return: number
+    '''
+    gro_file = os.path.join(wdir, 'solv_ions.gro')
+    if not os.path.isfile(gro_file):
+        return 0
+    nsteps = 0
+    for mdp_fname in mdp_files:
+        mdp_file = os.path.join(wdir, mdp_fname)
+        if os.path.isfile(mdp_file):
+            nsteps += max(0, int(get_mdp_value(mdp_file, 'nsteps') or 0))
+    return get_number_of_atoms_gro(gro_file) * nsteps
+
+
+def estimate_equilibration_cost(wdir):
+    return estimate_md_cost(wdir, ['nvt.mdp', 'npt.mdp'])
+
+
+def estimate_simulation_cost(wdir):
+    return estimate_md_cost(wdir, ['md.mdp'])
+
+
+def estimate_ligand_cost(mol_tuple):
+    '''
+    Cost of antechamber/Gaussian ligand preparation is estimated by the number of heavy atoms
+    :param mol_tuple: (mol, mol_id) tuple
+    :return: number
+    '''
+    return mol_tuple[0].GetNumHeavyAtoms()
+
+
+def estimate_trajectory_cost(xtc):
+    '''
+    Cost of trajectory analysis is estimated by the size of xtc file, which is proportional to
+    the number of frames multiplied by the number of atoms and requires no reading of the trajectory
+    :param xtc:
+    :return: number
+    '''
+    return os.path.getsize(xtc) if os.path.isfile(xtc) else 0
+
+
+def estimate_analysis_cost(wdir_deffnm):
+    '''
+    :param wdir_deffnm: (wdir, deffnm) tuple returned by the simulation step
+    :return: number
+    '''
+    wdir, deffnm = wdir_deffnm
+    return estimate_trajectory_cost(os.path.join(wdir, f'{deffnm}.xtc'))
+
+
+def sort_by_cost(items, cost_func):
+    '''
+    Order tasks by the longest-processing-time-first rule to avoid a single large system
+    started at the end of the run
+    :param items: list of task arguments
+    :param cost_func: function which returns an estimated cost of a task argument
+    :return: list sorted by decreasing cost
+    '''
+    costs = []
+    for item in items:
+        try:
+            costs.append(cost_func(item))
+        except Exception as e:
+            logging.warning(f'Cannot estimate the cost of the task {item}: {e}')
+            costs.append(0)
+    order = sorted(range(len(items)), key=lambda i: costs[i], reverse=True)
+    return [items[i] for i in order]
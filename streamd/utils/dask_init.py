@@ -1,18 +1,31 @@
+import itertools
 import logging
 import math
-
-from dask.distributed import Client, SSHCluster
-from rdkit import Chem
+import os
+import re
 import time
 
-def init_dask_cluster(n_tasks_per_node, ncpu, use_multi_servers=True, hostfile=None):
+from streamd.utils.executors import get_executor
+
+def init_dask_cluster(n_tasks_per_node, ncpu, use_multi_servers=True, hostfile=None, resources=None,
+                      wait_timeout=600):
     '''
 
     :param n_tasks_per_node: number of task on a single server
     :param ncpu: number of cpu on a single server
     :param hostfile:
+    :param resources: dict of abstract resources of each worker, e.g. {'CPU': 16, 'GPU': 1, 'MEMORY': 64e9}.
+                      Tasks can request them by calc_dask(..., resources={'CPU': 1})
+    :param wait_timeout: time in seconds to wait until all workers are started
     :return:
     '''
+    import dask
+    from dask.distributed import Client, SSHCluster
+
+    # tasks run their own process pools (e.g. trajectory processing by time blocks), it is not possible
+    # in daemonic processes. The config is passed to workers of SSHCluster as well
+    dask.config.set({'distributed.worker.daemon': False})
+
     if hostfile and use_multi_servers:
         with open(hostfile) as f:
             hosts = [line.strip() for line in f if line.strip()]
@@ -25,19 +38,28 @@ def init_dask_cluster(n_tasks_per_node, ncpu, use_multi_servers=True, hostfile=N
     n_threads = math.ceil(ncpu / n_tasks_per_node)
     if hosts:
         logging.warning(f'Dask init, {ncpu}, {n_threads}, {n_workers}, {hosts},{n_servers}')
+        worker_options = {"nthreads": n_threads, 'n_workers': n_workers}
+        if resources:
+            worker_options['resources'] = resources
         cluster = SSHCluster(
             hosts=[hosts[0]] + hosts,
             connect_options={"known_hosts": None},
-            worker_options={"nthreads": n_threads, 'n_workers': n_workers},
+            worker_options=worker_options,
             scheduler_options={"port": 0, "dashboard_address": ":8786"},
         )
         dask_client = Client(cluster)
-        time.sleep(10)
         logging.warning(cluster)
 
     else:
         cluster = None
-        dask_client = Client(n_workers=n_workers, threads_per_worker=n_threads)  # to run dask on a single server
+        dask_client = Client(n_workers=n_workers, threads_per_worker=n_threads,
+                             resources=resources)  # to run dask on a single server
+
+    try:
+        dask_client.wait_for_workers(n_workers=n_workers * n_servers, timeout=wait_timeout)
+    except TimeoutError:
+        logging.warning(f'Only {len(dask_client.scheduler_info()["workers"])} from {n_workers * n_servers} '
+                        f'dask workers were started in {wait_timeout} s. Calculations will continue with them.')
 
     dask_client.forward_logging(level=logging.INFO)
     dask_client.run(lambda: logging.getLogger().setLevel(logging.INFO))
@@ -47,40 +69,284 @@ def init_dask_cluster(n_tasks_per_node, ncpu, use_multi_servers=True, hostfile=N
     return dask_client, cluster
 
 
-def calc_dask(func, main_arg, dask_client, dask_report_fname=None, **kwargs):
+def get_total_memory():
+    '''
+    :return: physical memory of the current server in bytes
+    '''
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+
+def parse_memory(value):
+    '''
+    :param value: memory string as used by Gaussian, e.g. 120GB, 500MB
+    :return: number of bytes or None
+    '''
+    parsed = re.match(r'^\s*([0-9.]+)\s*([KMGT]?)B?\s*$', str(value), flags=re.IGNORECASE)
+    if not parsed:
+        return None
+    number, unit = parsed.groups()
+    return int(float(number) * 1024 ** ('KMGT'.index(unit.upper()) + 1 if unit else 0))
+
+
+def get_session_resources(ncpu, n_workers_per_node, use_gpu=False):
+    '''
+    :param ncpu: number of cpu on a single server
+    :param n_workers_per_node: number of workers per server
+    :param use_gpu: tag each worker by 1 GPU slot
+    :return: dict of resources of each worker. CPU is the number of cores of the worker also if GPU is used,
+             a simulation task requests all of them together with the GPU slot
+    '''
+    resources = {'CPU': ncpu // n_workers_per_node,
+                 'MEMORY': get_total_memory() // n_workers_per_node}
+    if use_gpu:
+        resources['GPU'] = 1
+    return resources
+
+
+def init_dask_session(hostfile, ncpu, n_workers_per_node, use_gpu=False):
+    '''
+    Start one dask cluster which is used by all steps of the run. Each server runs n_workers_per_node workers.
+    Workers are tagged by resources: CPU (cores), GPU (slots for simulations, only if GPU is used)
+    and MEMORY (bytes), so each step requests its own per-task footprint on the same workers.
+
+    :param hostfile: None or file with addresses of servers
+    :param ncpu: number of cpu on a single server
+    :param n_workers_per_node: number of workers (simultaneous simulations) per server
+    :param use_gpu: tag each worker by 1 GPU slot
+    :return: dask_client, cluster
+    '''
+    return init_dask_cluster(n_tasks_per_node=n_workers_per_node, ncpu=ncpu, use_multi_servers=True,
+                             hostfile=hostfile, resources=get_session_resources(ncpu, n_workers_per_node, use_gpu))
+
+
+def get_worker_resources(dask_client):
+    '''
+    :param dask_client: dask client or executor
+    :return: dict of resources available on each worker (minimal values across the workers)
+    '''
+    worker_resources = {}
+    for worker in get_executor(dask_client).get_workers():
+        for name, value in worker.get('resources', {}).items():
+            worker_resources[name] = min(worker_resources.get(name, value), value)
+    return worker_resources
+
+
+def get_number_of_slots(dask_client, resources=None):
+    '''
+    Number of tasks which can run simultaneously taking into account worker threads and requested resources
+    :param dask_client: dask client or executor
+    :param resources: dict of resources requested by a single task
+    :return: int
+    '''
+    nslots = 0
+    for worker in get_executor(dask_client).get_workers():
+        worker_slots = worker['nthreads']
+        for name, value in (resources or {}).items():
+            if value:
+                worker_slots = min(worker_slots, int(worker.get('resources', {}).get(name, 0) // value))
+        nslots += worker_slots
+    return max(1, nslots)
+
+
+def get_task_option(option, arg):
+    '''
+    :param option: value or function which returns a value for the given task argument
+    :param arg: argument of a task
+    :return: value of the option for the task
+    '''
+    return option(arg) if callable(option) else option
+
+
+def calc_dask(func, main_arg, dask_client, dask_report_fname=None, resources=None, priority=None,
+              window_factor=2, max_retries=0, task_callback=None, **kwargs):
+    '''
+    :param func:
+    :param main_arg: iterable of arguments, func is called for each of them
+    :param dask_client: dask client or executor (see streamd.utils.executors)
+    :param dask_report_fname:
+    :param resources: dict of worker resources requested by a single task, e.g. {'CPU': 1} or {'GPU': 1},
+                      or a function which returns such a dict for the given argument (e.g. expected cores of a task)
+    :param priority: int or a function which returns int for the given argument. Tasks with higher priority
+                     are started first. By default the priority of a task is given by its position in main_arg,
+                     so tasks are started in the order of main_arg (e.g. the longest first, see sort_by_cost)
+                     also if failed tasks are resubmitted while other tasks are queued
+    :param window_factor: the number of submitted but unfinished tasks is kept equal to
+                          window_factor * the number of tasks which fit on the workers simultaneously,
+                          so the scheduler always has queued tasks to start as soon as a slot becomes free
+    :param max_retries: the number of times a failed task (an error, a lost worker or None result) is submitted again.
+                        func should be able to resume the calculation from its previous outputs
+    :param task_callback: function called for each finished task as task_callback(arg, result, task_info),
+                          where task_info is a dict of start, end, host and attempt of the task
+    :param kwargs: keyword arguments of func
+    :return: yields results of func
+    '''
+    if dask_client is None:
+        return
+    executor = get_executor(dask_client)
     main_arg = iter(main_arg)
-    Chem.SetDefaultPickleProperties(Chem.PropertyPickleOptions.AllProps)
     task_times = {}  # Dictionary to store start times for each task
+    futures = []
+    seq = executor.as_completed()
+
+    order = itertools.count()
+
+    def submit(arg, attempt=0, rank=0):
+        future = executor.submit(func, arg,
+                                 resources=get_task_option(resources, arg),
+                                 priority=get_task_option(priority, arg) or 0 if priority is not None else -rank,
+                                 **kwargs)
+        futures.append(future)
+        seq.add(future)
+        task_times[future] = {'start': time.time(), 'arg': arg, 'attempt': attempt, 'rank': rank}
+
+    def submit_next():
+        try:
+            arg = next(main_arg)
+        except StopIteration:
+            return False
+        submit(arg, rank=next(order))
+        return True
+
+    try:
+        with executor.performance_report(dask_report_fname):
+            nslots = get_number_of_slots(executor, None if callable(resources) else resources)
+            window = max(1, math.ceil(nslots * window_factor))
+            while len(task_times) < window and submit_next():
+                pass
+            i = 0
+            for future, results in seq:
+                task = task_times.pop(future)
+                error = executor.get_error(future)
+                if error is not None or results is None:
+                    message = repr(error) if error is not None else 'no result'
+                    if task['attempt'] < max_retries:
+                        logging.warning(f'Task {func.__name__}({task["arg"]}) failed: {message}. '
+                                        f'Resubmit it, attempt {task["attempt"] + 1} from {max_retries}.')
+                        submit(task['arg'], attempt=task['attempt'] + 1, rank=task['rank'])
+                        continue
+                    if error is not None:
+                        logging.error(f'Task {func.__name__}({task["arg"]}) failed: {message}')
+                        results = None
+                i += 1
+                logging.info(f'Finished task N: {i}. Argument: {results}. '
+                                f'Function: {func.__name__}. '
+                                f'Time: {round(time.time()-task["start"], 3)} s.'
+                                )
+                if task_callback is not None:
+                    task_callback(task['arg'], results,
+                                  {'start': task['start'], 'end': time.time(), 'attempt': task['attempt'],
+                                   'host': executor.get_task_host(future)})
+                yield results
+                del future
+                while len(task_times) < window and submit_next():
+                    pass
+    finally:
+        executor.cancel(futures)
+
+
+def calc_dask_groups(func, main_arg, group_size, dask_client, task_callback=None, **kwargs):
+    '''
+    Run func for groups of consecutive arguments (e.g. several systems simulated by a single mdrun launch)
+    :param func: function which takes a tuple of arguments and returns a list of results for each of them
+                 (None for a failed argument) or None if all of them failed
+    :param main_arg: list of arguments, neighboring arguments are grouped (sort them by cost to group similar ones)
+    :param group_size: maximum number of arguments in a group
+    :param dask_client: dask client or executor
+    :param task_callback: function called for each argument of a finished group as task_callback(arg, result, task_info)
+    :param kwargs: arguments of calc_dask and keyword arguments of func
+    :return: yields results of each argument of successfully finished groups
+    '''
+    main_arg = list(main_arg)
+    groups = [tuple(main_arg[i: i + group_size]) for i in range(0, len(main_arg), group_size)]
+
+    def group_callback(args, results, task_info):
+        for arg, res in zip(args, results or [None] * len(args)):
+            task_callback(arg, res, task_info)
+
+    for results in calc_dask(func, groups, dask_client,
+                             task_callback=group_callback if task_callback is not None else None, **kwargs):
+        for res in results or []:
+            yield res
+
+
+def calc_dask_pipeline(stages, main_arg, dask_client, dask_report_fname=None, window_factor=2, task_callback=None):
+    '''
+    Run a chain of functions for every argument as a dataflow without barriers between stages.
+    Each argument is moved to the next stage as soon as its own previous stage is finished,
+    so different arguments can be processed at different stages at the same time.
+    Tasks of the later stages are submitted first and with higher priority to finish already started chains
+    as soon as possible. All stages share the same workers, the scheduler places each task according to
+    the resources requested by its stage.
+
+    :param stages: list of (func, kwargs, resources, cost_func, max_retries) tuples. The result of a stage is used
+                   as the argument of the next stage. Failed (None) results are not passed further. cost_func (can be None)
+                   estimates the cost of a task, tasks of the same stage are submitted longest first. Failed tasks
+                   (an error, a lost worker or None result) are submitted again max_retries times
+    :param main_arg: iterable of (stage_index, arg) pairs. An argument can enter the pipeline at any stage
+    :param dask_client: dask client or executor (see streamd.utils.executors)
+    :param dask_report_fname:
+    :param window_factor: the number of unfinished tasks is kept equal to window_factor * the number of tasks
+                          which fit on the workers simultaneously
+    :param task_callback: function called for each finished task as task_callback(stage_index, arg, result, task_info),
+                          where task_info is a dict of start, end, host and attempt of the task
+    :return: yields (stage_index, arg, result) for each finished task
+    '''
+    executor = get_executor(dask_client)
+    main_arg = iter(main_arg)
+    waiting = []  # (stage_index, cost, arg) of already started chains
+    task_info = {}  # future: (stage_index, arg, start time, attempt)
+    futures = []
+    seq = executor.as_completed()
+
+    def submit(stage_index, arg, attempt=0):
+        func, kwargs, resources = stages[stage_index][:3]
+        future = executor.submit(func, arg, priority=stage_index, resources=resources, **kwargs)
+        task_info[future] = (stage_index, arg, time.time(), attempt)
+        futures.append(future)
+        seq.add(future)
+
+    def fill(nslots):
+        # continue already started chains first, the rest of them waits for free places in the window
+        waiting.sort(key=lambda x: x[:2], reverse=True)
+        while waiting and len(task_info) < nslots:
+            stage_index, _, arg = waiting.pop(0)
+            submit(stage_index, arg)
+        while len(task_info) < nslots:
+            try:
+                submit(*next(main_arg))
+            except StopIteration:
+                return
 
     try:
-        if dask_client is not None:
-            from dask.distributed import as_completed, performance_report
-            # https://stackoverflow.com/a/12168252/895544 - optional context manager
-            from contextlib import contextmanager
-            none_context = contextmanager(lambda: iter([None]))()
-            with (performance_report(filename=dask_report_fname) if dask_report_fname is not None else none_context):
-                nworkers = len(dask_client.scheduler_info()['workers'])
-                futures = []
-                for i, arg in enumerate(main_arg, 1):
-                    future = dask_client.submit(func, arg, **kwargs)
-                    futures.append(future)
-                    task_times[future.key] = {'start': time.time()}
-                    if i == nworkers:
-                        break
-                seq = as_completed(futures, with_results=True)
-                for i, (future, results) in enumerate(seq, 1):
-                    logging.info(f'Finished task N: {i}. Argument: {results}. '
-                                    f'Function: {future.key.split("-")[0]}. '
-                                    f'Time: {round(time.time()-task_times[future.key]["start"], 3)} s.'
-                                    )
-                    yield results
-                    del future
-                    try:
-                        arg = next(main_arg)
-                        new_future = dask_client.submit(func, arg, **kwargs)
-                        seq.add(new_future)
-                        task_times[new_future.key] = {'start': time.time()}
-                    except StopIteration:
+        with executor.performance_report(dask_report_fname):
+            nslots = max(get_number_of_slots(executor, stage[2]) for stage in stages)
+            nslots = max(1, math.ceil(nslots * window_factor))
+            fill(nslots)
+            for future, results in seq:
+                stage_index, arg, start_time, attempt = task_info.pop(future)
+                error = executor.get_error(future)
+                if error is not None or results is None:
+                    message = repr(error) if error is not None else 'no result'
+                    if attempt < stages[stage_index][4]:
+                        logging.warning(f'Stage {stage_index} ({stages[stage_index][0].__name__}) failed for {arg}: '
+                                        f'{message}. Resubmit it, attempt {attempt + 1} from {stages[stage_index][4]}.')
+                        submit(stage_index, arg, attempt=attempt + 1)
                         continue
+                    if error is not None:
+                        logging.error(f'Stage {stage_index} ({stages[stage_index][0].__name__}) failed for {arg}: {message}')
+                        results = None
+                logging.info(f'Finished stage {stage_index} ({stages[stage_index][0].__name__}). '
+                             f'Argument: {results}. '
+                             f'Time: {round(time.time() - start_time, 3)} s.')
+                if task_callback is not None:
+                    task_callback(stage_index, arg, results,
+                                  {'start': start_time, 'end': time.time(), 'attempt': attempt,
+                                   'host': executor.get_task_host(future)})
+                if results and stage_index + 1 < len(stages):
+                    cost_func = stages[stage_index + 1][3]
+                    waiting.append((stage_index + 1, cost_func(results) if cost_func else 0, results))
+                yield stage_index, arg, results
+                del future
+                fill(nslots)
     finally:
-        dask_client.cancel(futures)
+        executor.cancel(futures)
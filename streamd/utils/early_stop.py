@@ -0,0 +1,153 @@
+import logging
+import os
+import signal
+
+from streamd.utils.xtc_tail import tail_xtc, make_whole, minimum_image, fit_transform
+
+
+def get_early_stop_file(wdir, deffnm):
+    return os.path.join(wdir, f'{deffnm}_early_stop.txt')
+
+
+def get_mdrun_pid_file(wdir, deffnm):
+    return os.path.join(wdir, f'{deffnm}_mdrun.pid')
+
+
+def is_early_stopped(wdir, deffnm):
+    return os.path.isfile(get_early_stop_file(wdir, deffnm))
+
+
+def backup_stale_trajectory(wdir, deffnm):
+    '''
+    Rename {deffnm}.xtc left by a failed attempt of a new simulation (without checkpoint) to a GROMACS-style backup
+    #{deffnm}.xtc.N#, so monitors of the new run do not read frames of the previous attempt
+    :param wdir: directory of the complex
+    :param deffnm: name of output files of mdrun
+    :return: name of the backup file or None if there is no trajectory
+    '''
+    xtc = os.path.join(wdir, f'{deffnm}.xtc')
+    if not os.path.isfile(xtc):
+        return None
+    n = 1
+    while os.path.exists(os.path.join(wdir, f'#{deffnm}.xtc.{n}#')):
+        n += 1
+    backup = os.path.join(wdir, f'#{deffnm}.xtc.{n}#')
+    os.replace(xtc, backup)
+    logging.warning(f'{wdir}: {deffnm}.xtc of a previous attempt was renamed to {os.path.basename(backup)}')
+    return backup
+
+
+def get_monitor_atoms(tpr, ligand_resid='UNL', active_site_dist=5.0):
+    '''
+    :param tpr:
+    :param ligand_resid:
+    :param active_site_dist: backbone atoms within this distance from the ligand are used to place the ligand
+                             into the nearest periodic image
+    :return: indices of backbone atoms, ligand heavy atoms and pocket backbone atoms or None if there is no ligand
+    '''
+    import MDAnalysis as mda
+    import numpy as np
+
+    universe = mda.Universe(tpr)
+    backbone = universe.select_atoms('backbone')
+    ligand = universe.select_atoms(f'resname {ligand_resid} and not name H*')
+    if not len(backbone) or not len(ligand):
+        return None
+    pocket = universe.select_atoms(f'backbone and (around {active_site_dist} resname {ligand_resid})')
+    pocket_mask = np.isin(backbone.indices, pocket.indices)
+    return backbone.indices, ligand.indices, pocket_mask
+
+
+def get_ligand_rmsd_frames(frames, backbone_ids, ligand_ids, pocket_mask):
+    '''
+    Ligand heavy-atom RMSD after fitting on the backbone (as md_rmsd_analysis) of raw mdrun frames.
+    Periodic jumps are removed in each frame, the first frame is the reference
+    :param frames: iterable of (time in ps, coordinates in A, box in A)
+    :return: generator of (time in ns, RMSD in A)
+    '''
+    import numpy as np
+
+    ref_backbone, ref_ligand = None, None
+    for t, coords, box in frames:
+        backbone = make_whole(coords[backbone_ids], box)
+        ligand = make_whole(coords[ligand_ids], box)
+        # the nearest image of the ligand to the binding pocket
+        pocket_center = backbone[pocket_mask].mean(axis=0) if pocket_mask.any() else backbone.mean(axis=0)
+        ligand_center = ligand.mean(axis=0)
+        ligand += pocket_center + minimum_image([ligand_center - pocket_center], box)[0] - ligand_center
+        if ref_backbone is None:
+            ref_backbone, ref_ligand = backbone, ligand
+        rotation, mobile_center, ref_center = fit_transform(backbone, ref_backbone)
+        ligand = (ligand - mobile_center) @ rotation.T + ref_center
+        yield t / 1000, float(np.sqrt(((ligand - ref_ligand) ** 2).sum(axis=1).mean()))
+
+
+def stop_mdrun(pid_file):
+    '''
+    Send SIGTERM to mdrun. mdrun stops at the next neighbour search step and writes the checkpoint and output files
+    :param pid_file: file with pid of mdrun written by md.sh
+    :return: True if the signal was sent
+    '''
+    if not os.path.isfile(pid_file):
+        return False
+    with open(pid_file) as inp:
+        pid = int(inp.read().strip())
+    cmdline = f'/proc/{pid}/cmdline'
+    if os.path.isfile(cmdline):
+        with open(cmdline, 'rb') as inp:
+            if b'mdrun' not in inp.read():
+                return False
+    try:
+        os.kill(pid, signal.SIGTERM)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+def monitor_ligand_rmsd(wdir, deffnm, is_running, threshold, window_ns=1.0, ligand_resid='UNL', interval=60):
+    '''
+    Tail the trajectory of a running production MD and stop mdrun if the ligand RMSD exceeds the threshold
+    for the whole window. The stop is recorded in {deffnm}_early_stop.txt file of the complex
+    :param wdir: directory of the complex
+    :param deffnm: name of output files of mdrun
+    :param is_running: function returning False when the simulation is finished
+    :param threshold: ligand RMSD threshold in A
+    :param window_ns: the ligand RMSD should be above the threshold for this time to stop the simulation
+    :param ligand_resid:
+    :param interval: time in seconds between reads of new frames
+    :return: time in ns when the simulation was stopped or None
+    '''
+    from itertools import chain
+
+    tpr = os.path.join(wdir, f'{deffnm}.tpr')
+    xtc = os.path.join(wdir, f'{deffnm}.xtc')
+    frames = tail_xtc(xtc, is_running, interval=interval)
+    try:
+        # tpr is created by grompp before mdrun starts writing the trajectory
+        first_frame = next(frames, None)
+        if first_frame is None:
+            return None
+        atoms = get_monitor_atoms(tpr, ligand_resid=ligand_resid)
+        if atoms is None:
+            logging.warning(f'{wdir}: no ligand {ligand_resid} was found. Early stop of MD is not applied')
+            return None
+
+        above_since = None
+        for t, rmsd in get_ligand_rmsd_frames(chain([first_frame], frames), *atoms):
+            if rmsd <= threshold:
+                above_since = None
+                continue
+            if above_since is None:
+                above_since = t
+            if t - above_since >= window_ns:
+                with open(get_early_stop_file(wdir, deffnm), 'w') as out:
+                    out.write(f'time_ns\tligand_rmsd\tthreshold\twindow_ns\n'
+                              f'{round(t, 3)}\t{round(rmsd, 2)}\t{threshold}\t{window_ns}\n')
+                logging.warning(f'{wdir}: ligand RMSD is above {threshold} A since {round(above_since, 3)} ns. '
+                                f'The simulation is stopped at {round(t, 3)} ns')
+                if not stop_mdrun(get_mdrun_pid_file(wdir, deffnm)):
+                    logging.warning(f'{wdir}: cannot stop mdrun. The simulation will be continued')
+                return t
+    except Exception as e:
+        logging.warning(f'{wdir}: monitoring of ligand RMSD failed and will be stopped: {e}')
+    return None
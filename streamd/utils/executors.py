@@ -0,0 +1,496 @@
+import getpass
+import logging
+import math
+import multiprocessing
+import os
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+from itertools import count
+from urllib.parse import urlparse
+
+from streamd.utils.batch_task import save_task, load_result
+
+
+@contextmanager
+def none_context():
+    yield None
+
+
+class DaskExecutor:
+    '''
+    Run tasks on a dask cluster (a single server or several servers over SSH)
+    '''
+
+    def __init__(self, dask_client, cluster=None):
+        self.dask_client = dask_client
+        self.cluster = cluster
+
+    def get_workers(self):
+        return list(self.dask_client.scheduler_info()['workers'].values())
+
+    def submit(self, func, arg, resources=None, priority=0, **kwargs):
+        return self.dask_client.submit(func, arg, resources=resources, priority=priority, pure=False, **kwargs)
+
+    def as_completed(self):
+        from dask.distributed import as_completed
+        return as_completed(with_results=True, raise_errors=False)
+
+    def get_error(self, future):
+        return future.exception() if future.status == 'error' else None
+
+    def get_task_host(self, future):
+        '''
+        :param future: finished future
+        :return: host of the worker which keeps the result of the future or None
+        '''
+        try:
+            workers = self.dask_client.who_has(future).get(future.key)
+        except Exception:
+            return None
+        return urlparse(workers[0]).hostname if workers else None
+
+    def cancel(self, futures):
+        self.dask_client.cancel(futures)
+
+    def performance_report(self, filename=None):
+        if filename is None:
+            return none_context()
+        from dask.distributed import performance_report
+        return performance_report(filename=filename)
+
+    def close(self):
+        if self.dask_client:
+            self.dask_client.retire_workers(self.dask_client.scheduler_info()['workers'],
+                                            close_workers=True, remove=True)
+            self.dask_client.shutdown()
+        if self.cluster:
+            self.cluster.close()
+
+
+class LocalExecutor:
+    '''
+    Run tasks in a pool of processes on the current server without a scheduler.
+    Resources requested by tasks are accounted on the client side: the server is split into n_workers
+    virtual workers with the same resources as dask workers would have, a task is started on a worker
+    only if it has a free thread and enough free resources. Queued tasks with higher priority are started first.
+    Worker processes are forked, so they inherit the logging set up of the main process.
+    '''
+
+    def __init__(self, n_workers, ncpu, resources=None):
+        '''
+        :param n_workers: number of virtual workers
+        :param ncpu: number of cpu on the server
+        :param resources: dict of abstract resources of each worker, e.g. {'CPU': 16, 'GPU': 1, 'MEMORY': 64e9}
+        '''
+        nthreads = math.ceil(ncpu / n_workers)
+        self.workers = [{'nthreads': nthreads, 'resources': dict(resources or {}), 'running': 0, 'used': {}}
+                        for _ in range(n_workers)]
+        self.max_workers = n_workers * nthreads
+        self.pool = self._create_pool()
+        self.host = socket.gethostname()
+        self.queue = []  # (-priority, order, future, func, arg, resources, kwargs)
+        self.running = {}  # pool future: (future, worker, resources)
+        self.order = count()
+
+    def _create_pool(self):
+        return ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('fork'))
+
+    def get_workers(self):
+        return self.workers
+
+    def submit(self, func, arg, resources=None, priority=0, **kwargs):
+        future = Future()
+        self.queue.append((-(priority or 0), next(self.order), future, func, arg, resources or {}, kwargs))
+        self._start_queued()
+        return future
+
+    def _fits(self, worker, resources):
+        return worker['running'] < worker['nthreads'] and \
+            all(worker['resources'].get(name, 0) - worker['used'].get(name, 0) >= value
+                for name, value in resources.items())
+
+    def _start_queued(self):
+        self.queue.sort(key=lambda x: x[:2])
+        queue = []
+        for item in self.queue:
+            future, func, arg, resources, kwargs = item[2:]
+            if future.cancelled():
+                continue
+            worker = min((w for w in self.workers if self._fits(w, resources)),
+                         key=lambda w: w['running'], default=None)
+            if worker is None:
+                if not any(all(w['resources'].get(name, 0) >= value for name, value in resources.items())
+                           for w in self.workers):
+                    future.set_running_or_notify_cancel()
+                    future.set_exception(ValueError(f'Requested resources {resources} exceed resources of workers'))
+                else:
+                    queue.append(item)
+                continue
+            try:
+                pool_future = self.pool.submit(func, arg, **kwargs)
+            except BrokenProcessPool:
+                # a worker process was killed (e.g. out of memory), tasks can be resubmitted to a new pool
+                logging.warning('Process pool is broken and will be restarted')
+                self.pool.shutdown(wait=False)
+                self.pool = self._create_pool()
+                pool_future = self.pool.submit(func, arg, **kwargs)
+            future.set_running_or_notify_cancel()
+            worker['running'] += 1
+            for name, value in resources.items():
+                worker['used'][name] = worker['used'].get(name, 0) + value
+            self.running[pool_future] = (future, worker, resources)
+        self.queue = queue
+
+    def _wait(self):
+        '''
+        Wait until at least one running task is finished and start queued tasks on released resources
+        '''
+        if not self.running:
+            return
+        done, _ = wait(list(self.running), return_when=FIRST_COMPLETED)
+        for pool_future in done:
+            future, worker, resources = self.running.pop(pool_future)
+            worker['running'] -= 1
+            for name, value in resources.items():
+                worker['used'][name] -= value
+            if pool_future.cancelled():
+                future.set_exception(RuntimeError('Task was cancelled'))
+            elif pool_future.exception() is not None:
+                future.set_exception(pool_future.exception())
+            else:
+                future.set_result(pool_future.result())
+        self._start_queued()
+
+    def as_completed(self):
+        return AsCompleted(self)
+
+    def get_error(self, future):
+        return None if future.cancelled() else future.exception()
+
+    def get_task_host(self, future):
+        return self.host
+
+    def cancel(self, futures):
+        futures = set(futures)
+        for future in futures:
+            future.cancel()
+        for pool_future, (future, _, _) in self.running.items():
+            if future in futures:
+                pool_future.cancel()
+
+    def performance_report(self, filename=None):
+        if filename is not None:
+            logging.warning('Performance report is available only for dask executor and will not be created')
+        return none_context()
+
+    def close(self, terminate=None):
+        '''
+        :param terminate: terminate running tasks instead of waiting for them. By default running tasks are
+                          terminated if the executor is closed while an exception is handled (e.g. KeyboardInterrupt
+                          or an error of the main process), so the exit is not blocked by long simulations
+        '''
+        if terminate is None:
+            terminate = sys.exc_info()[0] is not None
+        self.cancel([item[2] for item in self.queue])
+        self.queue = []
+        if not terminate:
+            self.pool.shutdown(wait=True)
+            return
+        processes = list((getattr(self.pool, '_processes', None) or {}).values())
+        if sys.version_info >= (3, 9):
+            self.pool.shutdown(wait=False, cancel_futures=True)
+        else:
+            self.pool.shutdown(wait=False)
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+
+
+BATCH_SYSTEMS = {
+    'slurm': {'submit': 'sbatch --parsable', 'status': 'squeue -h -o %i -u {user}', 'cancel': 'scancel'},
+    'pbs': {'submit': 'qsub -V', 'status': 'qstat -u {user}', 'cancel': 'qdel'},
+}
+
+
+def get_job_header(batch_system, name, log, ncpu, ngpu=0):
+    '''
+    :param batch_system: slurm or pbs
+    :param name: job name
+    :param log: file of the job output
+    :param ncpu: number of cores requested by the job
+    :param ngpu: number of GPUs requested by the job
+    :return: list of directives of the job script
+    '''
+    if batch_system == 'slurm':
+        header = [f'#SBATCH --job-name={name}', f'#SBATCH --output={log}', '#SBATCH --nodes=1',
+                  f'#SBATCH --cpus-per-task={ncpu}']
+        if ngpu:
+            header.append(f'#SBATCH --gres=gpu:{ngpu}')
+        return header
+    select = f'select=1:ncpus={ncpu}' + (f':ngpus={ngpu}' if ngpu else '')
+    return [f'#PBS -N {name}', f'#PBS -o {log}', '#PBS -j oe', f'#PBS -l {select}']
+
+
+class BatchExecutor:
+    '''
+    Run each task (or a packed group of tasks) as its own job of a batch system (SLURM or PBS), so short jobs
+    can fill gaps of the cluster instead of holding a single allocation for the whole run.
+    Tasks are pickled into the batch directory and run by streamd.utils.batch_task inside jobs with the same
+    python interpreter. Finished tasks are detected by their result files in the batch directory, the queue of
+    the batch system is checked only to find jobs which were finished without results (e.g. killed by time limit).
+    The number of simultaneously submitted jobs is limited, queued tasks with higher priority are submitted first.
+    Commands of the batch system are taken from PATH, so they can be replaced by stand-in scripts.
+    '''
+
+    def __init__(self, batch_dir, resources=None, batch_system='slurm', batch_options='', max_jobs=100, pack=1,
+                 poll_interval=30):
+        '''
+        :param batch_dir: directory of task, result and log files, should be shared between the servers
+        :param resources: dict of resources of a single task slot, e.g. {'CPU': 16, 'GPU': 1}
+        :param batch_system: slurm or pbs
+        :param batch_options: additional options of the submission command, e.g. '-p short -t 04:00:00'
+        :param max_jobs: maximal number of simultaneously submitted jobs
+        :param pack: maximal number of tasks run simultaneously within a single job
+        :param poll_interval: time in seconds between checks of finished tasks
+        '''
+        if batch_system not in BATCH_SYSTEMS:
+            raise ValueError(f'Unknown batch system: {batch_system}. Supported: {", ".join(BATCH_SYSTEMS)}')
+        self.batch_dir = os.path.abspath(batch_dir)
+        os.makedirs(self.batch_dir, exist_ok=True)
+        self.batch_system = batch_system
+        self.commands = BATCH_SYSTEMS[batch_system]
+        self.batch_options = batch_options or ''
+        self.max_jobs = max_jobs
+        self.pack = max(1, pack)
+        self.poll_interval = poll_interval
+        self.slot_ncpu = (resources or {}).get('CPU', 1)
+        # each task slot is published as a separate worker, so tasks request resources of a single slot
+        # and a job requests the sum of resources of its packed tasks
+        self.workers = [{'nthreads': 1, 'resources': dict(resources or {})} for _ in range(max_jobs * self.pack)]
+        self.queue = []  # (-priority, order, future, func, arg, resources, kwargs)
+        self.jobs = {}  # job id: {'tasks': [(future, task_file)], 'missing': number of checks without the job}
+        self.hosts = {}  # future: host
+        self.order = count()
+        self.job_order = count()
+
+    def get_workers(self):
+        return self.workers
+
+    def submit(self, func, arg, resources=None, priority=0, **kwargs):
+        # tasks are submitted as jobs while waiting for results, so a group of queued tasks can be packed
+        future = Future()
+        self.queue.append((-(priority or 0), next(self.order), future, func, arg, resources or {}, kwargs))
+        return future
+
+    def _run_command(self, cmd):
+        return subprocess.run(cmd, shell=True, capture_output=True, text=True, check=True).stdout
+
+    def _submit_job(self, items):
+        n = next(self.job_order)
+        task_files = []
+        for i, (_, _, future, func, arg, resources, kwargs) in enumerate(items):
+            task_file = os.path.join(self.batch_dir, f'task_{n}_{i}.pkl')
+            save_task(task_file, func, arg, kwargs)
+            task_files.append(task_file)
+        # tasks which do not request cores get cores of a whole slot
+        ncpu = sum(max(1, int(item[5].get('CPU', self.slot_ncpu))) for item in items)
+        ngpu = sum(int(item[5].get('GPU', 0)) for item in items)
+        job_script = os.path.join(self.batch_dir, f'job_{n}.sh')
+        with open(job_script, 'w') as out:
+            out.write('\n'.join(['#!/bin/bash'] +
+                                get_job_header(self.batch_system, name=f'streamd_{n}',
+                                               log=os.path.join(self.batch_dir, f'job_{n}.log'),
+                                               ncpu=ncpu, ngpu=ngpu) +
+                                [f'cd {shlex.quote(os.getcwd())}',
+                                 ' '.join([shlex.quote(sys.executable), '-m', 'streamd.utils.batch_task'] +
+                                          [shlex.quote(task_file) for task_file in task_files])]) + '\n')
+        try:
+            output = self._run_command(f'{self.commands["submit"]} {self.batch_options} {shlex.quote(job_script)}')
+            job_id = output.strip().split(';')[0]
+        except subprocess.CalledProcessError as e:
+            logging.error(f'Job {job_script} cannot be submitted: {e.stderr}')
+            for item in items:
+                item[2].set_running_or_notify_cancel()
+                item[2].set_exception(RuntimeError(f'Job {job_script} cannot be submitted: {e.stderr}'))
+            return
+        logging.info(f'Batch job {job_id} with {len(items)} task(s) was submitted')
+        for item in items:
+            item[2].set_running_or_notify_cancel()
+        self.jobs[job_id] = {'tasks': [(item[2], task_file) for item, task_file in zip(items, task_files)],
+                             'missing': 0}
+
+    def _start_queued(self):
+        self.queue = [item for item in self.queue if not item[2].cancelled()]
+        self.queue.sort(key=lambda x: x[:2])
+        while self.queue and len(self.jobs) < self.max_jobs:
+            items, self.queue = self.queue[:self.pack], self.queue[self.pack:]
+            self._submit_job(items)
+
+    def _get_active_jobs(self):
+        '''
+        :return: set of job ids in the queue of the batch system or None if the queue cannot be checked
+        '''
+        try:
+            output = self._run_command(self.commands['status'].format(user=getpass.getuser()))
+        except subprocess.CalledProcessError as e:
+            logging.warning(f'Batch queue cannot be checked: {e.stderr}')
+            return None
+        return set(re.findall(r'^\s*([0-9]+)', output, flags=re.MULTILINE))
+
+    def _collect(self):
+        '''
+        :return: number of finished tasks
+        '''
+        nfinished = 0
+        active_jobs, checked = None, False
+        for job_id in list(self.jobs):
+            job = self.jobs[job_id]
+            for future, task_file in job['tasks']:
+                if future.done():
+                    continue
+                output = load_result(task_file)
+                if output is None:
+                    continue
+                self.hosts[future] = output.get('host')
+                if 'error' in output:
+                    future.set_exception(output['error'])
+                else:
+                    future.set_result(output.get('result'))
+                nfinished += 1
+            if all(future.done() for future, _ in job['tasks']):
+                del self.jobs[job_id]
+                continue
+            if not checked:
+                active_jobs, checked = self._get_active_jobs(), True
+            if active_jobs is not None and job_id.split('.')[0] not in active_jobs:
+                # results of a finished job may appear with a delay on a shared file system
+                job['missing'] += 1
+                if job['missing'] > 1:
+                    for future, _ in job['tasks']:
+                        if not future.done():
+                            future.set_exception(RuntimeError(f'Batch job {job_id} was finished without result'))
+                            nfinished += 1
+                    del self.jobs[job_id]
+        return nfinished
+
+    def _wait(self):
+        '''
+        Submit queued tasks and wait until at least one task is finished
+        '''
+        self._start_queued()
+        while self.jobs:
+            nfinished = self._collect()
+            self._start_queued()
+            if nfinished:
+                return
+            time.sleep(self.poll_interval)
+
+    def as_completed(self):
+        return AsCompleted(self)
+
+    def get_error(self, future):
+        return None if future.cancelled() else future.exception()
+
+    def get_task_host(self, future):
+        return self.hosts.get(future)
+
+    def cancel(self, futures):
+        futures = set(futures)
+        for future in futures:
+            future.cancel()
+        for job_id in list(self.jobs):
+            tasks = self.jobs[job_id]['tasks']
+            if all(future.done() or future in futures for future, _ in tasks) and \
+                    not all(future.done() for future, _ in tasks):
+                try:
+                    self._run_command(f'{self.commands["cancel"]} {job_id}')
+                except subprocess.CalledProcessError as e:
+                    logging.warning(f'Batch job {job_id} cannot be cancelled: {e.stderr}')
+                del self.jobs[job_id]
+
+    def performance_report(self, filename=None):
+        if filename is not None:
+            logging.warning('Performance report is available only for dask executor and will not be created')
+        return none_context()
+
+    def close(self):
+        self.cancel([item[2] for item in self.queue] +
+                    [future for job in self.jobs.values() for future, _ in job['tasks']])
+        self.queue = []
+
+
+class AsCompleted:
+    '''
+    Iterator over (future, result) of finished tasks of LocalExecutor or BatchExecutor in the order of completion.
+    New futures can be added during the iteration, errors are not raised (result is None)
+    '''
+
+    def __init__(self, executor):
+        self.executor = executor
+        self.futures = []
+
+    def add(self, future):
+        self.futures.append(future)
+
+    def __iter__(self):
+        while self.futures:
+            finished = next((future for future in self.futures if future.done()), None)
+            if finished is None:
+                self.executor._wait()
+                continue
+            self.futures.remove(finished)
+            yield finished, (None if self.executor.get_error(finished) or finished.cancelled()
+                             else finished.result())
+
+
+def get_executor(dask_client):
+    '''
+    :param dask_client: executor or dask client
+    :return: executor
+    '''
+    if isinstance(dask_client, (DaskExecutor, LocalExecutor, BatchExecutor)):
+        return dask_client
+    return DaskExecutor(dask_client)
+
+
+def init_executor(executor, hostfile, ncpu, n_workers_per_node, use_gpu=False, batch_options=None):
+    '''
+    Start the executor used by all steps of the run. See init_dask_session for the resources of workers.
+
+    :param executor: dask, local, batch or auto. The local executor runs tasks in a pool of processes on the current
+                     server and has no start up costs. The batch executor submits tasks as jobs of SLURM or PBS.
+                     auto uses dask if hostfile is set and local otherwise
+    :param hostfile: None or file with addresses of servers (dask executor only)
+    :param ncpu: number of cpu on a single server
+    :param n_workers_per_node: number of workers per server
+    :param use_gpu: tag each worker by 1 GPU slot
+    :param batch_options: dict of keyword arguments of BatchExecutor (batch executor only), batch_dir is required
+    :return: executor
+    '''
+    from streamd.utils.dask_init import init_dask_session, get_session_resources
+    if executor == 'auto':
+        executor = 'dask' if hostfile else 'local'
+    logging.info(f'Tasks will be run by {executor} executor')
+    if executor == 'dask':
+        return DaskExecutor(*init_dask_session(hostfile=hostfile, ncpu=ncpu, n_workers_per_node=n_workers_per_node,
+                                               use_gpu=use_gpu))
+    if executor == 'batch':
+        resources = {'CPU': ncpu // n_workers_per_node}
+        if use_gpu:
+            resources['GPU'] = 1
+        return BatchExecutor(resources=resources, **(batch_options or {}))
+    if executor != 'local':
+        raise ValueError(f'Unknown executor: {executor}')
+    if hostfile:
+        logging.warning('Local executor uses only the current server. Hostfile will be ignored.')
+    return LocalExecutor(n_workers=n_workers_per_node, ncpu=ncpu,
+                         resources=get_session_resources(ncpu, n_workers_per_node, use_gpu))
@@ -0,0 +1,266 @@
+import csv
+import json
+import logging
+import os
+import re
+from glob import glob
+
+from streamd.utils.state_db import connect
+
+
+def init_performance_table(db_fname):
+    '''
+    Create the table of mdrun performance in the state database of the run (one row per mdrun log file)
+    :param db_fname:
+    :return: db_fname
+    '''
+    with connect(db_fname) as conn, conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS mdrun_performance (
+                        wdir TEXT NOT NULL,
+                        log TEXT NOT NULL,
+                        stage TEXT,
+                        host TEXT,
+                        natoms INTEGER,
+                        box TEXT,
+                        nsteps INTEGER,
+                        ns_per_day REAL,
+                        hours_per_ns REAL,
+                        core_time REAL,
+                        wall_time REAL,
+                        ntmpi INTEGER,
+                        ntomp INTEGER,
+                        gpu_mapping TEXT,
+                        device_flags TEXT,
+                        cpu TEXT,
+                        gpus TEXT,
+                        pme_mesh_force_load REAL,
+                        pme_imbalance REAL,
+                        load_imbalance REAL,
+                        cycle_accounting TEXT,
+                        notes TEXT,
+                        command_line TEXT,
+                        mtime REAL,
+                        PRIMARY KEY (wdir, log))''')
+    return db_fname
+
+
+def is_mdrun_log(log_file):
+    '''
+    :param log_file:
+    :return: True if the file is a log written by gmx mdrun (md.log). Logs of captured stdout/stderr of mdrun
+             (e.g. streamd_bash_*.log) contain the same header but not the line about opening of the log file
+    '''
+    try:
+        with open(log_file, errors='replace') as inp:
+            head = inp.read(4096)
+    except OSError:
+        return False
+    return re.search(r':-\) GROMACS - gmx\S* mdrun', head) is not None and 'Log file opened on' in head
+
+
+def get_gro_box(gro_file):
+    '''
+    :param gro_file:
+    :return: box vectors from the last line of gro file as a string or None
+    '''
+    if not os.path.isfile(gro_file):
+        return None
+    with open(gro_file, 'rb') as inp:
+        inp.seek(0, os.SEEK_END)
+        inp.seek(max(0, inp.tell() - 200))
+        lines = inp.read().decode(errors='replace').strip().split('\n')
+    return ' '.join(lines[-1].split()) if lines else None
+
+
+def parse_cycle_accounting(lines):
+    '''
+    :param lines: lines of the cycle accounting table before the Total line
+    :return: dict {part: percentage of the total time}
+    '''
+    table = {}
+    for line in lines:
+        parsed = re.match(r'^\s*(\S.*?)\s{2,}[0-9\s.]*?([0-9.]+)\s*$', line)
+        if parsed:
+            table[parsed.group(1)] = float(parsed.group(2))
+    return table
+
+
+def parse_mdrun_log(log_file):
+    '''
+    Parse performance, hardware, parallelization and load balance information from a gmx mdrun log
+    :param log_file:
+    :return: dict or None if the run was not finished (no Performance line)
+    '''
+    with open(log_file, errors='replace') as inp:
+        lines = inp.read().split('\n')
+
+    res = {'notes': []}
+    in_cycles, in_notes = False, False
+    cycle_lines = []
+    for i, line in enumerate(lines):
+        if line.startswith('Command line:') and i + 1 < len(lines):
+            res['command_line'] = lines[i + 1].strip()
+        elif line.startswith('Hardware detected on host'):
+            res['host'] = line.split()[4].rstrip(':')
+        elif line.strip().startswith('Brand:') and 'cpu' not in res:
+            res['cpu'] = line.split(':', 1)[1].strip()
+        elif re.match(r'^\s*#[0-9]+: ', line) and 'compute cap' in line:
+            res.setdefault('gpus', []).append(re.sub(r'^\s*#[0-9]+: ', '', line.split(',')[0]).strip())
+        elif re.match(r'^\s*nsteps\s*=', line) and 'nsteps' not in res:
+            res['nsteps'] = int(line.split('=')[1])
+        elif line.startswith('Mapping of GPU IDs') and i + 1 < len(lines):
+            res['gpu_mapping'] = lines[i + 1].strip()
+        elif re.match(r'^Using [0-9]+ MPI thread', line):
+            res['ntmpi'] = int(line.split()[1])
+        elif re.match(r'^Using [0-9]+ OpenMP thread', line):
+            res['ntomp'] = int(line.split()[1])
+        elif re.match(r'^There are: [0-9]+ Atoms', line):
+            res['natoms'] = int(line.split()[2])
+        elif 'R E A L   C Y C L E' in line:
+            in_cycles = True
+            cycle_lines = []
+        elif in_cycles and line.strip().startswith('Total'):
+            in_cycles = False
+        elif in_cycles and not line.startswith('-----'):
+            cycle_lines.append(line)
+        elif 'Average PME mesh/force load:' in line:
+            res['pme_mesh_force_load'] = float(line.split(':')[1])
+        elif 'waiting due to PP/PME imbalance' in line:
+            res['pme_imbalance'] = float(re.findall(r'([0-9.]+)\s*%', line)[0])
+        elif 'Average load imbalance:' in line:
+            res['load_imbalance'] = float(re.findall(r'([0-9.]+)\s*%', line)[0])
+        elif line.strip().startswith('Time:') and 'wall_time' not in res:
+            values = line.split()
+            res['core_time'], res['wall_time'] = float(values[1]), float(values[2])
+        elif line.startswith('Performance:'):
+            values = line.split()
+            res['ns_per_day'], res['hours_per_ns'] = float(values[1]), float(values[2])
+
+        # notes of mdrun (e.g. about load balance), a note can continue on the next indented lines
+        if line.startswith('NOTE:') or (in_notes and line.startswith('      ') and line.strip()):
+            if line.startswith('NOTE:'):
+                res['notes'].append(line[5:].strip())
+            else:
+                res['notes'][-1] += ' ' + line.strip()
+            in_notes = True
+        else:
+            in_notes = False
+
+    if 'ns_per_day' not in res:
+        return None
+
+    res['cycle_accounting'] = parse_cycle_accounting(cycle_lines)
+    command_line = res.get('command_line', '')
+    flags = re.findall(r'(-(?:nb|pme|pmefft|bonded|update|npme)\s+\S+)', command_line)
+    res['device_flags'] = ' '.join(flags)
+    # -ntmpi/-ntomp set explicitly override the values reported by mdrun
+    for option in ('ntmpi', 'ntomp'):
+        parsed = re.search(rf'-{option}\s+([0-9]+)', command_line)
+        if parsed:
+            res[option] = int(parsed.group(1))
+    return res
+
+
+def get_log_stage(log_file):
+    name = os.path.splitext(os.path.basename(log_file))[0]
+    return name if name in ('em', 'nvt', 'npt') else 'md'
+
+
+def harvest_mdrun_logs(db_fname, wdir, host=None):
+    '''
+    Parse all finished mdrun logs of a complex directory and save them to the performance table.
+    Logs which were not changed since the previous harvest are skipped
+    :param db_fname: state database of the run
+    :param wdir: directory of the complex
+    :param host: host of the task, used if the log has no host information
+    :return: number of saved logs
+    '''
+    if db_fname is None:
+        return 0
+    from streamd.utils.cost_model import get_number_of_atoms_gro
+
+    with connect(db_fname) as conn:
+        harvested = dict(conn.execute('SELECT log, mtime FROM mdrun_performance WHERE wdir = ?', (wdir,)).fetchall())
+    rows = []
+    for log_file in sorted(glob(os.path.join(wdir, '*.log'))):
+        log_name = os.path.basename(log_file)
+        mtime = os.path.getmtime(log_file)
+        if harvested.get(log_name) == mtime or not is_mdrun_log(log_file):
+            continue
+        try:
+            res = parse_mdrun_log(log_file)
+        except Exception as e:
+            logging.warning(f'Cannot parse mdrun log {log_file}: {e}')
+            continue
+        if res is None:
+            continue
+        deffnm = os.path.splitext(log_name)[0]
+        gro_file = os.path.join(wdir, f'{deffnm}.gro')
+        if not os.path.isfile(gro_file):
+            gro_file = os.path.join(wdir, 'solv_ions.gro')
+        if 'natoms' not in res and os.path.isfile(gro_file):
+            res['natoms'] = get_number_of_atoms_gro(gro_file)
+        rows.append((wdir, log_name, get_log_stage(log_file), res.get('host') or host, res.get('natoms'),
+                     get_gro_box(gro_file), res.get('nsteps'), res['ns_per_day'], res.get('hours_per_ns'),
+                     res.get('core_time'), res.get('wall_time'), res.get('ntmpi'), res.get('ntomp'),
+                     res.get('gpu_mapping'), res.get('device_flags'), res.get('cpu'),
+                     ', '.join(res.get('gpus', [])) or None, res.get('pme_mesh_force_load'),
+                     res.get('pme_imbalance'), res.get('load_imbalance'), json.dumps(res['cycle_accounting']),
+                     json.dumps(res['notes']), res.get('command_line'), mtime))
+    if rows:
+        with connect(db_fname) as conn, conn:
+            conn.executemany(f'INSERT OR REPLACE INTO mdrun_performance VALUES ({", ".join(["?"] * 24)})', rows)
+    return len(rows)
+
+
+def get_harvest_callback(db_fname, task_callback=None):
+    '''
+    :param db_fname: state database of the run or None
+    :param task_callback: callback of calc_dask to call before (e.g. to save the state of the task) or None
+    :return: function to harvest mdrun logs of each finished equilibration or simulation task of calc_dask
+    '''
+    def harvest(arg, result, task_info):
+        if task_callback is not None:
+            task_callback(arg, result, task_info)
+        if result:
+            # equilibration returns wdir, simulation returns (wdir, deffnm)
+            harvest_mdrun_logs(db_fname, result if isinstance(result, str) else result[0],
+                               host=task_info.get('host'))
+    return harvest if db_fname is not None else task_callback
+
+
+def get_size_range(natoms, step=25000):
+    if natoms is None:
+        return 'unknown'
+    start = natoms // step * step
+    return f'{start}-{start + step}'
+
+
+def write_performance_summary(db_fname, out_file):
+    '''
+    Summarize throughput of production runs by system size and hardware
+    :param db_fname: state database of the run
+    :param out_file: csv file
+    :return: out_file or None if there are no data
+    '''
+    if db_fname is None or not os.path.isfile(db_fname):
+        return None
+    with connect(db_fname) as conn:
+        rows = conn.execute("SELECT natoms, cpu, gpus, ntmpi, ntomp, device_flags, ns_per_day, wall_time "
+                            "FROM mdrun_performance WHERE stage = 'md'").fetchall()
+    if not rows:
+        return None
+    groups = {}
+    for natoms, cpu, gpus, ntmpi, ntomp, device_flags, ns_per_day, wall_time in rows:
+        key = (get_size_range(natoms), gpus or '', cpu or '', ntmpi, ntomp, device_flags or '')
+        groups.setdefault(key, []).append((natoms or 0, ns_per_day, wall_time or 0))
+    with open(out_file, 'w', newline='') as out:
+        writer = csv.writer(out)
+        writer.writerow(['natoms_range', 'gpus', 'cpu', 'ntmpi', 'ntomp', 'device_flags', 'runs', 'mean_natoms',
+                         'mean_ns_per_day', 'min_ns_per_day', 'max_ns_per_day', 'total_wall_time_h'])
+        for key, values in sorted(groups.items(), key=lambda x: (str(x[0][1]), str(x[0][2]), x[0][0])):
+            ns_per_day = [i[1] for i in values]
+            writer.writerow(list(key) + [len(values), round(sum(i[0] for i in values) / len(values)),
+                                         round(sum(ns_per_day) / len(ns_per_day), 3), min(ns_per_day),
+                                         max(ns_per_day), round(sum(i[2] for i in values) / 3600, 3)])
+    return out_file
@@ -0,0 +1,290 @@
+import fcntl
+from glob import glob
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import time
+from contextlib import contextmanager
+
+
+def detect_gpu_ids():
+    '''
+    :return: list of ids of GPUs visible on the current server or None if GPUs cannot be detected
+    '''
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    if visible_devices is not None:
+        # gmx mdrun -gpu_id numbers the visible devices starting from 0
+        return [str(i) for i, device in enumerate(visible_devices.split(',')) if device.strip()] or None
+    try:
+        res = subprocess.run('nvidia-smi -L', shell=True, capture_output=True, text=True)
+    except OSError:
+        return None
+    gpus = [line for line in res.stdout.split('\n') if line.startswith('GPU ')]
+    return [str(i) for i in range(len(gpus))] or None
+
+
+def get_lock_dir(unique_id):
+    '''
+    :param unique_id: unique id of the run. Slots are shared by all tasks of the run on the same server
+    :return: path to a node-local directory with lock files
+    '''
+    return os.path.join(tempfile.gettempdir(), f'streamd_mdrun_slots_{unique_id}')
+
+
+@contextmanager
+def acquire_slot(lock_dir, nslots, poll_interval=5):
+    '''
+    Lock one of nslots slots of the current server. The slot is released when the context is closed
+    or the process is killed.
+    :param lock_dir: node-local directory with lock files
+    :param nslots: number of slots on the server (simultaneous mdrun per node)
+    :param poll_interval: time in seconds to wait before the next attempt if all slots are busy
+    :return: slot index
+    '''
+    os.makedirs(lock_dir, exist_ok=True)
+    while True:
+        for slot in range(nslots):
+            lock_file = open(os.path.join(lock_dir, f'slot_{slot}.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                yield slot
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        time.sleep(poll_interval)
+
+
+def get_slot_gpu_ids(slot, nslots, gpu_ids):
+    '''
+    Split GPUs of a server between slots. If there are less GPUs than slots, slots share GPUs evenly
+    :param slot: slot index
+    :param nslots: number of slots on the server
+    :param gpu_ids: list of GPU ids of the server
+    :return: list of GPU ids of the slot
+    '''
+    if not gpu_ids:
+        return None
+    if len(gpu_ids) >= nslots:
+        ngpus_per_slot = len(gpu_ids) // nslots
+        return gpu_ids[slot * ngpus_per_slot: (slot + 1) * ngpus_per_slot]
+    return [gpu_ids[slot % len(gpu_ids)]]
+
+
+def parse_cpulist(cpulist):
+    '''
+    :param cpulist: string in the format of /sys/devices/system/node/node*/cpulist, e.g. 0-15,32-47
+    :return: list of cpu ids
+    '''
+    cpus = []
+    for item in cpulist.strip().split(','):
+        if '-' in item:
+            start, end = item.split('-')
+            cpus.extend(range(int(start), int(end) + 1))
+        elif item:
+            cpus.append(int(item))
+    return cpus
+
+
+def get_numa_cpus(sysfs_dir='/sys/devices/system/node', available_cpus=None):
+    '''
+    :param sysfs_dir: directory of NUMA nodes
+    :param available_cpus: set of cpus or None to use cpus available to the current process
+    :return: list of sorted lists of cpus available to the current process grouped by NUMA nodes
+    '''
+    if available_cpus is None:
+        available_cpus = os.sched_getaffinity(0)
+    numa_cpus = []
+    for node in sorted(glob(os.path.join(sysfs_dir, 'node[0-9]*')),
+                       key=lambda x: int(re.findall('node([0-9]+)$', x)[0])):
+        with open(os.path.join(node, 'cpulist')) as inp:
+            cpus = sorted(set(parse_cpulist(inp.read())) & available_cpus)
+        if cpus:
+            numa_cpus.append(cpus)
+    return numa_cpus or [sorted(available_cpus)]
+
+
+def get_slot_cpus(slot, nslots, ncpu, numa_cpus=None):
+    '''
+    Split cpus of a server into disjoint sets for each slot. Slots are evenly distributed between NUMA nodes and
+    a set of a slot does not cross NUMA nodes if there are at least as many slots as NUMA nodes.
+    If there are less slots than NUMA nodes, each slot gets its own whole NUMA nodes
+    :param slot: slot index
+    :param nslots: number of slots on the server
+    :param ncpu: number of cpu of a single mdrun
+    :param numa_cpus: list of lists of cpus of NUMA nodes or None to read them (see get_numa_cpus)
+    :return: list of cpu ids
+    '''
+    if numa_cpus is None:
+        numa_cpus = get_numa_cpus()
+    if nslots < len(numa_cpus):
+        nnodes_per_slot = len(numa_cpus) // nslots
+        slot_cpus = [cpu for cpus in numa_cpus[slot * nnodes_per_slot: (slot + 1) * nnodes_per_slot] for cpu in cpus]
+        return slot_cpus[:ncpu]
+    nslots_per_node = -(-nslots // len(numa_cpus))
+    node_cpus = numa_cpus[slot // nslots_per_node]
+    ncpu_per_slot = min(ncpu, len(node_cpus) // nslots_per_node)
+    start = (slot % nslots_per_node) * ncpu_per_slot
+    return node_cpus[start: start + ncpu_per_slot]
+
+
+def get_mdrun_cpu_order(sysfs_dir='/sys/devices/system/cpu'):
+    '''
+    :param sysfs_dir: directory of cpus
+    :return: list of cpu ids of the server in the order of logical cores of gmx mdrun (hardware threads of a core
+             are consecutive, cores are grouped by sockets) or None if the topology cannot be read
+    '''
+    keys = []
+    for cpu_dir in glob(os.path.join(sysfs_dir, 'cpu[0-9]*')):
+        cpu = int(re.findall('cpu([0-9]+)$', cpu_dir)[0])
+        try:
+            with open(os.path.join(cpu_dir, 'topology', 'physical_package_id')) as inp:
+                package = int(inp.read())
+            with open(os.path.join(cpu_dir, 'topology', 'core_id')) as inp:
+                core = int(inp.read())
+        except (OSError, ValueError):
+            # offline cpus have no topology
+            continue
+        keys.append((package, core, cpu))
+    return [cpu for _, _, cpu in sorted(keys)] or None
+
+
+def get_mdrun_pin_args(cpus, cpu_order=None):
+    '''
+    -pinoffset and -pinstride of mdrun are numbers of its logical cores, so cpu ids are converted to this order.
+    If the cpus cannot be described by a single offset and stride, mdrun is not pinned to avoid overlapping
+    of threads of simultaneous simulations
+    :param cpus: list of cpu ids of a single mdrun
+    :param cpu_order: list of cpu ids in the order of logical cores of mdrun or None to read it
+                      (see get_mdrun_cpu_order)
+    :return: gmx mdrun pinning arguments quoted for bash
+    '''
+    if not cpus:
+        return ''
+    if cpu_order is None:
+        cpu_order = get_mdrun_cpu_order()
+    if cpu_order is None or not set(cpus).issubset(cpu_order):
+        logging.warning(f'Topology of cpus {cpus} cannot be read. mdrun will not be pinned.')
+        return ''
+    cores = sorted(cpu_order.index(cpu) for cpu in cpus)
+    strides = {j - i for i, j in zip(cores, cores[1:])}
+    if len(strides) > 1:
+        logging.warning(f'Cpus {cpus} cannot be described by a single -pinoffset and -pinstride of mdrun. '
+                        f'mdrun will not be pinned.')
+        return ''
+    return f"'-pin on -pinoffset {cores[0]} -pinstride {strides.pop() if strides else 1}'"
+
+
+def get_mdrun_params(ncpu, compute_device, ntmpi_per_gpu, gpu_ids=None):
+    '''
+    :param ncpu: number of cpu of a single mdrun
+    :param compute_device: cpu, gpu or auto
+    :param ntmpi_per_gpu: number of thread-MPI ranks per GPU
+    :param gpu_ids: list of GPU ids used by a single mdrun or None to use all visible GPUs
+    :return: dict of default launch parameters of gmx mdrun (pme, update, bonded, ntmpi, ntomp, npme, nstlist),
+             None values are not passed to mdrun
+    '''
+    # To set where to execute (cpu or gpu) the interactions and update steps during gmx mdrun
+    params = {'pme': compute_device, 'update': compute_device, 'bonded': compute_device}
+    if compute_device == 'gpu' or gpu_ids:
+        ngpus = len(gpu_ids) if gpu_ids else 1
+        # https://gromacs.bioexcel.eu/t/using-multiple-gpus-on-one-machine/5974
+        k = ngpus * ntmpi_per_gpu
+        params.update({'ntmpi': k, 'ntomp': max(1, ncpu // k), 'npme': 1 if k > 1 else None})
+    return params
+
+
+def format_mdrun_args(params, gpu_ids=None):
+    '''
+    :param params: dict of launch parameters of gmx mdrun, see get_mdrun_params
+    :param gpu_ids: list of GPU ids used by a single mdrun or None to use all visible GPUs
+    :return: device_param and gpu_args strings (not quoted)
+    '''
+    device_param = f"-update {params['update']} -pme {params['pme']} -bonded {params['bonded']} " \
+                   f"-pmefft {params['pme']}"
+    for name in ('npme', 'nstlist'):
+        if params.get(name) is not None:
+            device_param = f"{device_param} -{name} {params[name]}"
+    gpu_args = ''
+    if params.get('ntmpi') is not None:
+        gpu_args = f"-ntmpi {params['ntmpi']} -ntomp {params['ntomp']}"
+        if gpu_ids:
+            gpu_args = gpu_args + f" -gpu_id {','.join(gpu_ids)}"
+    return device_param, gpu_args
+
+
+def quote_args(args):
+    return f"'{args}'" if args else ''
+
+
+def get_mdrun_gpu_args(ncpu, compute_device, ntmpi_per_gpu, gpu_ids=None):
+    '''
+    :param ncpu: number of cpu of a single mdrun
+    :param compute_device: cpu, gpu or auto
+    :param ntmpi_per_gpu: number of thread-MPI ranks per GPU
+    :param gpu_ids: list of GPU ids used by a single mdrun or None to use all visible GPUs
+    :return: device_param and gpu_args strings quoted for bash
+    '''
+    device_param, gpu_args = format_mdrun_args(get_mdrun_params(ncpu=ncpu, compute_device=compute_device,
+                                                                ntmpi_per_gpu=ntmpi_per_gpu, gpu_ids=gpu_ids),
+                                               gpu_ids=gpu_ids)
+    return quote_args(device_param), quote_args(gpu_args)
+
+
+def get_multidir_mdrun_args(ncpu, compute_device, ntmpi_per_gpu, gpu_ids, pin_args, nsim):
+    '''
+    Arguments of gmx_mpi mdrun -multidir with one rank per system. Ranks share cores and GPUs of the slot
+    :param ncpu: number of cpu of the slot
+    :param nsim: number of simulations of a single launch
+    :return: device_param and gpu_args strings quoted for bash
+    '''
+    params = get_mdrun_params(ncpu=ncpu, compute_device=compute_device, ntmpi_per_gpu=1, gpu_ids=None)
+    params.update({'ntmpi': None, 'npme': None})
+    device_param, _ = format_mdrun_args(params)
+    gpu_args = f"-ntomp {max(1, ncpu // nsim)}"
+    if gpu_ids:
+        gpu_args = gpu_args + f" -gpu_id {','.join(gpu_ids)}"
+    return quote_args(device_param), quote_args(gpu_args)
+
+
+@contextmanager
+def mdrun_slot(ncpu, compute_device, ntmpi_per_gpu, gpu_ids, nslots, lock_dir, get_args=None):
+    '''
+    Reserve a slot on the current server for a single mdrun task and return its own GPU subset and its own
+    NUMA-local set of cpu cores (pinning is used only if several mdrun share the server)
+    :param ncpu: number of cpu of a single mdrun
+    :param compute_device: cpu, gpu or auto
+    :param ntmpi_per_gpu: number of thread-MPI ranks per GPU
+    :param gpu_ids: list of GPU ids of the server or None to detect them
+    :param nslots: number of simultaneous mdrun per server
+    :param lock_dir: node-local directory with lock files
+    :param get_args: None or function returning device_param and gpu_args of the slot instead of the default ones
+                     (e.g. tuned parameters, see mdrun_tuning.tune_mdrun). It is called with ncpu, compute_device,
+                     ntmpi_per_gpu, gpu_ids and pin_args of the slot
+    :return: device_param, gpu_args, pin_args
+    '''
+    if gpu_ids is None and compute_device == 'gpu':
+        gpu_ids = detect_gpu_ids()
+    with acquire_slot(lock_dir, nslots) as slot:
+        slot_gpu_ids = get_slot_gpu_ids(slot, nslots, gpu_ids)
+        if slot_gpu_ids:
+            logging.info(f'mdrun slot {slot} uses GPU(s): {",".join(slot_gpu_ids)}')
+        pin_args = ''
+        if nslots > 1:
+            slot_cpus = get_slot_cpus(slot, nslots, ncpu)
+            pin_args = get_mdrun_pin_args(slot_cpus)
+            if pin_args:
+                logging.info(f'mdrun slot {slot} is pinned to cpus: {",".join(map(str, slot_cpus))}')
+        if get_args is not None:
+            device_param, gpu_args = get_args(ncpu=ncpu, compute_device=compute_device, ntmpi_per_gpu=ntmpi_per_gpu,
+                                              gpu_ids=slot_gpu_ids, pin_args=pin_args)
+        else:
+            device_param, gpu_args = get_mdrun_gpu_args(ncpu=ncpu, compute_device=compute_device,
+                                                        ntmpi_per_gpu=ntmpi_per_gpu, gpu_ids=slot_gpu_ids)
+        yield device_param, gpu_args, pin_args
@@ -0,0 +1,256 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+from contextlib import contextmanager
+from glob import glob
+
+from streamd.utils.cost_model import get_number_of_atoms_gro
+from streamd.utils.mdrun_performance import get_size_range, parse_mdrun_log
+from streamd.utils.mdrun_slots import get_mdrun_params, format_mdrun_args, quote_args
+from streamd.utils.state_db import connect
+from streamd.utils.utils import run_check_subprocess
+
+
+def get_default_cache_file():
+    return os.path.join(os.path.expanduser('~'), '.cache', 'streamd', 'mdrun_tuning.db')
+
+
+def init_tuning_cache(cache_file):
+    '''
+    Create the cache of the best mdrun launch parameters. The cache is shared by all runs (campaigns)
+    :param cache_file:
+    :return: cache_file
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(cache_file)), exist_ok=True)
+    with connect(cache_file) as conn, conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS mdrun_tuning (
+                        hardware TEXT NOT NULL,
+                        size_class TEXT NOT NULL,
+                        compute_device TEXT NOT NULL,
+                        params TEXT NOT NULL,
+                        ns_per_day REAL,
+                        natoms INTEGER,
+                        benchmarks TEXT,
+                        time REAL,
+                        PRIMARY KEY (hardware, size_class, compute_device))''')
+    return cache_file
+
+
+def get_cached_params(cache_file, hardware, size_class, compute_device):
+    '''
+    :return: dict of the best launch parameters or None if the search was not run yet
+    '''
+    with connect(cache_file) as conn:
+        row = conn.execute('SELECT params FROM mdrun_tuning WHERE hardware = ? AND size_class = ? '
+                           'AND compute_device = ?', (hardware, size_class, compute_device)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def save_cached_params(cache_file, hardware, size_class, compute_device, params, ns_per_day, natoms, benchmarks):
+    with connect(cache_file) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO mdrun_tuning VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                     (hardware, size_class, compute_device, json.dumps(params, sort_keys=True), ns_per_day, natoms,
+                      json.dumps(benchmarks), time.time()))
+
+
+@contextmanager
+def file_lock(lock_file):
+    '''
+    Exclusive lock of a file (blocking), used to run a single search per key if many tasks start simultaneously
+    '''
+    os.makedirs(os.path.dirname(lock_file), exist_ok=True)
+    with open(lock_file, 'w') as out:
+        fcntl.flock(out, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(out, fcntl.LOCK_UN)
+
+
+def get_cpu_model():
+    try:
+        with open('/proc/cpuinfo') as inp:
+            for line in inp:
+                if line.startswith('model name'):
+                    return line.split(':', 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def get_gpu_names(gpu_ids):
+    '''
+    :param gpu_ids: list of GPU ids as used by gmx mdrun -gpu_id (indices of visible devices)
+    :return: list of GPU names
+    '''
+    if not gpu_ids:
+        return []
+    visible_devices = os.environ.get('CUDA_VISIBLE_DEVICES')
+    devices = [i.strip() for i in visible_devices.split(',') if i.strip()] if visible_devices else None
+    device_ids = [devices[int(i)] if devices and int(i) < len(devices) else i for i in gpu_ids]
+    try:
+        res = subprocess.run(f'nvidia-smi --query-gpu=name --format=csv,noheader -i {",".join(device_ids)}',
+                             shell=True, capture_output=True, text=True)
+        names = [line.strip() for line in res.stdout.split('\n') if line.strip()] if res.returncode == 0 else []
+    except OSError:
+        names = []
+    return names if len(names) == len(gpu_ids) else [f'gpu{i}' for i in gpu_ids]
+
+
+def get_hardware_signature(ncpu, gpu_ids):
+    '''
+    :param ncpu: number of cpu of a single mdrun
+    :param gpu_ids: list of GPU ids of a single mdrun
+    :return: string describing cpu model, number of cores and GPU models of a single mdrun
+    '''
+    return f'{get_cpu_model()}; ncpu={ncpu}; gpus={",".join(get_gpu_names(gpu_ids))}'
+
+
+def get_tuning_stages(ncpu, compute_device, gpu_ids):
+    '''
+    Parameters are tuned one group after another starting from the default parameters, the best set of each
+    group is kept for the next groups
+    :return: list of functions returning a list of candidate updates of the current best parameters
+    '''
+    stages = []
+    use_gpu = compute_device == 'gpu' or bool(gpu_ids)
+    if compute_device == 'gpu':
+        # offload of PME, update/constraints and bonded interactions
+        stages.append(lambda params: [{'pme': pme, 'update': update, 'bonded': bonded}
+                                      for pme, update, bonded in [('gpu', 'gpu', 'gpu'), ('gpu', 'gpu', 'cpu'),
+                                                                  ('gpu', 'cpu', 'cpu'), ('cpu', 'cpu', 'gpu')]])
+    if use_gpu:
+        ngpus = len(gpu_ids) if gpu_ids else 1
+        ranks = sorted({k for k in (ngpus, 2 * ngpus, 4 * ngpus) if k <= ncpu})
+        stages.append(lambda params: [{'ntmpi': k, 'ntomp': max(1, ncpu // k), 'npme': 1 if k > 1 else None}
+                                      for k in ranks])
+        nstlist = [None, 100, 200, 300]
+    else:
+        ranks = [k for k in (1, 2, 4, 8, 16, 32) if k <= ncpu and ncpu % k == 0]
+        stages.append(lambda params: [{'ntmpi': k, 'ntomp': ncpu // k, 'npme': None} for k in ranks])
+        # separate PME ranks are usually useful only for many ranks
+        stages.append(lambda params: [{'npme': npme} for npme in (None, 0, (params.get('ntmpi') or 0) // 4)]
+                      if (params.get('ntmpi') or 0) >= 8 else [])
+        nstlist = [None, 20, 40, 80]
+    stages.append(lambda params: [{'nstlist': i} for i in nstlist])
+    return stages
+
+
+def run_benchmark(tpr, bench_dir, name, params, ncpu, gpu_ids, pin_args, nsteps, bash_log, env=None):
+    '''
+    Run a short mdrun, the performance is measured on the second half of the run (-resethway)
+    :return: ns/day or None if the run failed
+    '''
+    device_param, gpu_args = format_mdrun_args(params, gpu_ids=gpu_ids)
+    # pin_args are quoted to be passed to bash scripts as a variable
+    pin_args = pin_args.strip("'")
+    log = os.path.join(bench_dir, bash_log)
+    cmd = (f'cd {bench_dir} && gmx mdrun -s {tpr} -deffnm {name} -nsteps {nsteps} -resethway -noconfout '
+           f'-nt {ncpu} {device_param} {gpu_args} {pin_args} >> {log} 2>&1')
+    if not run_check_subprocess(cmd, key=f'{tpr} {name}', log=log, env=env, ignore_error=True,
+                                stage='mdrun_tuning'):
+        return None
+    res = parse_mdrun_log(os.path.join(bench_dir, f'{name}.log'))
+    return res['ns_per_day'] if res else None
+
+
+def search_mdrun_params(tpr, bench_dir, ncpu, compute_device, ntmpi_per_gpu, gpu_ids, pin_args, nsteps,
+                        bash_log, env=None):
+    '''
+    :return: the best parameters, their ns/day (None if all benchmarks failed), list of (params, ns/day) of all runs
+    '''
+    best = get_mdrun_params(ncpu=ncpu, compute_device=compute_device, ntmpi_per_gpu=ntmpi_per_gpu, gpu_ids=gpu_ids)
+    best = {k: v for k, v in best.items() if v is not None}
+    benchmarks = []
+
+    def benchmark(params):
+        ns_per_day = run_benchmark(tpr, bench_dir, name=f'bench_{len(benchmarks)}', params=params, ncpu=ncpu,
+                                   gpu_ids=gpu_ids, pin_args=pin_args, nsteps=nsteps, bash_log=bash_log, env=env)
+        logging.info(f'mdrun tuning {tpr}: {format_mdrun_args(params, gpu_ids)} {ns_per_day} ns/day')
+        benchmarks.append((params, ns_per_day))
+        return ns_per_day
+
+    best_ns_per_day = benchmark(best)
+    for stage in get_tuning_stages(ncpu, compute_device, gpu_ids):
+        for update in stage(best):
+            params = {k: v for k, v in {**best, **update}.items() if v is not None}
+            if any(params == i[0] for i in benchmarks):
+                continue
+            ns_per_day = benchmark(params)
+            if ns_per_day is not None and (best_ns_per_day is None or ns_per_day > best_ns_per_day):
+                best, best_ns_per_day = params, ns_per_day
+    return best, best_ns_per_day, benchmarks
+
+
+def tune_mdrun(wdir, ncpu, compute_device, ntmpi_per_gpu, gpu_ids, pin_args, cache_file, nsteps=5000, tpr=None,
+               bash_log='bash.log', env=None):
+    '''
+    Select the fastest launch parameters of gmx mdrun (thread-MPI ranks and OpenMP threads, separate PME ranks,
+    nstlist and GPU offload of PME, update and bonded interactions) for the system. The search is run only once
+    for a system size class and hardware, the results are cached and reused by later runs
+    :param wdir: directory of the complex
+    :param ncpu: number of cpu of a single mdrun
+    :param compute_device: cpu, gpu or auto
+    :param ntmpi_per_gpu: number of thread-MPI ranks per GPU
+    :param gpu_ids: list of GPU ids of a single mdrun
+    :param pin_args: pinning arguments of the slot (quoted for bash)
+    :param cache_file: SQLite database with the best parameters
+    :param nsteps: number of steps of each benchmark run
+    :param tpr: tpr file to benchmark or None to create it from npt.gro/npt.cpt and md.mdp of wdir
+    :param bash_log:
+    :param env:
+    :return: device_param, gpu_args quoted for bash
+    '''
+    gro = os.path.join(wdir, 'npt.gro')
+    natoms = get_number_of_atoms_gro(gro if os.path.isfile(gro) else os.path.join(wdir, 'solv_ions.gro'))
+    size_class = get_size_range(natoms)
+    hardware = get_hardware_signature(ncpu, gpu_ids)
+    init_tuning_cache(cache_file)
+
+    params = get_cached_params(cache_file, hardware, size_class, compute_device)
+    if params is None:
+        key = hashlib.sha1(f'{hardware}|{size_class}|{compute_device}'.encode()).hexdigest()
+        with file_lock(os.path.join(f'{cache_file}.locks', f'{key}.lock')):
+            # the search could be finished by another task while waiting for the lock
+            params = get_cached_params(cache_file, hardware, size_class, compute_device)
+            if params is None:
+                logging.info(f'{wdir}. Search for the fastest mdrun parameters of {natoms} atoms system '
+                             f'({size_class} atoms) on {hardware}')
+                bench_dir = os.path.join(wdir, 'mdrun_tuning')
+                os.makedirs(bench_dir, exist_ok=True)
+                if tpr is None:
+                    tpr = os.path.join(bench_dir, 'tune.tpr')
+                    cmd = (f'cd {wdir} && gmx grompp -f md.mdp -c npt.gro -t npt.cpt -p topol.top -n index.ndx '
+                           f'-o {tpr} -maxwarn 1 >> {os.path.join(bench_dir, bash_log)} 2>&1')
+                    if not run_check_subprocess(cmd, key=wdir, log=os.path.join(bench_dir, bash_log), env=env,
+                                                stage='mdrun_tuning'):
+                        tpr = None
+                if tpr is not None:
+                    params, ns_per_day, benchmarks = search_mdrun_params(
+                        os.path.abspath(tpr), bench_dir, ncpu=ncpu, compute_device=compute_device,
+                        ntmpi_per_gpu=ntmpi_per_gpu, gpu_ids=gpu_ids, pin_args=pin_args, nsteps=nsteps,
+                        bash_log=bash_log, env=env)
+                    if ns_per_day is not None:
+                        save_cached_params(cache_file, hardware, size_class, compute_device, params, ns_per_day,
+                                           natoms, benchmarks)
+                        logging.info(f'{wdir}. The fastest mdrun parameters {params} ({ns_per_day} ns/day) '
+                                     f'were saved to {cache_file}')
+                    else:
+                        logging.warning(f'{wdir}. All benchmark runs of mdrun tuning failed. '
+                                        f'Default parameters will be used')
+                        params = None
+                # keep only logs of benchmark runs
+                for f in glob(os.path.join(bench_dir, '*')):
+                    if not f.endswith('.log'):
+                        os.remove(f)
+
+    if params is None:
+        params = get_mdrun_params(ncpu=ncpu, compute_device=compute_device, ntmpi_per_gpu=ntmpi_per_gpu,
+                                  gpu_ids=gpu_ids)
+    device_param, gpu_args = format_mdrun_args(params, gpu_ids=gpu_ids)
+    return quote_args(device_param), quote_args(gpu_args)
@@ -0,0 +1,144 @@
+import fcntl
+import json
+import logging
+import os
+import re
+import socket
+import time
+
+
+METRICS_FILE_VARIABLE = 'STREAMD_METRICS_FILE'
+
+
+def get_metrics_file(env=None):
+    '''
+    :param env: environment of the command or None to use the environment of the current process
+    :return: path to the metrics file of the run or None if metrics are not collected
+    '''
+    return (env or {}).get(METRICS_FILE_VARIABLE) or os.environ.get(METRICS_FILE_VARIABLE)
+
+
+def get_command_name(cmd):
+    '''
+    :param cmd: shell command (string or sequence with the command as the first item)
+    :return: name of the called bash script (without .sh) or program, e.g. equlibration, gmx, antechamber
+    '''
+    if not isinstance(cmd, str):
+        cmd = cmd[0]
+    script = re.search(r'\bbash\s+(\S+)', cmd)
+    if script:
+        return re.sub(r'\.sh$', '', os.path.basename(script.group(1)))
+    for word in cmd.split():
+        # skip variable assignments and directory changes
+        if '=' in word or word in ('cd', '&&', ';'):
+            continue
+        return os.path.basename(word)
+    return None
+
+
+def get_rusage_metrics(rusage):
+    '''
+    :param rusage: resource usage of a finished child process (os.wait4)
+    :return: dict of user/sys cpu time (s), peak RSS (bytes) and block I/O (bytes read from / written to
+             block devices by the file system). Reads from the page cache and I/O of network file systems
+             are not counted
+    '''
+    return {'user_time': round(rusage.ru_utime, 3),
+            'sys_time': round(rusage.ru_stime, 3),
+            'max_rss': rusage.ru_maxrss * 1024,  # kilobytes on Linux
+            'block_read_bytes': rusage.ru_inblock * 512,
+            'block_write_bytes': rusage.ru_oublock * 512}
+
+
+def save_metrics(record, metrics_file):
+    '''
+    Append a record as a single JSON line. The file is locked, so several processes (and servers with a shared
+    file system) can write to the same file
+    :param record: dict
+    :param metrics_file:
+    :return:
+    '''
+    try:
+        with open(metrics_file, 'a') as out:
+            fcntl.flock(out, fcntl.LOCK_EX)
+            try:
+                out.write(json.dumps(record) + '\n')
+            finally:
+                fcntl.flock(out, fcntl.LOCK_UN)
+    except OSError as e:
+        logging.warning(f'Metrics cannot be saved to {metrics_file}: {e}')
+
+
+def save_subprocess_metrics(cmd, key, wdir, stage, returncode, start_time, rusage, env=None):
+    '''
+    :param cmd: shell command
+    :param key: key of the command used in logs (complex directory, molecule id, etc.)
+    :param wdir: directory of the complex (or ligand) or None
+    :param stage: name of the stage or None to use the name of the called script or program
+    :param returncode:
+    :param start_time:
+    :param rusage: resource usage of the finished command (os.wait4)
+    :param env: environment of the command
+    :return:
+    '''
+    metrics_file = get_metrics_file(env)
+    if not metrics_file:
+        return
+    end_time = time.time()
+    record = {'stage': stage or get_command_name(cmd),
+              'wdir': wdir,
+              'key': str(key),
+              'host': socket.gethostname(),
+              'returncode': returncode,
+              'start_time': round(start_time, 3),
+              'wall_time': round(end_time - start_time, 3)}
+    record.update(get_rusage_metrics(rusage))
+    save_metrics(record, metrics_file)
+
+
+def summarize_metrics(metrics_file):
+    '''
+    :param metrics_file:
+    :return: dict {stage: dict of the number of calls, failed calls, total wall, user and sys time and max peak RSS}
+    '''
+    summary = {}
+    if not metrics_file or not os.path.isfile(metrics_file):
+        return summary
+    with open(metrics_file) as inp:
+        for line in inp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            stage = summary.setdefault(record.get('stage'), {'calls': 0, 'failed': 0, 'wall_time': 0, 'user_time': 0,
+                                                             'sys_time': 0, 'max_rss': 0})
+            stage['calls'] += 1
+            stage['failed'] += int(record.get('returncode') != 0)
+            for name in ('wall_time', 'user_time', 'sys_time'):
+                stage[name] = round(stage[name] + record.get(name, 0), 3)
+            stage['max_rss'] = max(stage['max_rss'], record.get('max_rss', 0))
+    return summary
+
+
+def init_metrics_file(metrics_file):
+    '''
+    Set up the metrics file for all commands of the run (including commands started by workers,
+    which receive the environment of the main process)
+    :param metrics_file:
+    :return: metrics_file
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(metrics_file)), exist_ok=True)
+    os.environ[METRICS_FILE_VARIABLE] = os.path.abspath(metrics_file)
+    return metrics_file
+
+
+def log_metrics_summary(metrics_file):
+    summary = summarize_metrics(metrics_file)
+    if not summary:
+        return
+    lines = [f'{"stage":20s} {"calls":>6s} {"failed":>6s} {"wall, h":>9s} {"cpu, h":>9s} {"peak RSS, GB":>12s}']
+    for stage, values in sorted(summary.items(), key=lambda x: x[1]['wall_time'], reverse=True):
+        lines.append(f'{str(stage):20s} {values["calls"]:6d} {values["failed"]:6d} '
+                     f'{values["wall_time"] / 3600:9.3f} {(values["user_time"] + values["sys_time"]) / 3600:9.3f} '
+                     f'{values["max_rss"] / 1024 ** 3:12.2f}')
+    logging.info(f'Resources used by external programs (saved in {metrics_file}):\n' + '\n'.join(lines))
@@ -0,0 +1,51 @@
+import os
+import re
+
+REPLICA_SUFFIX = '_replica'
+
+
+def get_replica_dir(wdir, replica):
+    '''
+    :param wdir: directory of the complex, it is used as the first replica
+    :param replica: replica number starting from 1
+    :return: directory of the replica
+    '''
+    return wdir if replica == 1 else f'{wdir.rstrip(os.sep)}{REPLICA_SUFFIX}{replica}'
+
+
+def split_replica_name(name):
+    '''
+    :param name: name of a complex directory, e.g. protein_ligand or protein_ligand_replica2
+    :return: name of the complex without the replica suffix, replica number
+    '''
+    parsed = re.match(rf'^(.+){REPLICA_SUFFIX}([0-9]+)$', name)
+    if parsed:
+        return parsed.group(1), int(parsed.group(2))
+    return name, 1
+
+
+def has_replicas(names):
+    '''
+    :param names: names of complex directories
+    :return: True if at least one complex has several replicas
+    '''
+    systems = [split_replica_name(i)[0] for i in names]
+    return len(set(systems)) < len(systems)
+
+
+def summarize_replicas(df, name_col, value_cols, group_cols=()):
+    '''
+    Aggregate values of replicas of each complex
+    :param df: pandas DataFrame with a row per replica (and per group_cols)
+    :param name_col: column with names of complex directories of replicas
+    :param value_cols: numeric columns to aggregate
+    :param group_cols: additional columns to group by (e.g. interaction, time range)
+    :return: pandas DataFrame with mean and SD between replicas (columns with _mean and _sd suffixes)
+             and the number of replicas of each complex
+    '''
+    df = df.copy()
+    df['system'] = [split_replica_name(i)[0] for i in df[name_col]]
+    grouped = df.groupby(['system'] + list(group_cols))[list(value_cols)]
+    res = grouped.mean().add_suffix('_mean').join(grouped.std().add_suffix('_sd')).round(3)
+    res.insert(0, 'replicas', grouped.size())
+    return res.reset_index()
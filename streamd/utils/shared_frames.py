@@ -0,0 +1,105 @@
+import errno
+import logging
+import os
+
+
+class SharedFrames:
+    '''
+    Node-local shared memory buffer of decoded frames: original frame numbers, box dimensions (frames x 6) and
+    coordinates (frames x atoms x 3, float32, A). It is filled once by one reader, worker processes attach to it
+    by name and use numpy views of the buffer without copying
+    '''
+    def __init__(self, n_frames, n_atoms, name=None):
+        '''
+        :param n_frames:
+        :param n_atoms:
+        :param name: None to create a new buffer or the name of the existing buffer to attach
+        '''
+        import numpy as np
+        from multiprocessing import shared_memory
+
+        self.n_frames, self.n_atoms = n_frames, n_atoms
+        size = n_frames * (8 + 6 * 4 + n_atoms * 3 * 4)
+        self.owner = name is None
+        if self.owner:
+            check_shared_memory(size)
+        self.shm = shared_memory.SharedMemory(name=name, create=self.owner, size=max(1, size))
+        self.frames = np.ndarray((n_frames,), dtype=np.int64, buffer=self.shm.buf)
+        self.dimensions = np.ndarray((n_frames, 6), dtype=np.float32, buffer=self.shm.buf, offset=n_frames * 8)
+        self.coordinates = np.ndarray((n_frames, n_atoms, 3), dtype=np.float32, buffer=self.shm.buf,
+                                      offset=n_frames * (8 + 6 * 4))
+
+    def get_spec(self):
+        '''
+        :return: arguments to attach the buffer in another process: SharedFrames(**spec)
+        '''
+        return dict(n_frames=self.n_frames, n_atoms=self.n_atoms, name=self.shm.name)
+
+    def close(self):
+        self.frames, self.dimensions, self.coordinates = None, None, None
+        try:
+            self.shm.close()
+        except BufferError:
+            # views of the buffer are still used (e.g. by a Universe), the memory is released when they are deleted
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def check_shared_memory(size, shm_dir='/dev/shm'):
+    '''
+    Shared memory on tmpfs is allocated on write, a buffer larger than the free space is created successfully
+    but writing to it kills the process by SIGBUS. So the free space is checked before the buffer is created
+    :param size: size of the buffer in bytes
+    :param shm_dir: directory of shared memory segments
+    :return: raise OSError if there is not enough free space
+    '''
+    if not os.path.isdir(shm_dir):
+        return
+    stat = os.statvfs(shm_dir)
+    free = stat.f_bavail * stat.f_frsize
+    if size > free:
+        raise OSError(errno.ENOSPC, f'{size} bytes are required for shared frames, but only {free} bytes '
+                                    f'are free in {shm_dir}')
+
+
+def fill_shared_frames(atomgroup, trajectory):
+    '''
+    Decode frames once and copy coordinates of the atom group to a new shared buffer
+    :param atomgroup: MDAnalysis AtomGroup
+    :param trajectory: MDAnalysis trajectory or its slice (e.g. u.trajectory[::step])
+    :return: SharedFrames, the caller should close it
+    '''
+    n_frames = len(trajectory)
+    shared_frames = SharedFrames(n_frames, len(atomgroup))
+    try:
+        for i, ts in enumerate(trajectory):
+            shared_frames.frames[i] = ts.frame
+            shared_frames.dimensions[i] = ts.dimensions if ts.dimensions is not None else 0
+            shared_frames.coordinates[i] = atomgroup.positions
+    except Exception:
+        shared_frames.close()
+        raise
+    logging.info(f'{n_frames} frames of {len(atomgroup)} atoms were loaded to shared memory')
+    return shared_frames
+
+
+def get_shared_universe(universe, shared_frames):
+    '''
+    :param universe: MDAnalysis Universe of the atoms of the buffer (e.g. created by MDAnalysis.Merge(atomgroup)),
+                     only its topology is used
+    :param shared_frames: SharedFrames
+    :return: the Universe with the trajectory reading frames from the shared buffer without copying.
+             Frame numbers of the trajectory are indices of the buffer, shared_frames.frames maps them to
+             original frame numbers
+    '''
+    from MDAnalysis.coordinates.memory import MemoryReader
+
+    universe.load_new(shared_frames.coordinates, format=MemoryReader, dimensions=shared_frames.dimensions)
+    return universe
@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import closing
+
+
+def connect(db_fname):
+    return closing(sqlite3.connect(db_fname, timeout=60))
+
+
+def init_state_db(db_fname):
+    '''
+    Create the database to store the state of each task of the run (one row per stage and complex)
+    :param db_fname:
+    :return: db_fname
+    '''
+    os.makedirs(os.path.dirname(os.path.abspath(db_fname)), exist_ok=True)
+    with connect(db_fname) as conn, conn:
+        conn.execute('''CREATE TABLE IF NOT EXISTS tasks (
+                        stage TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        status TEXT NOT NULL,
+                        signature TEXT,
+                        output TEXT,
+                        host TEXT,
+                        start_time REAL,
+                        end_time REAL,
+                        attempt INTEGER,
+                        PRIMARY KEY (stage, key))''')
+    return db_fname
+
+
+def reset_state_db(db_fname, stages):
+    '''
+    Remove the state of all tasks of the stages, e.g. if their outputs were removed
+    :param db_fname: None or file
+    :param stages: list of names of stages
+    :return:
+    '''
+    if db_fname is None or not os.path.isfile(db_fname):
+        return
+    with connect(db_fname) as conn, conn:
+        n = conn.execute(f'DELETE FROM tasks WHERE stage IN ({", ".join(["?"] * len(stages))})',
+                         list(stages)).rowcount
+    if n:
+        logging.info(f'State of {n} tasks of {", ".join(stages)} steps was removed from {db_fname}')
+
+
+def get_input_signature(files=(), dirs=(), **params):
+    '''
+    Signature of inputs of a task. Files are compared by size and modification time
+    :param files: list of input files
+    :param dirs: list of directories, all files in them except logs and backups (#file#) are inputs
+    :param params: parameters of the task, should be JSON serializable (or have a string representation)
+    :return: string
+    '''
+    files = list(files)
+    for dirname in dirs:
+        if os.path.isdir(dirname):
+            files.extend(os.path.join(dirname, i) for i in sorted(os.listdir(dirname))
+                         if not i.endswith('.log') and not i.startswith('#'))
+    stats = [(i, os.path.getsize(i), os.path.getmtime(i)) for i in files if os.path.isfile(i)]
+    return hashlib.md5(json.dumps([params, stats], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def get_task_signature(signature, arg):
+    '''
+    :param signature: None, string (the same for all tasks of a stage) or a function which returns the signature
+                      of the given argument of a task (e.g. a hash of its input files)
+    :param arg: argument of the task
+    :return: signature of the task
+    '''
+    return signature(arg) if callable(signature) else signature
+
+
+def get_task_key(arg):
+    '''
+    :param arg: argument of a task: mol tuple (mol, molid, resid), directory or (directory, deffnm) tuple
+    :return: unique string key of the task within a stage. It includes all fields of the argument
+             (e.g. deffnm of replicas in the same directory) except the molecule, which is compared by signature
+    '''
+    if isinstance(arg, str):
+        return arg
+    if isinstance(arg, (tuple, list)) and arg:
+        # (mol, molid, resid) or (wdir, deffnm)
+        fields = arg[1:] if not isinstance(arg[0], str) else arg
+        return json.dumps([str(i) for i in fields])
+    return json.dumps(arg)
+
+
+def decode_output(output):
+    output = json.loads(output)
+    return tuple(output) if isinstance(output, list) else output
+
+
+def save_task_state(db_fname, stage, arg, status, output=None, signature=None, task_info=None):
+    '''
+    :param db_fname: None or file. Nothing is saved if None
+    :param stage: name of the stage
+    :param arg: argument of the task
+    :param status: done or failed
+    :param output: result of the task, should be JSON serializable
+    :param signature: parameters or inputs of the stage (see get_task_signature).
+                      A finished task is not reused if its signature was changed
+    :param task_info: dict of start, end, host, attempt of the task
+    :return:
+    '''
+    if db_fname is None:
+        return
+    task_info = task_info or {}
+    with connect(db_fname) as conn, conn:
+        conn.execute('INSERT OR REPLACE INTO tasks (stage, key, status, signature, output, host, start_time, end_time, attempt) '
+                     'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (stage, get_task_key(arg), status, get_task_signature(signature, arg), json.dumps(output),
+                      task_info.get('host'), task_info.get('start'), task_info.get('end', time.time()),
+                      task_info.get('attempt')))
+
+
+def get_finished_tasks(db_fname, stage, signature=None):
+    '''
+    :param db_fname:
+    :param stage:
+    :param signature: see get_task_signature. If it is a function, signatures of tasks are checked
+                      by get_finished_output
+    :return: dict {key: output} of successfully finished tasks of the stage with the same signature
+             or dict {key: (signature, output)} if the signature is a function
+    '''
+    if db_fname is None:
+        return {}
+    with connect(db_fname) as conn:
+        if callable(signature):
+            rows = conn.execute('SELECT key, signature, output FROM tasks WHERE stage = ? AND status = ?',
+                                (stage, 'done')).fetchall()
+            return {key: (task_signature, decode_output(output)) for key, task_signature, output in rows}
+        rows = conn.execute('SELECT key, output FROM tasks WHERE stage = ? AND status = ? AND signature IS ?',
+                            (stage, 'done', signature)).fetchall()
+    return {key: decode_output(output) for key, output in rows}
+
+
+def get_finished_output(finished, arg, signature=None):
+    '''
+    :param finished: finished tasks of a stage (see get_finished_tasks)
+    :param arg: argument of a task
+    :param signature: the same signature as used by get_finished_tasks
+    :return: output of the task or None if it was not finished or its inputs were changed
+    '''
+    output = finished.get(get_task_key(arg))
+    if output is None or not callable(signature):
+        return output
+    task_signature, output = output
+    return output if task_signature == signature(arg) else None
+
+
+def split_finished_tasks(db_fname, stage, args, signature=None):
+    '''
+    :param db_fname:
+    :param stage:
+    :param args: list of arguments of the tasks
+    :param signature:
+    :return: list of outputs of already finished tasks, list of arguments of tasks to run
+    '''
+    finished = get_finished_tasks(db_fname, stage, signature)
+    outputs, args_to_run = [], []
+    for arg in args:
+        output = get_finished_output(finished, arg, signature) if finished else None
+        if output is not None:
+            outputs.append(output)
+        else:
+            args_to_run.append(arg)
+    if outputs:
+        logging.info(f'{len(outputs)} tasks of the {stage} step were already finished and will be skipped')
+    return outputs, args_to_run
+
+
+def get_resume_point(finished_tasks, stage_index, arg, signatures=None):
+    '''
+    Follow already finished stages of a single chain of tasks
+    :param finished_tasks: list of finished tasks of each stage (see get_finished_tasks)
+    :param stage_index: index of the first stage of the chain
+    :param arg: argument of the first stage
+    :param signatures: None or list of signatures of each stage used by get_finished_tasks
+    :return: list of (stage_index, arg, output) of finished stages, index of the first unfinished stage (or None)
+             and its argument
+    '''
+    finished = []
+    while stage_index < len(finished_tasks):
+        output = get_finished_output(finished_tasks[stage_index], arg,
+                                     signatures[stage_index] if signatures else None)
+        if output is None:
+            return finished, stage_index, arg
+        finished.append((stage_index, arg, output))
+        stage_index, arg = stage_index + 1, output
+    return finished, None, arg
+
+
+def get_task_callback(db_fname, stage, signature=None):
+    '''
+    :param db_fname: None or file
+    :param stage: name of the stage
+    :param signature:
+    :return: function to save the state of each finished task of calc_dask (see task_callback argument)
+    '''
+    def save_state(arg, result, task_info):
+        save_task_state(db_fname, stage, arg, 'done' if result else 'failed', output=result,
+                        signature=signature, task_info=task_info)
+    return save_state if db_fname is not None else None
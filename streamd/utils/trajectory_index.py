@@ -0,0 +1,133 @@
+import logging
+import os
+import pickle
+
+
+def get_index_file(xtc):
+    '''
+    The sidecar file is the offsets file of MDAnalysis (.{xtc}_offsets.npz) extended by the frame count, timestep
+    and the serialized topology, so MDAnalysis readers use the same frame offsets for random access
+    :param xtc:
+    :return: file name of the sidecar
+    '''
+    from MDAnalysis.coordinates.XDR import offsets_filename
+
+    return offsets_filename(xtc)
+
+
+def read_index_file(xtc):
+    '''
+    :param xtc:
+    :return: dict of the sidecar data or None if it does not exist or the trajectory was changed (size or mtime)
+    '''
+    import numpy as np
+
+    index_file = get_index_file(xtc)
+    if not os.path.isfile(index_file):
+        return None
+    try:
+        with np.load(index_file) as inp:
+            data = {k: inp[k] for k in inp.files}
+    except Exception as e:
+        logging.warning(f'Failed to read {index_file}: {e}')
+        return None
+    # the file may be written by MDAnalysis itself without frame count and timestep
+    if not {'n_frames', 'dt', 'size', 'mtime'}.issubset(data) or \
+            data['size'] != os.path.getsize(xtc) or data['mtime'] != os.path.getmtime(xtc):
+        return None
+    return data
+
+
+def write_index_file(xtc, data):
+    '''
+    Atomic write of the sidecar. If the directory is not writable the sidecar is not saved
+    '''
+    import numpy as np
+
+    index_file = get_index_file(xtc)
+    tmp_file = f'{index_file[:-len(".npz")]}.{os.getpid()}.tmp.npz'
+    try:
+        np.savez(tmp_file, **data)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        logging.warning(f'Cannot save the trajectory index {index_file}: {e}')
+        if os.path.isfile(tmp_file):
+            os.remove(tmp_file)
+
+
+def get_trajectory_index(xtc):
+    '''
+    Frame byte offsets, frame count and timestep of xtc file. They are read from the sidecar file or
+    computed from frame headers (coordinates are not decoded) and saved to the sidecar
+    :param xtc:
+    :return: dict of offsets, n_frames, dt (ps), t0 (ps of the first frame), n_atoms
+    '''
+    import numpy as np
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    data = read_index_file(xtc)
+    if data is None:
+        size, mtime, ctime = os.path.getsize(xtc), os.path.getmtime(xtc), os.path.getctime(xtc)
+        with XTCFile(xtc) as inp:
+            offsets = inp.offsets
+            n_atoms = inp.n_atoms
+            times = []
+            for _ in range(min(2, len(offsets))):
+                times.append(inp.read().time)
+        data = dict(offsets=offsets, size=size, ctime=ctime, n_atoms=n_atoms, mtime=mtime,
+                    n_frames=len(offsets), t0=times[0] if times else 0.0,
+                    dt=times[1] - times[0] if len(times) > 1 else 0.0)
+        write_index_file(xtc, data)
+    return dict(offsets=np.asarray(data['offsets']), n_frames=int(data['n_frames']), dt=float(data['dt']),
+                t0=float(data['t0']), n_atoms=int(data['n_atoms']))
+
+
+def get_topology(tpr, xtc):
+    '''
+    Topology of tpr file serialized to the sidecar of xtc file, it is parsed again if tpr was changed (size or mtime)
+    :param tpr:
+    :param xtc:
+    :return: MDAnalysis Topology
+    '''
+    import numpy as np
+    import MDAnalysis as mda
+
+    get_trajectory_index(xtc)
+    data = read_index_file(xtc)
+    if data is not None and 'topology' in data and data['tpr_size'] == os.path.getsize(tpr) and \
+            data['tpr_mtime'] == os.path.getmtime(tpr):
+        return pickle.loads(data['topology'].tobytes())
+    topology = mda.Universe(tpr)._topology
+    if data is not None:
+        data.update(topology=np.frombuffer(pickle.dumps(topology), dtype=np.uint8),
+                    tpr_size=os.path.getsize(tpr), tpr_mtime=os.path.getmtime(tpr))
+        write_index_file(xtc, data)
+    return topology
+
+
+def load_universe(tpr, xtc, use_cache=True):
+    '''
+    MDAnalysis Universe using the cached topology and frame offsets of the trajectory sidecar
+    :param tpr:
+    :param xtc:
+    :param use_cache: use the memory-mapped coordinate cache of the trajectory if it exists (see coordinate_cache),
+                      the Universe then contains only the cached atoms
+    :return: MDAnalysis Universe
+    '''
+    import MDAnalysis as mda
+
+    if use_cache:
+        from streamd.utils.coordinate_cache import load_cached_universe
+        try:
+            universe = load_cached_universe(tpr, xtc)
+            if universe is not None:
+                return universe
+        except Exception as e:
+            logging.warning(f'Failed to use the coordinate cache of {xtc}: {e}')
+
+    try:
+        topology = get_topology(tpr, xtc)
+    except Exception as e:
+        logging.warning(f'Failed to use the trajectory index of {xtc}: {e}')
+        topology = tpr
+    return mda.Universe(topology, xtc, in_memory=False)
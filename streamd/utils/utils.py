@@ -4,8 +4,9 @@ import os
 import re
 import shutil
 import subprocess
+import time
 
-import MDAnalysis as mda
+from streamd.utils.metrics import save_subprocess_metrics
 
 
 def filepath_type(x, ext=None, check_exist=True, exist_type='file', create_dir=False):
@@ -67,23 +68,75 @@ def get_mol_resid_pair(fname):
             molid, resid = pair
             yield molid, resid
 
-def run_check_subprocess(cmd, key, log, env=None, ignore_error=False):
+def run_check_subprocess(cmd, key, log, env=None, ignore_error=False, stage=None):
+    '''
+    Run a shell command. Wall time, cpu time, peak memory and block I/O of the command are saved to the metrics file
+    of the run if it is set up by STREAMD_METRICS_FILE environment variable (see streamd.utils.metrics)
+    :param cmd:
+    :param key: used in log messages
+    :param log: log file of the command, its directory is used as the directory of the complex in metrics
+    :param env:
+    :param ignore_error: do not log the error
+    :param stage: name of the stage in metrics. The name of the called script or program by default
+    :return: True if the command was successfully finished
+    '''
+    start_time = time.time()
+    proc = None
+    status = None
     try:
-        subprocess.check_output(cmd, shell=True, env=env, stderr=subprocess.STDOUT)
+        proc = subprocess.Popen(cmd, shell=True, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        # only the end of the output is kept for the error, long running commands may print a lot
+        output = b''
+        for chunk in iter(lambda: proc.stdout.read(65536), b''):
+            output = (output + chunk)[-65536:]
+        # unlike getrusage(RUSAGE_CHILDREN), wait4 returns resources of this command only,
+        # even if other tasks run commands in other threads of the same process
+        _, status, rusage = os.wait4(proc.pid, 0)
+        # the same return code as subprocess: the exit code or -signal if the command was killed
+        proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        save_subprocess_metrics(cmd, key=key, wdir=os.path.dirname(log) if log else None, stage=stage,
+                                returncode=proc.returncode, start_time=start_time, rusage=rusage, env=env)
+        if proc.returncode != 0:
+            raise subprocess.CalledProcessError(proc.returncode, cmd, output=output)
     except subprocess.CalledProcessError as e:
         if log:
             logging.warning(f'Failed run for {key}. Check log {log}\n')
         if not ignore_error:
             logging.exception(f'Failed run for {key}. Error:{e}', stack_info=True)
         return False
+    finally:
+        if proc is not None:
+            proc.stdout.close()
+            if status is None:
+                # this process was interrupted (e.g. KeyboardInterrupt), the command is stopped and reaped
+                # to leave no zombie processes
+                proc.kill()
+                proc.wait()
     return True
 
 def get_protein_resid_set(protein_fname):
+    import MDAnalysis as mda
+
     protein = mda.Universe(protein_fname)
     protein_resid_set = set(protein.residues.resnames.tolist())
     return protein_resid_set
 
 def get_number_of_frames(xtc, env):
+    '''
+    :param xtc:
+    :param env:
+    :return: number of frames and timestep (ps) of the trajectory or None. They are read from the trajectory
+             sidecar index (see trajectory_index), gmx check is used if it fails
+    '''
+    from streamd.utils.trajectory_index import get_trajectory_index
+
+    try:
+        index = get_trajectory_index(xtc)
+        logging.info(f'{xtc} has {index["n_frames"]} frames')
+        return index['n_frames'], index['dt']
+    except Exception as e:
+        logging.warning(f'Failed to read the trajectory index of {xtc}, gmx check will be used. Error: {e}')
+
     res = subprocess.run(f'gmx check -f {xtc}', shell=True, capture_output=True, env=env)
     res_parsed = re.findall('Step[ ]*([0-9]*)[ ]*([0-9]*)\n', res.stderr.decode("utf-8"))
     if res_parsed:
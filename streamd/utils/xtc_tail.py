@@ -0,0 +1,106 @@
+import os
+import time
+
+
+def read_new_frames(xtc, offset=0, max_frames=None):
+    '''
+    Read frames appended to a growing xtc file (e.g. written by a running mdrun) since the previous call.
+    A partially written last frame is not read and will be read by the next call
+    :param xtc: xtc file
+    :param offset: byte offset of the first frame to read (returned by the previous call)
+    :param max_frames: maximum number of frames to read or None
+    :return: list of (time in ps, coordinates in A (natoms x 3), box (3 x 3) in A), byte offset of the next frame
+    '''
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    frames = []
+    if not os.path.isfile(xtc) or os.path.getsize(xtc) <= offset:
+        return frames, offset
+    with XTCFile(xtc) as inp:
+        inp._bytes_seek(offset)
+        while max_frames is None or len(frames) < max_frames:
+            try:
+                frame = inp.read()
+            except (StopIteration, OSError):
+                # end of the file or the last frame is not completely written yet
+                break
+            frames.append((frame.time, frame.x * 10, frame.box * 10))
+            offset = inp._bytes_tell()
+    return frames, offset
+
+
+def get_xtc_n_frames(xtc):
+    '''
+    :param xtc:
+    :return: the number of complete frames of xtc file (only frame headers are read)
+    '''
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    with XTCFile(xtc) as inp:
+        return len(inp.offsets)
+
+
+def tail_xtc(xtc, is_running, interval=60, offset=0):
+    '''
+    Generator of frames of a growing xtc file. It stops when the writer is finished and all frames are read
+    :param xtc: xtc file
+    :param is_running: function returning False when the writer is finished
+    :param interval: time in seconds between reads of new frames
+    :param offset: byte offset of the first frame
+    :return: (time in ps, coordinates in A, box in A)
+    '''
+    while True:
+        running = is_running()
+        frames, offset = read_new_frames(xtc, offset)
+        yield from frames
+        if not running:
+            break
+        if not frames:
+            time.sleep(interval)
+
+
+def minimum_image(vectors, box):
+    '''
+    :param vectors: numpy array (n x 3) of difference vectors
+    :param box: box vectors (3 x 3), rectangular or triclinic box of GROMACS
+    :return: the shortest periodic images of the vectors
+    '''
+    import numpy as np
+
+    vectors = np.array(vectors, dtype=np.float64)
+    # box matrix of GROMACS is lower triangular, so the z, y and x shifts are applied one after another
+    for dim in (2, 1, 0):
+        if box[dim][dim] > 0:
+            vectors -= np.outer(np.round(vectors[:, dim] / box[dim][dim]), box[dim])
+    return vectors
+
+
+def make_whole(coords, box):
+    '''
+    Remove periodic jumps between consecutive atoms (e.g. backbone atoms or atoms of a ligand)
+    :param coords: numpy array (n x 3)
+    :param box: box vectors (3 x 3)
+    :return: coordinates where each atom is the nearest image of the previous one
+    '''
+    import numpy as np
+
+    if len(coords) < 2:
+        return np.array(coords, dtype=np.float64)
+    steps = minimum_image(np.diff(coords, axis=0), box)
+    return np.vstack([coords[:1], coords[0] + np.cumsum(steps, axis=0)])
+
+
+def fit_transform(mobile, ref, weights=None):
+    '''
+    :param mobile: coordinates (n x 3) to fit
+    :param ref: reference coordinates (n x 3)
+    :param weights: None or weights of atoms (e.g. masses)
+    :return: rotation matrix, mobile center, reference center to superimpose mobile onto ref:
+             (x - mobile_center) @ rotation.T + ref_center
+    '''
+    import numpy as np
+    from MDAnalysis.analysis.align import rotation_matrix
+
+    mobile_center, ref_center = np.average(mobile, axis=0, weights=weights), np.average(ref, axis=0, weights=weights)
+    rotation, _ = rotation_matrix(mobile - mobile_center, ref - ref_center, weights=weights)
+    return rotation, mobile_center, ref_center
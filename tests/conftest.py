@@ -0,0 +1,50 @@
+import os
+
+import pytest
+
+EXAMPLE_PROTEIN = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               'streamd', 'example', 'protein_HIS.pdb')
+
+
+def random_rotation(rng):
+    import numpy as np
+
+    q = rng.normal(size=4)
+    a, b, c, d = q / np.linalg.norm(q)
+    return np.array([[a * a + b * b - c * c - d * d, 2 * (b * c - a * d), 2 * (b * d + a * c)],
+                     [2 * (b * c + a * d), a * a - b * b + c * c - d * d, 2 * (c * d - a * b)],
+                     [2 * (b * d - a * c), 2 * (c * d + a * b), a * a - b * b - c * c + d * d]])
+
+
+@pytest.fixture(scope='session')
+def protein_trajectory(tmp_path_factory):
+    '''
+    Small protein (the first residues of the example protein with bonds) and its trajectory of randomly
+    rotated, shifted and perturbed frames in a large rectangular box, 10 ps between frames
+    :return: pdb, xtc, box size (A)
+    '''
+    import MDAnalysis as mda
+    import numpy as np
+
+    wdir = tmp_path_factory.mktemp('protein')
+    pdb, xtc = str(wdir / 'protein.pdb'), str(wdir / 'protein.xtc')
+    box_size = 150.0
+    universe = mda.Universe(EXAMPLE_PROTEIN)
+    protein = universe.select_atoms('protein and resid 1:20')
+    protein.guess_bonds(vdwradii={'H': 1.1})
+    protein.positions = protein.positions - protein.center_of_geometry() + box_size / 2
+    universe.dimensions = [box_size] * 3 + [90] * 3
+    with mda.Writer(pdb, bonds='all') as out:
+        out.write(protein)
+
+    rng = np.random.default_rng(1)
+    ref = protein.positions.copy()
+    center = ref.mean(axis=0)
+    with mda.Writer(xtc, n_atoms=len(protein)) as out:
+        for i in range(25):
+            universe.trajectory.ts.time = i * 10
+            rotation = random_rotation(rng) if i else np.eye(3)
+            protein.positions = (ref - center) @ rotation.T + center + rng.normal(scale=2, size=3) * bool(i) + \
+                rng.normal(scale=0.3, size=ref.shape) * bool(i)
+            out.write(protein)
+    return pdb, xtc, box_size
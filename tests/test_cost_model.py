@@ -0,0 +1,38 @@
+import os
+
+from streamd.utils.cost_model import (estimate_equilibration_cost, estimate_simulation_cost, estimate_ligand_cost,
+                                      sort_by_cost)
+
+
+def make_complex_dir(wdir, natoms, nsteps):
+    os.makedirs(wdir)
+    with open(os.path.join(wdir, 'solv_ions.gro'), 'w') as out:
+        out.write(f'system\n{natoms:5d}\n')
+    for mdp_fname, steps in nsteps.items():
+        with open(os.path.join(wdir, mdp_fname), 'w') as out:
+            out.write(f'integrator  = md\nnsteps      = {steps}     ; comment\ndt = 0.002\n')
+    return wdir
+
+
+def test_estimate_md_cost(tmp_path):
+    wdir = make_complex_dir(str(tmp_path / 'complex'), 1000, {'nvt.mdp': 50, 'npt.mdp': 100, 'md.mdp': 5000})
+    assert estimate_equilibration_cost(wdir) == 150000
+    assert estimate_simulation_cost(wdir) == 5000000
+    # not prepared complex
+    assert estimate_simulation_cost(str(tmp_path)) == 0
+
+
+def test_sort_by_cost(tmp_path):
+    small = make_complex_dir(str(tmp_path / 'small'), 1000, {'md.mdp': 5000})
+    large = make_complex_dir(str(tmp_path / 'large'), 5000, {'md.mdp': 5000})
+    long = make_complex_dir(str(tmp_path / 'long'), 1000, {'md.mdp': 50000})
+    small2 = make_complex_dir(str(tmp_path / 'small2'), 1000, {'md.mdp': 5000})
+    # the longest tasks first, tasks of the same cost keep their order, tasks without estimate are the last
+    assert sort_by_cost([small, None, large, small2, long], estimate_simulation_cost) == \
+        [long, large, small, small2, None]
+
+
+def test_estimate_ligand_cost():
+    from rdkit import Chem
+
+    assert estimate_ligand_cost((Chem.AddHs(Chem.MolFromSmiles('c1ccccc1O')), 'phenol')) == 7
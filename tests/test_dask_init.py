@@ -0,0 +1,32 @@
+import os
+
+from streamd.utils.dask_init import calc_dask
+from streamd.utils.executors import LocalExecutor
+
+
+def run_once_failing(arg, log):
+    '''
+    Record the start of the task, the task "a" fails at the first attempt
+    '''
+    with open(log, 'a') as out:
+        out.write(f'{arg}\n')
+    marker = f'{log}.{arg}'
+    if arg == 'a' and not os.path.isfile(marker):
+        open(marker, 'w').close()
+        return None
+    return arg
+
+
+def test_calc_dask_resubmitted_task_keeps_its_order(tmp_path):
+    log = str(tmp_path / 'log.txt')
+    executor = LocalExecutor(n_workers=1, ncpu=1, resources={'CPU': 1})
+    try:
+        res = list(calc_dask(run_once_failing, ['a', 'b', 'c', 'd'], executor, resources={'CPU': 1},
+                             max_retries=1, window_factor=3, log=log))
+    finally:
+        executor.close()
+    assert sorted(res) == ['a', 'b', 'c', 'd']
+    with open(log) as inp:
+        # the released slot is taken by the next queued task "b", the resubmitted task "a" (the longest one)
+        # is started before the rest of queued tasks
+        assert inp.read().split() == ['a', 'b', 'a', 'c', 'd']
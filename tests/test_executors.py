@@ -0,0 +1,99 @@
+import os
+import time
+
+import pytest
+
+from streamd.utils.dask_init import get_number_of_slots, get_worker_resources
+from streamd.utils.executors import LocalExecutor, BatchExecutor
+
+
+def record_interval(arg, log):
+    '''
+    Save the start and the end time of the task
+    '''
+    start = time.time()
+    time.sleep(0.3)
+    with open(log, 'a') as out:
+        out.write(f'{arg} {start} {time.time()}\n')
+    return arg
+
+
+def test_local_executor_tasks_with_full_cpu_do_not_overlap(tmp_path):
+    log = str(tmp_path / 'log.txt')
+    executor = LocalExecutor(n_workers=1, ncpu=2, resources={'CPU': 2})
+    try:
+        futures = [executor.submit(record_interval, arg, resources={'CPU': 2}, log=log) for arg in ['a', 'b']]
+        completed = executor.as_completed()
+        for future in futures:
+            completed.add(future)
+        res = sorted(result for _, result in completed)
+    finally:
+        executor.close()
+    assert res == ['a', 'b']
+    with open(log) as inp:
+        intervals = sorted([float(i) for i in line.split()[1:]] for line in inp)
+    assert intervals[0][1] <= intervals[1][0]
+
+
+def test_local_executor_rejects_task_exceeding_resources():
+    executor = LocalExecutor(n_workers=2, ncpu=2, resources={'CPU': 1})
+    try:
+        future = executor.submit(record_interval, 'a', resources={'CPU': 2}, log=os.devnull)
+    finally:
+        executor.close()
+    with pytest.raises(ValueError):
+        future.result()
+
+
+def test_local_executor_terminates_tasks_on_error():
+    executor = LocalExecutor(n_workers=1, ncpu=1)
+    start = time.time()
+    with pytest.raises(KeyboardInterrupt):
+        try:
+            executor.submit(time.sleep, 60)
+            raise KeyboardInterrupt
+        finally:
+            executor.close()
+    assert time.time() - start < 30
+
+
+def make_batch_commands(bin_dir):
+    '''
+    Stand-in sbatch/squeue/scancel: sbatch runs the job script immediately and prints its id
+    '''
+    os.makedirs(bin_dir)
+    scripts = {'sbatch': '#!/bin/bash\nscript="${@: -1}"\nbash "$script" > /dev/null 2>&1\n'
+                         'basename "$script" .sh | tr -dc 0-9\necho\n',
+               'squeue': '#!/bin/bash\n',
+               'scancel': '#!/bin/bash\n'}
+    for name, text in scripts.items():
+        fname = os.path.join(bin_dir, name)
+        with open(fname, 'w') as out:
+            out.write(text)
+        os.chmod(fname, 0o755)
+
+
+def test_batch_executor_requests_resources_of_packed_tasks(tmp_path, monkeypatch):
+    make_batch_commands(str(tmp_path / 'bin'))
+    monkeypatch.setenv('PATH', f'{tmp_path / "bin"}{os.pathsep}{os.environ["PATH"]}')
+    batch_dir = tmp_path / 'batch'
+    executor = BatchExecutor(str(batch_dir), resources={'CPU': 4}, max_jobs=2, pack=2, poll_interval=0.1)
+    # tasks see resources of a single slot and as many slots as can run simultaneously
+    assert get_worker_resources(executor) == {'CPU': 4}
+    assert get_number_of_slots(executor, {'CPU': 4}) == 4
+    try:
+        futures = [executor.submit(os.path.basename, f'dir/{arg}', resources=resources)
+                   for arg, resources in [('a', {'CPU': 4}), ('b', {'CPU': 4}), ('c', {'CPU': 1}), ('d', {})]]
+        completed = executor.as_completed()
+        for future in futures:
+            completed.add(future)
+        res = sorted(result for _, result in completed)
+    finally:
+        executor.close()
+    assert res == ['a', 'b', 'c', 'd']
+    headers = []
+    for n in range(2):
+        with open(batch_dir / f'job_{n}.sh') as inp:
+            headers.append([line.strip() for line in inp if '--cpus-per-task' in line])
+    # tasks without requested cores get cores of a whole slot
+    assert headers == [['#SBATCH --cpus-per-task=8'], ['#SBATCH --cpus-per-task=5']]
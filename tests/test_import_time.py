@@ -0,0 +1,17 @@
+import subprocess
+import sys
+
+import pytest
+
+HEAVY_LIBRARIES = ['MDAnalysis', 'rdkit', 'dask', 'distributed', 'matplotlib', 'seaborn', 'pandas', 'numpy']
+
+
+@pytest.mark.parametrize('module', ['streamd.run_md', 'streamd.run_gbsa', 'streamd.prolif.run_prolif',
+                                    'streamd.analysis.run_analysis'])
+def test_import_does_not_load_heavy_libraries(module):
+    # heavy libraries should be imported only by the code which uses them to keep "--help" and start up fast
+    res = subprocess.run([sys.executable, '-c', f'import sys, {module}; '
+                                                f'print(",".join(name for name in {HEAVY_LIBRARIES} '
+                                                f'if name in sys.modules))'],
+                         capture_output=True, text=True, check=True)
+    assert res.stdout.strip() == ''
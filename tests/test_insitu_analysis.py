@@ -0,0 +1,36 @@
+import numpy as np
+
+from streamd.analysis.insitu_analysis import StreamingAnalysis
+from streamd.analysis.md_system_analysis import analyse_trajectory
+from streamd.utils.xtc_tail import read_new_frames
+
+
+def test_insitu_analysis_matches_trajectory_analysis(protein_trajectory, tmp_path):
+    pdb, xtc, _ = protein_trajectory
+    frames, _ = read_new_frames(xtc)
+    analysis = StreamingAnalysis(pdb, {})
+    for t, coords, box in frames:
+        analysis.add_frame(t, coords, box)
+    # the state is saved between the parts of a continued simulation
+    analysis.save_state(str(tmp_path / 'state.npz'))
+    analysis = StreamingAnalysis(pdb, {})
+    analysis.load_state(str(tmp_path / 'state.npz'))
+    rmsd_df = analysis.get_rmsd_df()
+
+    # the in-situ results replace the post-hoc analysis of the trajectory if all frames were analysed
+    res = analyse_trajectory(pdb, xtc, selection1='backbone', protein_selection='protein')
+    np.testing.assert_allclose(rmsd_df['time(ns)'], res['rmsd_df']['time(ns)'])
+    np.testing.assert_allclose(rmsd_df['backbone'], res['rmsd_df']['backbone'], atol=0.011)
+    # radius of gyration around axes depends on the orientation, the post-hoc analysis reads a fitted trajectory
+    np.testing.assert_allclose(np.asarray(analysis.rg)[:, 0], res['rg'][:, 0], atol=1e-3)
+    np.testing.assert_allclose(analysis.m2.sum(axis=1) / analysis.n_frames, res['msf'], rtol=1e-3, atol=1e-3)
+
+
+def test_insitu_rmsd_time(protein_trajectory):
+    pdb, xtc, _ = protein_trajectory
+    frames, _ = read_new_frames(xtc)
+    analysis = StreamingAnalysis(pdb, {})
+    # every second frame, duplicated frames of a continued simulation are skipped
+    for t, coords, box in frames[:10:2] + frames[8:12:2]:
+        analysis.add_frame(t, coords, box)
+    np.testing.assert_allclose(analysis.get_rmsd_df()['time(ns)'], [0, 0.02, 0.04, 0.06, 0.08, 0.1])
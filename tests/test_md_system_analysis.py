@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from streamd.analysis.md_system_analysis import (analyse_trajectory, kabsch_batch, merge_welford,
+                                                 rmsd_for_atomgroups, rmsd_for_atomgroups_parallel)
+
+
+def test_kabsch_batch():
+    from MDAnalysis.analysis.align import rotation_matrix
+
+    rng = np.random.default_rng(3)
+    ref = rng.normal(size=(30, 3))
+    ref -= ref.mean(axis=0)
+    mobile = rng.normal(size=(5, 30, 3))
+    mobile -= mobile.mean(axis=1, keepdims=True)
+    weights = rng.uniform(1, 16, size=30)
+    for w in (None, weights):
+        rotations = kabsch_batch(mobile, ref, weights=w)
+        for frame, rotation in zip(mobile, rotations):
+            # the rotation of a single frame: ref ~ rotation @ mobile
+            expected, _ = rotation_matrix(frame, ref, weights=w)
+            np.testing.assert_allclose(rotation, expected.T, atol=1e-8)
+            assert np.isclose(np.linalg.det(rotation), 1)
+
+
+@pytest.mark.parametrize('ncpu,batch_size', [(1, 100), (1, 7), (2, 5)])
+def test_rmsd_matches_mdanalysis(protein_trajectory, ncpu, batch_size):
+    import MDAnalysis as mda
+
+    pdb, xtc, _ = protein_trajectory
+    groups = ['name CA and resid 1:10', 'resid 15:20']
+    expected = rmsd_for_atomgroups(mda.Universe(pdb, xtc), 'backbone', groups)
+    rmsd_df = rmsd_for_atomgroups_parallel(pdb, xtc, 'backbone', groups, ncpu=ncpu, batch_size=batch_size)
+    assert list(rmsd_df.columns) == list(expected.columns)
+    np.testing.assert_allclose(rmsd_df.values, expected.values, atol=0.011)
+
+
+def test_merge_welford():
+    rng = np.random.default_rng(4)
+    x = rng.normal(size=(20, 6, 3))
+    acc = (0, np.zeros((6, 3)), np.zeros((6, 3)))
+    for part in (x[:7], x[7:8], x[8:8], x[8:]):
+        mean = part.mean(axis=0) if len(part) else np.zeros((6, 3))
+        acc = merge_welford(acc, (len(part), mean, ((part - mean) ** 2).sum(axis=0)))
+    n, mean, m2 = acc
+    assert n == 20
+    np.testing.assert_allclose(mean, x.mean(axis=0))
+    np.testing.assert_allclose(m2 / n, x.var(axis=0))
+
+
+@pytest.mark.parametrize('ncpu,batch_size', [(1, 100), (2, 5)])
+def test_gyrate_and_rmsf_match_mdanalysis(protein_trajectory, ncpu, batch_size):
+    import MDAnalysis as mda
+    from MDAnalysis.analysis import align, rms
+
+    pdb, xtc, _ = protein_trajectory
+    res = analyse_trajectory(pdb, xtc, 'backbone', protein_selection='protein', ncpu=ncpu, batch_size=batch_size)
+
+    universe = mda.Universe(pdb, xtc)
+    protein = universe.select_atoms('protein')
+    masses = protein.masses
+    rg = []
+    for _ in universe.trajectory:
+        d2 = masses[:, None] * (protein.positions - protein.center_of_mass()) ** 2
+        rg.append([protein.radius_of_gyration()] +
+                  [np.sqrt(d2[:, list(axes)].sum() / masses.sum()) for axes in ((1, 2), (0, 2), (0, 1))])
+    np.testing.assert_allclose(res['rg'], rg, atol=1e-3)
+
+    # gmx rmsf: mass weighted fit of the protein to the first frame
+    universe.trajectory[0]
+    reference = mda.Universe(pdb, xtc)
+    align.AlignTraj(universe, reference, select='protein', weights='mass', in_memory=True).run()
+    rmsf = rms.RMSF(universe.select_atoms('protein')).run().results.rmsf
+    np.testing.assert_allclose(np.sqrt(res['msf']), rmsf, atol=1e-3)
@@ -0,0 +1,36 @@
+import os
+
+from streamd.utils.mdrun_performance import is_mdrun_log, parse_mdrun_log
+
+MD_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data', 'md.log')
+
+
+def test_parse_mdrun_log():
+    assert is_mdrun_log(MD_LOG)
+    res = parse_mdrun_log(MD_LOG)
+    assert res['host'] == 'node07'
+    assert res['cpu'] == 'AMD EPYC 7302 16-Core Processor'
+    assert res['gpus'] == ['NVIDIA NVIDIA A100-PCIE-40GB'] * 2
+    assert res['gpu_mapping'] == 'PP:0,PME:0'
+    assert (res['nsteps'], res['natoms'], res['ntmpi'], res['ntomp']) == (500000, 52467, 1, 16)
+    assert (res['ns_per_day'], res['hours_per_ns']) == (261.893, 0.092)
+    assert (res['core_time'], res['wall_time']) == (5278.4, 329.9)
+    assert res['load_imbalance'] == 3.2
+    assert res['device_flags'] == '-nb gpu -update gpu -pme gpu -bonded gpu -pmefft gpu'
+    assert res['cycle_accounting']['Wait GPU state copy'] == 75.9
+    assert res['cycle_accounting']['Rest'] == 10.3
+    assert res['notes'] == ['The number of threads is not equal to the number of (logical) cores '
+                            'and the -pin option is set to on: will pin threads to cores.']
+
+
+def test_parse_unfinished_mdrun_log(tmp_path):
+    with open(MD_LOG) as inp:
+        lines = inp.readlines()
+    log_file = str(tmp_path / 'md_out.log')
+    with open(log_file, 'w') as out:
+        out.writelines(line for line in lines if not line.startswith('Performance:'))
+    assert parse_mdrun_log(log_file) is None
+    # captured output of mdrun has the same header without the log file line
+    with open(log_file, 'w') as out:
+        out.writelines(line for line in lines if not line.startswith('Log file opened'))
+    assert not is_mdrun_log(log_file)
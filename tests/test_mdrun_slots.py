@@ -0,0 +1,76 @@
+import os
+
+from streamd.utils.mdrun_slots import (parse_cpulist, get_numa_cpus, get_slot_cpus, get_mdrun_cpu_order,
+                                       get_mdrun_pin_args)
+
+
+def write_file(fname, text):
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'w') as out:
+        out.write(text)
+
+
+def make_sysfs(root, numa_cpulists, nsockets=2, ncores=8):
+    '''
+    Two sockets of 8 cores with 2 hardware threads, Linux numbering: cpus 0-15 are the first threads of cores,
+    cpus 16-31 are their siblings
+    '''
+    for i, cpulist in enumerate(numa_cpulists):
+        write_file(os.path.join(root, 'node', f'node{i}', 'cpulist'), f'{cpulist}\n')
+    ncpu = nsockets * ncores
+    for cpu in range(2 * ncpu):
+        core = cpu % ncpu
+        write_file(os.path.join(root, 'cpu', f'cpu{cpu}', 'topology', 'physical_package_id'), f'{core // ncores}\n')
+        write_file(os.path.join(root, 'cpu', f'cpu{cpu}', 'topology', 'core_id'), f'{core % ncores}\n')
+    return os.path.join(root, 'node'), os.path.join(root, 'cpu')
+
+
+def test_parse_cpulist():
+    assert parse_cpulist('0-3,8,10-11\n') == [0, 1, 2, 3, 8, 10, 11]
+    assert parse_cpulist('5') == [5]
+    assert parse_cpulist('') == []
+
+
+def test_get_numa_cpus(tmp_path):
+    node_dir, _ = make_sysfs(str(tmp_path), ['0-7,16-23', '8-15,24-31'])
+    assert get_numa_cpus(node_dir, available_cpus=set(range(32))) == \
+        [list(range(8)) + list(range(16, 24)), list(range(8, 16)) + list(range(24, 32))]
+    # cpus not available to the process are skipped, nodes without available cpus are skipped
+    assert get_numa_cpus(node_dir, available_cpus={0, 1, 2}) == [[0, 1, 2]]
+
+
+def test_get_slot_cpus_within_numa_nodes():
+    numa_cpus = [list(range(0, 8)), list(range(8, 16))]
+    slots = [get_slot_cpus(slot, 4, 4, numa_cpus=numa_cpus) for slot in range(4)]
+    assert slots == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9, 10, 11], [12, 13, 14, 15]]
+
+
+def test_get_slot_cpus_whole_numa_nodes():
+    numa_cpus = [list(range(i * 4, i * 4 + 4)) for i in range(4)]
+    slots = [get_slot_cpus(slot, 2, 8, numa_cpus=numa_cpus) for slot in range(2)]
+    assert slots == [list(range(0, 8)), list(range(8, 16))]
+    # a slot does not take cpus of a node of another slot
+    slots = [get_slot_cpus(slot, 2, 6, numa_cpus=numa_cpus) for slot in range(2)]
+    assert slots == [list(range(0, 6)), list(range(8, 14))]
+
+
+def test_get_mdrun_cpu_order(tmp_path):
+    _, cpu_dir = make_sysfs(str(tmp_path), ['0-31'])
+    order = get_mdrun_cpu_order(cpu_dir)
+    # hardware threads of a core are consecutive
+    assert order[:4] == [0, 16, 1, 17]
+    assert order[16:18] == [8, 24]
+
+
+def test_get_mdrun_pin_args(tmp_path):
+    _, cpu_dir = make_sysfs(str(tmp_path), ['0-31'])
+    order = get_mdrun_cpu_order(cpu_dir)
+    # the first threads of cores 0-3: every second logical core of mdrun
+    assert get_mdrun_pin_args([0, 1, 2, 3], cpu_order=order) == "'-pin on -pinoffset 0 -pinstride 2'"
+    assert get_mdrun_pin_args([4, 5, 6, 7], cpu_order=order) == "'-pin on -pinoffset 8 -pinstride 2'"
+    # both threads of cores 0 and 1
+    assert get_mdrun_pin_args([0, 1, 16, 17], cpu_order=order) == "'-pin on -pinoffset 0 -pinstride 1'"
+    # cannot be described by a single offset and stride
+    assert get_mdrun_pin_args([0, 1, 16, 20], cpu_order=order) == ''
+    assert get_mdrun_pin_args([], cpu_order=order) == ''
+    assert get_mdrun_pin_args([0, 1], cpu_order=[]) == ''
@@ -0,0 +1,46 @@
+import os
+
+from streamd.utils.mdrun_performance import get_size_range
+from streamd.utils.mdrun_slots import format_mdrun_args, get_mdrun_params, quote_args
+from streamd.utils.mdrun_tuning import (get_cached_params, get_hardware_signature, init_tuning_cache,
+                                        save_cached_params, tune_mdrun)
+
+
+def make_complex_dir(wdir, natoms):
+    os.makedirs(wdir)
+    with open(os.path.join(wdir, 'solv_ions.gro'), 'w') as out:
+        out.write(f'system\n{natoms:5d}\n')
+    return wdir
+
+
+def test_size_range():
+    assert get_size_range(0) == '0-25000'
+    assert get_size_range(24999) == '0-25000'
+    assert get_size_range(25000) == '25000-50000'
+    assert get_size_range(None) == 'unknown'
+
+
+def test_tuning_cache_key(tmp_path):
+    cache_file = init_tuning_cache(str(tmp_path / 'cache' / 'mdrun_tuning.db'))
+    hardware = get_hardware_signature(8, [])
+    assert hardware != get_hardware_signature(16, [])
+    params = {'ntmpi': 2, 'ntomp': 4, 'update': 'cpu', 'pme': 'cpu', 'bonded': 'cpu', 'nstlist': 40}
+    save_cached_params(cache_file, hardware, '25000-50000', 'cpu', params, 100.0, 30000, [])
+    assert get_cached_params(cache_file, hardware, '25000-50000', 'cpu') == params
+    # parameters are not shared between sizes, hardware and devices
+    assert get_cached_params(cache_file, hardware, '0-25000', 'cpu') is None
+    assert get_cached_params(cache_file, get_hardware_signature(16, []), '25000-50000', 'cpu') is None
+    assert get_cached_params(cache_file, hardware, '25000-50000', 'auto') is None
+
+    # a system of the same size class uses the cached parameters without benchmarks
+    wdir = make_complex_dir(str(tmp_path / 'complex'), 40000)
+    args = dict(ncpu=8, compute_device='cpu', ntmpi_per_gpu=1, gpu_ids=[], pin_args='', cache_file=cache_file,
+                env={'PATH': ''})
+    assert tune_mdrun(wdir, **args) == tuple(quote_args(i) for i in format_mdrun_args(params))
+    assert not os.path.isdir(os.path.join(wdir, 'mdrun_tuning'))
+
+    # a larger system is benchmarked, if it fails (no gmx here) the default parameters are used and not cached
+    wdir = make_complex_dir(str(tmp_path / 'large_complex'), 60000)
+    default = get_mdrun_params(ncpu=8, compute_device='cpu', ntmpi_per_gpu=1, gpu_ids=[])
+    assert tune_mdrun(wdir, **args) == tuple(quote_args(i) for i in format_mdrun_args(default))
+    assert get_cached_params(cache_file, hardware, '50000-75000', 'cpu') is None
@@ -0,0 +1,30 @@
+import numpy as np
+import pandas as pd
+
+from streamd.utils.replicas import get_replica_dir, has_replicas, split_replica_name, summarize_replicas
+
+
+def test_replica_names():
+    assert get_replica_dir('/md/protein_lig/', 1) == '/md/protein_lig/'
+    assert get_replica_dir('/md/protein_lig/', 3) == '/md/protein_lig_replica3'
+    assert split_replica_name('protein_lig_replica3') == ('protein_lig', 3)
+    assert split_replica_name('protein_lig') == ('protein_lig', 1)
+    assert has_replicas(['protein_lig', 'protein_lig_replica2', 'protein_lig2'])
+    assert not has_replicas(['protein_lig', 'protein_lig2'])
+
+
+def test_summarize_replicas():
+    df = pd.DataFrame({'name': ['a', 'a_replica2', 'a_replica3', 'b', 'a', 'a_replica2', 'a_replica3', 'b'],
+                       'interaction': ['hb'] * 4 + ['hydrophobic'] * 4,
+                       'value': [1.0, 2.0, 4.0, 5.0, 0.5, 0.5, 0.5, 1.0]})
+    res = summarize_replicas(df, 'name', ['value'], group_cols=['interaction'])
+    res = res.set_index(['system', 'interaction'])
+    assert res.loc[('a', 'hb'), 'replicas'] == 3
+    assert res.loc[('a', 'hb'), 'value_mean'] == round(7 / 3, 3)
+    # sample standard deviation between replicas
+    assert res.loc[('a', 'hb'), 'value_sd'] == round(np.std([1, 2, 4], ddof=1), 3)
+    assert res.loc[('a', 'hydrophobic'), 'value_sd'] == 0
+    # a complex without replicas has no SD
+    assert res.loc[('b', 'hb'), 'replicas'] == 1
+    assert res.loc[('b', 'hb'), 'value_mean'] == 5
+    assert np.isnan(res.loc[('b', 'hb'), 'value_sd'])
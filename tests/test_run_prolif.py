@@ -0,0 +1,22 @@
+from streamd.prolif.run_prolif import run_prolif_shared_frames
+
+
+def test_shared_frames_fingerprints_match_serial_run(protein_trajectory):
+    import MDAnalysis as mda
+    import prolif as plf
+
+    pdb, xtc, _ = protein_trajectory
+    universe = mda.Universe(pdb, xtc)
+    # a residue of the protein is used as the ligand
+    ligand = universe.select_atoms('resid 10')
+    protein = universe.select_atoms('protein and not resid 10')
+    interactions = ['Hydrophobic', 'HBDonor', 'HBAcceptor', 'Cationic', 'Anionic']
+    fp = plf.Fingerprint(interactions)
+    fp.run(universe.trajectory[::2], ligand, protein, progress=False, n_jobs=1)
+
+    ifp = run_prolif_shared_frames(universe.trajectory[::2], protein, ligand, interactions, n_jobs=3)
+    assert sorted(ifp) == sorted(fp.ifp)
+    for frame in fp.ifp:
+        assert {key: sorted(value) for key, value in ifp[frame].items()} == \
+               {key: sorted(value) for key, value in fp.ifp[frame].items()}
+    assert any(fp.ifp[frame] for frame in fp.ifp)
@@ -0,0 +1,72 @@
+from streamd.utils.state_db import (init_state_db, save_task_state, get_finished_tasks, split_finished_tasks,
+                                    get_resume_point, get_task_callback, get_task_key, reset_state_db)
+
+
+def test_get_task_key():
+    assert get_task_key('wdir') == 'wdir'
+    # replicas in the same directory differ by deffnm
+    assert get_task_key(('wdir', 'md_out')) != get_task_key(('wdir', 'md_out_2'))
+    # molecules with the same id and different residue names
+    assert get_task_key((None, 'mol1', 'UNL')) != get_task_key((None, 'mol1', 'LIG'))
+    assert get_task_key((None, 'mol1', 'UNL')) == get_task_key((object(), 'mol1', 'UNL'))
+
+
+def test_split_finished_tasks(tmp_path):
+    db = init_state_db(str(tmp_path / 'state.db'))
+    save_task_state(db, 'simulation', 'wdir1', 'done', output=['wdir1', 'md_out'], signature='md_time=1')
+    save_task_state(db, 'simulation', 'wdir2', 'failed', output=None, signature='md_time=1')
+    outputs, args = split_finished_tasks(db, 'simulation', ['wdir1', 'wdir2', 'wdir3'], 'md_time=1')
+    assert outputs == [('wdir1', 'md_out')]
+    assert args == ['wdir2', 'wdir3']
+    # a changed signature forces the task to be run again
+    outputs, args = split_finished_tasks(db, 'simulation', ['wdir1', 'wdir2'], 'md_time=2')
+    assert outputs == []
+    assert args == ['wdir1', 'wdir2']
+
+
+def test_split_finished_tasks_callable_signature(tmp_path):
+    db = init_state_db(str(tmp_path / 'state.db'))
+    inputs = {'a': 1, 'b': 1}
+    signature = lambda arg: f'input={inputs[arg]}'
+    callback = get_task_callback(db, 'complex', signature)
+    for arg in ['a', 'b']:
+        callback(arg, f'{arg}_out', {})
+    assert split_finished_tasks(db, 'complex', ['a', 'b'], signature) == (['a_out', 'b_out'], [])
+    # only the task with changed inputs is run again
+    inputs['b'] = 2
+    assert split_finished_tasks(db, 'complex', ['a', 'b'], signature) == (['a_out'], ['b'])
+
+
+def test_get_resume_point(tmp_path):
+    db = init_state_db(str(tmp_path / 'state.db'))
+    save_task_state(db, 'equilibration', 'wdir1', 'done', output='wdir1', signature='nvt=1')
+    save_task_state(db, 'simulation', 'wdir1', 'done', output=['wdir1', 'md_out'], signature='md=1')
+    save_task_state(db, 'equilibration', 'wdir2', 'done', output='wdir2', signature='nvt=1')
+    signatures = ['nvt=1', 'md=1', 'md=1']
+    finished_tasks = [get_finished_tasks(db, stage, signature)
+                      for stage, signature in zip(['equilibration', 'simulation', 'analysis'], signatures)]
+
+    finished, stage_index, arg = get_resume_point(finished_tasks, 0, 'wdir1', signatures)
+    assert [i[0] for i in finished] == [0, 1]
+    assert (stage_index, arg) == (2, ('wdir1', 'md_out'))
+
+    finished, stage_index, arg = get_resume_point(finished_tasks, 0, 'wdir2', signatures)
+    assert (stage_index, arg) == (1, 'wdir2')
+
+    finished, stage_index, arg = get_resume_point(finished_tasks, 0, 'wdir3', signatures)
+    assert finished == [] and (stage_index, arg) == (0, 'wdir3')
+
+    # a changed signature of the simulation stage
+    signatures = ['nvt=1', 'md=2', 'md=2']
+    finished_tasks[1] = get_finished_tasks(db, 'simulation', 'md=2')
+    finished, stage_index, arg = get_resume_point(finished_tasks, 0, 'wdir1', signatures)
+    assert (stage_index, arg) == (1, 'wdir1')
+
+
+def test_reset_state_db(tmp_path):
+    db = init_state_db(str(tmp_path / 'state.db'))
+    save_task_state(db, 'ligand', (None, 'mol1', 'UNL'), 'done', output='lig')
+    save_task_state(db, 'complex', 'lig', 'done', output='wdir')
+    reset_state_db(db, ['complex'])
+    assert get_finished_tasks(db, 'complex') == {}
+    assert list(get_finished_tasks(db, 'ligand').values()) == ['lig']
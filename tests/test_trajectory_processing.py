@@ -0,0 +1,86 @@
+import logging
+
+import numpy as np
+import pytest
+
+from streamd.analysis.trajectory_processing import postprocess_trajectory
+
+
+def write_wrapped_trajectory(pdb, xtc, box_sizes, seed=2):
+    '''
+    Trajectory of the protein drifting through a small periodic box, atoms are wrapped into the box
+    :param box_sizes: size of the cubic box of each frame (A)
+    '''
+    import MDAnalysis as mda
+
+    universe = mda.Universe(pdb)
+    rng = np.random.default_rng(seed)
+    ref = universe.atoms.positions.copy()
+    drift = np.zeros(3)
+    with mda.Writer(xtc, n_atoms=len(universe.atoms)) as out:
+        for i, box_size in enumerate(box_sizes):
+            drift += rng.normal(scale=4, size=3)
+            universe.trajectory.ts.time = i * 10
+            universe.dimensions = [box_size] * 3 + [90] * 3
+            universe.atoms.positions = np.mod(ref + drift + rng.normal(scale=0.3, size=ref.shape), box_size)
+            out.write(universe.atoms)
+
+
+def write_index(pdb, index_file):
+    import MDAnalysis as mda
+
+    n_atoms = len(mda.Universe(pdb).atoms)
+    with open(index_file, 'w') as out:
+        for name in ['System', 'Protein']:
+            out.write(f'[ {name} ]\n' + ' '.join(str(i) for i in range(1, n_atoms + 1)) + '\n')
+
+
+def read_xtc(xtc):
+    from MDAnalysis.lib.formats.libmdaxdr import XTCFile
+
+    with XTCFile(xtc) as inp:
+        return np.array([frame.x for frame in inp])
+
+
+@pytest.mark.parametrize('npt', [False, True])
+def test_postprocess_trajectory_blocks_match_single_pass(protein_trajectory, tmp_path, caplog, npt):
+    pdb = protein_trajectory[0]
+    xtc, index_file = str(tmp_path / 'md_out.xtc'), str(tmp_path / 'index.ndx')
+    box_sizes = 40 * (1 + 0.02 * np.sin(np.arange(30))) if npt else [40] * 30
+    write_wrapped_trajectory(pdb, xtc, box_sizes)
+    write_index(pdb, index_file)
+
+    serial = postprocess_trajectory(pdb, xtc, index_file, 1, [(str(tmp_path / 'serial.xtc'), None, None),
+                                                              (str(tmp_path / 'serial_dt.xtc'), 'Protein', 20)])
+    with caplog.at_level(logging.INFO):
+        blocks = postprocess_trajectory(pdb, xtc, index_file, 1, [(str(tmp_path / 'blocks.xtc'), None, None),
+                                                                  (str(tmp_path / 'blocks_dt.xtc'), 'Protein', 20)],
+                                        ncpu=3)
+    # a trajectory with a changing box is processed in a single pass
+    assert ('processed by 3 blocks' in caplog.text) != npt
+    for fname1, fname2 in zip(serial, blocks):
+        np.testing.assert_allclose(read_xtc(fname1), read_xtc(fname2), atol=2e-3)
+    assert len(read_xtc(serial[1])) == 15
+    # molecules are whole: consecutive atoms of the protein are not split by the box in all frames
+    frames = read_xtc(serial[0])
+    assert np.abs(np.diff(frames, axis=1)).max() < 1
+
+
+def test_postprocess_trajectory_matches_mdanalysis(protein_trajectory, tmp_path):
+    import MDAnalysis as mda
+    from MDAnalysis import transformations
+
+    pdb = protein_trajectory[0]
+    xtc, index_file = str(tmp_path / 'md_out.xtc'), str(tmp_path / 'index.ndx')
+    write_wrapped_trajectory(pdb, xtc, [40] * 20)
+    write_index(pdb, index_file)
+    fit_xtc, = postprocess_trajectory(pdb, xtc, index_file, 1, [(str(tmp_path / 'fit.xtc'), None, None)])
+
+    # the protein is a single molecule, so nojump and centering are the same as making it whole in each frame,
+    # then it is fitted (mass weighted) to the structure of the topology as trjconv -fit rot+trans -s tpr
+    universe = mda.Universe(pdb, xtc)
+    universe.trajectory.add_transformations(transformations.unwrap(universe.atoms),
+                                            transformations.fit_rot_trans(universe.atoms, mda.Universe(pdb),
+                                                                          weights='mass'))
+    reference = np.array([universe.atoms.positions / 10 for _ in universe.trajectory])
+    np.testing.assert_allclose(read_xtc(fit_xtc), reference, atol=2e-3)
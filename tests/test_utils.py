@@ -0,0 +1,17 @@
+import json
+
+from streamd.utils.utils import run_check_subprocess
+
+
+def test_run_check_subprocess_saves_metrics(tmp_path):
+    metrics_file = str(tmp_path / 'metrics.jsonl')
+    env = {'PATH': '/usr/bin:/bin', 'STREAMD_METRICS_FILE': metrics_file}
+    log = str(tmp_path / 'complex' / 'log.txt')
+    # a large output is read without blocking the command
+    assert run_check_subprocess('head -c 1000000 /dev/zero', key='ok', log=log, env=env, stage='ok')
+    assert not run_check_subprocess('echo error; exit 3', key='failed', log=log, env=env, stage='failed',
+                                    ignore_error=True)
+    with open(metrics_file) as inp:
+        records = [json.loads(line) for line in inp]
+    assert [(i['stage'], i['key'], i['returncode']) for i in records] == [('ok', 'ok', 0), ('failed', 'failed', 3)]
+    assert all(i['wdir'] == str(tmp_path / 'complex') for i in records)